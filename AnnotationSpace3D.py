@@ -1,16 +1,20 @@
 import numpy as np
 import pickle
-import imageio
-from multiprocessing import Process
-from PIL import Image
-import matplotlib.pyplot as plt
 import os 
-import models
-from tqdm import tqdm
-from helpers import disk
-import asyncio
-
-target_size_init = (32, 640)
+import shutil
+import tempfile
+import threading
+import models # keras is imported when weights are loaded
+from inference import TiledPredictor, normalize_batch
+from wire import PredictionClient
+from predcache import PredictionCache, file_digest
+from helpers import plane_block, plane_slice, stroke_mask
+from chunkstore import ChunkStore, DEFAULT_CHUNK_SHAPE, chunk_slices, chunks_in_region
+from history import History
+from probmap import ProbabilityMap
+
+PREDICT_BATCH_SIZE = 8 # slides per model.predict batch
+DEFAULT_THRESHOLD = 0.8 # model outputs below it become annotations
 
 def normalize(img): # normalized between 1 and -1
     min = img.min()
@@ -22,17 +26,30 @@ class AnnotationSpace3D():
 	
 	def __init__(self, npimages, dimensions, color_rgba):
 		self.npimages = npimages
-		self.npspace_rgba = np.zeros((dimensions[0], dimensions[1], dimensions[2], 4), np.uint8)
-		self.npspace = np.zeros(dimensions, dtype=np.uint8)
+		self.npspace = np.zeros(dimensions, dtype=np.uint8) # label volume, 0 is unannotated and 1..255 index the palette
+		self.palette = np.zeros((256, 4), np.uint8) # label -> rgba lookup table, label 0 stays transparent
+		self.num_labels = 0
 		self.dim = dimensions # 25,500,500
-		self.MAX_UNDOS = 10
-		self.undo_stack = [] # state history undo type, tuples (plane, npspace slice, npspace rgba slice) (slice of voxels) FOR ALL PLANES
+		self.history = History() # sparse undo/redo deltas of npspace, capped by bytes
+		self.probabilities = ProbabilityMap(dimensions) # model outputs behind predicted labels, for re-thresholding
+		self.threshold = DEFAULT_THRESHOLD
 		self.color_rgba = color_rgba
 		self.server_url = ''
 		self.predict_mode = 'local'
 		self.model = None
+		self.predictor = None # TiledPredictor around model
+		self.model_id = None # hash of the loaded weights, part of prediction cache keys
+		self.prediction_cache = PredictionCache()
+		self.client = None # PredictionClient for server mode
 		self.connection_context = None
 		self.socket = None
+		self.chunk_shape = DEFAULT_CHUNK_SHAPE
+		self.dirty_chunks = set() # chunks changed since the last save to store_path
+		self.dirty_trackers = {'save': self.dirty_chunks} # name -> chunks changed since that consumer last looked
+		self.dirty_lock = threading.Lock() # trackers are taken from export threads while the GUI thread marks them
+		self.mesher = None # SurfaceMesher with cached chunk meshes of npspace
+		self.store_path = None # chunk store the annotations were last loaded from or saved to
+		self.revision = 0 # bumped on every change of npspace, lets caches of rendered slices tell stale entries apart
 
 	def get_npimages(self):
 		return self.npimages
@@ -40,265 +57,441 @@ class AnnotationSpace3D():
 	def get_npspace(self):
 		return self.npspace
 
+	def get_palette(self):
+		return self.palette[:self.num_labels+1]
+
+	def set_palette(self, colors): # colors for labels 1..n
+		self.palette[:] = 0
+		self.num_labels = len(colors)
+		if self.num_labels > 0:
+			self.palette[1:self.num_labels+1] = colors
+
+	def label_for_color(self, color_rgba):
+		''' label id of color_rgba in the palette, new colors are appended as new labels '''
+		color = np.asarray(color_rgba, np.uint8)
+		if not color.any(): # fully transparent means unannotated
+			return 0
+		matches = np.nonzero((self.palette[1:self.num_labels+1] == color).all(axis=1))[0]
+		if len(matches) > 0:
+			return int(matches[0]) + 1
+		if self.num_labels == 255:
+			raise ValueError("Palette is full, at most 255 labels are supported.")
+		self.num_labels += 1
+		self.palette[self.num_labels] = color
+		return self.num_labels
+
+	def labels_from_rgba(self, rgba):
+		''' converter for the old parallel rgba volumes, every distinct non-transparent color becomes a label '''
+		labels = np.zeros(rgba.shape[:-1], np.uint8)
+		for z in range(rgba.shape[0]): # slab by slab to keep temporaries small
+			packed = np.ascontiguousarray(rgba[z], np.uint8).view(np.uint32)[..., 0]
+			colors, inverse = np.unique(packed, return_inverse=True)
+			lut = np.array([self.label_for_color(c) for c in colors.view(np.uint8).reshape(-1, 4)], np.uint8)
+			labels[z] = lut[inverse.reshape(packed.shape)]
+		return labels
+
+	def palette_lut(self, palette):
+		''' lookup table from labels indexed into another palette onto labels of this palette '''
+		lut = np.zeros(256, np.uint8)
+		for i in range(1, len(palette)):
+			lut[i] = self.label_for_color(palette[i])
+		return lut
+
+	def import_labels(self, labels, palette):
+		return self.palette_lut(palette)[labels]
+
+	def mark_dirty(self, region):
+		''' mark chunks overlapping region (z0, z1, y0, y1, x0, x1) as changed for every dirty tracker '''
+		chunks = chunks_in_region(region, self.dim, self.chunk_shape)
+		with self.dirty_lock:
+			for tracker in self.dirty_trackers.values():
+				tracker.update(chunks)
+		self.revision += 1
+
+
+	def mark_all_dirty(self): # npspace was replaced as a whole
+		self.mark_dirty((0, self.dim[0], 0, self.dim[1], 0, self.dim[2]))
+
+
+	def track_dirty(self, name, everything=False):
+		''' start collecting changed chunks under name, e.g. for a view that updates incrementally, optionally starting with all chunks '''
+		with self.dirty_lock: # mark_dirty may be iterating the trackers on another thread
+			self.dirty_trackers.setdefault(name, set())
+		if everything:
+			self.mark_dirty_chunks(name, chunks_in_region((0, self.dim[0], 0, self.dim[1], 0, self.dim[2]), self.dim, self.chunk_shape))
+
+
+	def take_dirty_chunks(self, name):
+		''' indices of the chunks changed since name last took them '''
+		with self.dirty_lock: # nothing marked in between is lost
+			tracker = self.dirty_trackers[name]
+			chunks = sorted(tracker)
+			tracker.clear()
+		return chunks
+
+
+	def mark_dirty_chunks(self, name, chunks): # hand chunks back to one tracker, e.g. after a failed write
+		with self.dirty_lock:
+			self.dirty_trackers[name].update(chunks)
+
+
+	def take_dirty(self, name):
+		''' chunks changed since the last take_dirty(name), as (z0, z1, y0, y1, x0, x1) voxel boxes '''
+		return [tuple(b for s in chunk_slices(idx, self.dim, self.chunk_shape) for b in (s.start, s.stop)) for idx in self.take_dirty_chunks(name)]
+
+
+	def mark_dirty_slice(self, p, cs, r0=0, r1=None, c0=0, c1=None):
+		''' mark rows r0:r1 and columns c0:c1 of slide cs on plane p dirty, whole slide by default '''
+		w,h,d = self.dim
+		if p == 'xy':
+			self.mark_dirty((cs, cs+1, r0, h if r1 is None else r1, c0, d if c1 is None else c1))
+		elif p == 'xz':
+			self.mark_dirty((r0, w if r1 is None else r1, cs, cs+1, c0, d if c1 is None else c1))
+		elif p == 'yz':
+			self.mark_dirty((c0, w if c1 is None else c1, r0, h if r1 is None else r1, cs, cs+1))
+
+
 	def draw(self, plane, curr_slide, x, y, brush_size, is_brush, color_rgba):
-		if plane == 'xy':
-			rr, cc = disk(center=(y, x), radius=brush_size, shape=(self.dim[1], self.dim[2]))
-			self.npspace[curr_slide, rr, cc] = is_brush
-			self.npspace_rgba[curr_slide, rr, cc] = color_rgba
+		return self.draw_stroke(plane, curr_slide, [(x, y)], brush_size, is_brush, color_rgba)
 
 
-		elif plane == 'yz':
-			rr, cc = disk(center=(y, x), radius=brush_size, shape=(self.dim[1], self.dim[0]))
-			self.npspace[:,:,curr_slide][cc, rr] = is_brush
-			self.npspace_rgba[:,:,curr_slide][cc, rr] = color_rgba
-			
+	def draw_stroke(self, plane, curr_slide, points, brush_size, is_brush, color_rgba):
+		''' paint the capsules swept between consecutive (x, y) points in one write, returns the dirty (r0, r1, c0, c1) box or None '''
+		label = self.label_for_color(color_rgba) if is_brush else 0
+		view = plane_slice(self.npspace, plane, curr_slide) # writable 2D view in display orientation
+		stroke = stroke_mask([(y, x) for x, y in points], brush_size, view.shape)
+		if stroke is None:
+			return None
 
-		elif plane == 'xz':
-			rr, cc = disk(center=(y, x) , radius=brush_size, shape=(self.dim[0], self.dim[1]))
-			self.npspace[:,curr_slide,:][rr, cc] = is_brush
-			self.npspace_rgba[:,curr_slide,:][rr, cc] = color_rgba
+		r0, c0, mask = stroke
+		r1, c1 = r0 + mask.shape[0], c0 + mask.shape[1]
+		self.begin_operation()
+		self.history.record(self.npspace, plane, curr_slide, r0, r1, c0, c1)
+		view[r0:r1, c0:c1][mask] = label
+		self.end_operation()
+		self.probabilities.invalidate(plane, curr_slide, r0, r1, c0, c1, mask) # hand-painted voxels keep their labels
+		self.mark_dirty_slice(plane, curr_slide, r0, r1, c0, c1)
+		return r0, r1, c0, c1
 
 
 	def save(self, path):
-		file = open(path, 'wb')
-		pickle.dump(self.npspace_rgba, file)
-		file.close()
-		imageio.mimwrite(path+'.tiff', self.npspace_rgba)
+		''' save annotations as a chunk store directory, only dirty chunks are rewritten when saving to the same store again '''
+		if os.path.isfile(path):
+			print("Cannot save annotations,", path, "is an existing file.")
+			return False
+		path = os.path.abspath(path)
+
+		if path == self.store_path and ChunkStore.is_store(path):
+			store = ChunkStore.open(path)
+			store.attrs['palette'] = self.get_palette().tolist()
+			store.write_volume(self.npspace, sorted(self.dirty_chunks))
+			self.probabilities.save(path, sorted(self.dirty_chunks))
+		else:
+			store = ChunkStore.create(path, self.npspace.shape, self.npspace.dtype, self.chunk_shape, attrs={'palette': self.get_palette().tolist()})
+			store.write_volume(self.npspace)
+			self.probabilities.save(path)
+
+		print("Saved", len(store.chunks), "non-empty chunks to", path)
+		self.store_path = path
+		self.dirty_chunks.clear()
+		return True
 		
 
-	def exportProcess(self, path, plane):
-		os.mkdir(path) 
-		image_path = os.path.join(path, 'image')
-		label_path = os.path.join(path, 'label')
-		os.mkdir(image_path)
-		os.mkdir(label_path) 
-
-		pindex = 0 # xy
-		if plane == 'xz':
-			pindex = 1
-		elif plane == 'yz':
-			pindex = 2
-		
-		for i in range(self.npimages.shape[pindex]):
-			fname = str(i)+'.png'
-			im = np.array([])
-			if plane == 'xy':
-				im = self.npimages[i]
-			elif plane == 'xz':
-				im = self.npimages[:,i,:]
-			elif plane == 'yz':
-				im = self.npimages[:,:,i]
-				
-			imageio.imwrite(uri=os.path.join(image_path, fname), im=im, format='PNG-PIL')  
+	def export(self, path, planes=('xz',), progress=None, skip_existing=True, workers=None):
+		''' export image/label PNGs of the given planes with a process pool sharing the volumes (in this process for workers=0), blocks until done '''
+		if isinstance(planes, str):
+			planes = (planes,)
+		from exporter import export_dataset # process pools and shared memory are only loaded when exporting
+		written = export_dataset(self.npimages, self.npspace, path, planes, workers=workers, skip_existing=skip_existing, progress=progress)
+		print("Exported", written, "slides of", ', '.join(planes), "to", path)
+		return written
 		
-		# 1 -> 0 black, 0 -> 255 white for 3D annotation matrix
-		self.npspace8bit = np.where(self.npspace==0, 255, self.npspace)
-		self.npspace8bit = np.where(self.npspace8bit==1, 0,self.npspace8bit)
-
-		for i in range(self.npimages.shape[pindex]):
-			fname = str(i)+'.png'
-			im = np.array([])
-			if plane == 'xy':
-				im = self.npspace8bit[i]
-			elif plane == 'xz':
-				im = self.npspace8bit[:,i,:]
-			elif plane == 'yz':
-				im = self.npspace8bit[:,:,i]
-
-			label_img = Image.fromarray(im.astype(np.uint8))
-			label_img.save(os.path.join(label_path, fname), "PNG")
-		
-		print("Exported to", path)
 
+	def export_shards(self, path, planes=('xz',), patch=None, compress=False, progress=None):
+		''' export annotated slides (or patches of them) as large training shards with an index '''
+		if isinstance(planes, str):
+			planes = (planes,)
+		from shards import write_shards
+		count = write_shards(self.npimages, self.npspace, path, planes, patch=patch, compress=compress, progress=progress)
+		print("Exported", count, "training pairs of", ', '.join(planes), "to", path)
+		return count
+
+
+	def export_mesh(self, path, progress=None):
+		''' write the surface of all annotations as .obj or .ply, only chunks edited since the last export are meshed again '''
+		from meshing import SurfaceMesher
+		if self.mesher is None or self.mesher.volume is not self.npspace: # first export, or labels loaded as a whole
+			self.track_dirty('mesh')
+			self.take_dirty('mesh')
+			self.mesher = SurfaceMesher(self.npspace)
+		for region in self.take_dirty('mesh'):
+			self.mesher.invalidate(region)
+		self.mesher.update(progress)
+		verts, faces = self.mesher.export(path)
+		print("Exported surface with", verts, "vertices and", faces, "faces to", path)
+		return faces
 
-	def export(self, path, plane): 
-		exportproc = Process(target=self.exportProcess, args=(path, plane,)) # parallel
-		exportproc.start()
-		
 
 	def load_model_weights(self, model_weights_file): # hdf5 file
-		''' load model weights for unet from given file and input size for xz default '''
-		self.model = models.unet(pretrained_weights=model_weights_file, input_size=(32, 640, 1))
+		''' load model weights for unet from given file, built fully convolutional so tiles of any slide size fit '''
+		self.model = models.unet(pretrained_weights=model_weights_file, input_size=(None, None, 1))
 		self.model.summary()
+		self.predictor = TiledPredictor(self.model)
+		self.model_id = 'unet:' + file_digest(model_weights_file)
 		print("Model loaded successfully.")
+
+
+	def set_prediction_cache_dir(self, directory): # keep model outputs on disk as well, across sessions
+		self.prediction_cache = PredictionCache(directory=directory)
 		
 
 	def set_server_url(self, url):
 		self.server_url = url
 		self.predict_mode = 'server'
+		if self.client is not None:
+			self.client.close()
+		self.client = PredictionClient(url)
 
 
 	def model_predict(self, p, cs):
-		img = self.get_src_slice(p, cs)
-		print("Predicting for", p, cs+1,"from",self.predict_mode)
+		self.predict_slices(p, cs, cs+1)
+
+
+	def predict_slices(self, p, start, stop, batch_size=PREDICT_BATCH_SIZE):
+		''' predict slides start:stop of plane p as batches and write the thresholded labels back at once '''
+		stop = min(stop, self.npspace.shape[{'xy': 0, 'xz': 1, 'yz': 2}[p]])
+		if stop <= start:
+			return
+		print("Predicting for", p, str(start+1)+'-'+str(stop), "from", self.predict_mode)
+
+		probs = self.predict_probabilities(p, start, stop, batch_size)
+		if probs is not None:
+			self.apply_prediction(p, start, probs)
+
+
+	def predict_probabilities(self, p, start, stop, batch_size=PREDICT_BATCH_SIZE):
+		''' (n, rows, cols) model output for slides start:stop of plane p, voxels below the threshold are annotations '''
+		imgs = plane_block(self.npimages, p, start, stop)
 
 		if self.predict_mode == 'server':
-			import requests
-			import json
-			
-			url = self.server_url
-			api = "/predict_model"
-			url += api
-
-			data = {'slide': img.tolist()}
-
-			response = requests.post(url, json=data)
-			print(response)
-
-			if response.status_code == 200:
-				bin_pred = json.loads(response.content)['prediction']
-				bin_pred = np.array(bin_pred)
-				print(bin_pred.shape)
-
-				rgba_pred = np.stack((bin_pred,)*4, axis=-1)
-				rgba_pred = np.where(rgba_pred == [1,1,1,1], self.color_rgba, [0,0,0,0]) #color for rgba else transparent
-
-				if p == 'xy':
-					self.npspace[cs] = bin_pred
-					self.npspace_rgba[cs] = rgba_pred
-				elif p == 'yz':
-					self.npspace[:,:,cs] = bin_pred
-					self.npspace_rgba[:,:,cs] = rgba_pred
-				elif p == 'xz':
-					self.npspace[:,cs,:] = bin_pred
-					self.npspace_rgba[:,cs,:] = rgba_pred
-			else:
-				print('Predict API call failed.', response)
+			try:
+				return self.client.predict(imgs) # binary batches over a pooled session, JSON per slide for old servers
+			except Exception as e:
+				print(e)
+				return None
 
 
 		elif self.predict_mode == 'local':
 
 			if (self.model is None): # model has not been loaded
 				print("No model loaded for local predictions.")
-				return
+				return None
+
+			keys = [PredictionCache.key(img, self.model_id, p, self.predictor.params) for img in imgs]
+			probs = np.empty(imgs.shape, np.float32)
+			missing = [] # slides never predicted with this model
+			for i, key in enumerate(keys):
+				cached = self.prediction_cache.get(key)
+				if cached is None:
+					missing.append(i)
+				else:
+					probs[i] = cached
+			if len(missing) == 0:
+				return probs
 
 			try:
-				from tensorflow import image as tfimage
-
-				img = normalize(img)
-				img = np.reshape(img,img.shape+(1,))
-				img = tfimage.pad_to_bounding_box(img, 0, 0, target_size_init[0], target_size_init[1])
-				img = np.reshape(img,(1,)+img.shape) # (x,y,1) -> (1,x,y,1)
-
-				np_results = self.model.predict(img, verbose=1)
-				pred = np_results[0]
-				# output = pred[:,:,0]*255
-				pred = pred.reshape(pred.shape[0], pred.shape[1])
-				# print("prediction", pred.shape, np.max(pred), np.min(pred))
-				# print("prediction out", output.shape, np.max(output), np.min(output))
-				# plt.figure()
-				# plt.imshow(output)
-				# plt.show()
-
-				t = 0.8 # thresholding param
-
-				bin_pred = np.copy(pred)
-				bin_pred = np.where(bin_pred < t, 1, 0) # transparent if above threshold else annotation
-				bin_pred = bin_pred[:25, :500]
-
-				rgba_pred = np.stack((bin_pred,)*4, axis=-1)
-				rgba_pred = np.where(rgba_pred == [1,1,1,1], [255,0,0,255], [0,0,0,0]) #color for rgba else transparent
-
-				if p == 'xy':
-					self.npspace[cs] = bin_pred
-					self.npspace_rgba[cs] = rgba_pred
-				elif p == 'yz':
-					self.npspace[:,:,cs] = bin_pred
-					self.npspace_rgba[:,:,cs] = rgba_pred
-				elif p == 'xz':
-					# print(bin_pred.dtype, self.npspace[:,cs,:].dtype, self.npspace.dtype)
-					self.npspace[:,cs,:] = bin_pred
-					self.npspace_rgba[:,cs,:] = rgba_pred
-					# print(bin_pred.dtype, self.npspace[:,cs,:].dtype, self.npspace.dtype)
+				self.predictor.batch_size = batch_size
+				out = self.predictor.predict(normalize_batch(imgs[missing])) # overlapping tiles, batched across slides
 
 			except Exception as e:
 				print(e)
-			
+				return None
+
+			for i, o in zip(missing, out):
+				probs[i] = o
+				self.prediction_cache.put(keys[i], o)
+			return probs
+
+
+	def apply_prediction(self, p, start, probs):
+		''' threshold probabilities of slides start:start+n and write them as one undo step, the probabilities are kept '''
+		label = np.uint8(self.label_for_color(self.color_rgba))
+		labels = (probs < self.threshold).astype(np.uint8) # transparent if above threshold else annotation
+		labels *= label
+		stop = start + len(probs)
+		self.begin_operation()
+		before = self.probabilities.snapshot(p, start, stop) # undo puts these back, redo the new ones
+		self.history.attach({'probabilities': 'stored', 'plane': p, 'start': start, 'stop': stop, 'before': before},
+		                    4 * probs.size if before is not None else 2 * probs.size) # values and labels, the after snapshot is taken on undo
+		self.probabilities.store(p, start, probs, label)
+		for cs in range(start, stop):
+			self.history.record(self.npspace, p, cs, 0, probs.shape[1], 0, probs.shape[2])
+		plane_block(self.npspace, p, start, stop)[...] = labels
+		self.end_operation()
+
+		for cs in range(start, stop):
+			self.mark_dirty_slice(p, cs)
+
+
+	def set_threshold(self, t, slab=8):
+		''' re-binarize every predicted voxel at threshold t from the kept probabilities, one undo step, no model calls '''
+		self.threshold = t
+		if not self.probabilities.allocated:
+			return
+		self.begin_operation()
+		self.history.attach({'probabilities': 'kept'}) # only labels change, the probabilities stay valid across undo/redo
+		for z0 in range(0, self.dim[0], slab): # vectorized per slab of xy slides to bound temporaries
+			region = (slice(z0, min(z0 + slab, self.dim[0])),)
+			predicted, labels = self.probabilities.binarize(t, region)
+			changed = predicted & (self.npspace[region] != labels)
+			for k in np.nonzero(changed.any(axis=(1, 2)))[0]:
+				z = z0 + int(k)
+				rows = np.nonzero(changed[k].any(axis=1))[0]
+				cols = np.nonzero(changed[k].any(axis=0))[0]
+				r0, r1, c0, c1 = int(rows[0]), int(rows[-1]) + 1, int(cols[0]), int(cols[-1]) + 1
+				self.history.record(self.npspace, 'xy', z, r0, r1, c0, c1)
+				np.copyto(self.npspace[z], labels[k], where=changed[k])
+				self.mark_dirty_slice('xy', z, r0, r1, c0, c1)
+		self.end_operation()
+
 
 	def load(self, path):
-		file = open(path, 'rb')
-		self.npspace_rgba = pickle.load(file)
+		if ChunkStore.is_store(path): # chunk store, only the stored (non-empty) chunks are read one by one
+			store = ChunkStore.open(path)
+			if store.shape[:3] != tuple(self.dim):
+				raise ValueError("Annotation store shape %s does not match volume %s" % (store.shape[:3], tuple(self.dim)))
+			self.npspace = np.zeros(self.dim, dtype=np.uint8)
+			self.set_palette(store.attrs.get('palette', [[0, 0, 0, 0]])[1:])
+			for idx, sl, chunk in store.iter_chunks():
+				if chunk.ndim == 4: # early stores kept the rgba volume
+					chunk = self.labels_from_rgba(chunk)
+				self.npspace[sl] = chunk
+			self.probabilities.load(store.path)
+			self.store_path = os.path.abspath(store.path)
+			self.mark_all_dirty()
+			self.dirty_chunks.clear() # same as the store again
+			self.history.clear()
+			return
+
+		file = open(path, 'rb') # legacy pickled rgba volume, converted to labels
+		npspace_rgba = pickle.load(file)
+		file.close()
+		self.set_palette([])
+		self.npspace = self.labels_from_rgba(npspace_rgba)
+		self.probabilities.clear()
+		self.store_path = None
+		self.history.clear()
+		self.mark_all_dirty()
+
+
+	def mergeload(self, path_list, mode='union', k=None, progress=None):
+		''' merge several annotation files chunk by chunk, see merge.MODES. With union later files win where labels overlap '''
+		self.set_merged(self.merge_files(path_list, mode, k, progress))
+
+
+	def merge_files(self, path_list, mode='union', k=None, progress=None):
+		''' merged label volume of several annotation files, npspace is left alone so this can run on a worker thread '''
+		from merge import merge_stores
+		tmp = tempfile.mkdtemp(prefix='annot3d-merge-')
+		try:
+			inputs = [self.merge_input(path, os.path.join(tmp, str(i))) for i, path in enumerate(path_list)]
+			return merge_stores(inputs, self.dim, self.chunk_shape, mode, k, progress=progress)
+		finally:
+			shutil.rmtree(tmp, ignore_errors=True)
+
+
+	def set_merged(self, labels): # replace npspace by a merge_files result
+		self.npspace = labels
+		self.probabilities.clear() # merged labels no longer follow any single prediction
+		self.store_path = None # merged result is not saved anywhere yet
+		self.history.clear()
+		self.mark_all_dirty()
+
+
+	def merge_input(self, path, tmp_path):
+		''' (store, lut) of an annotation file for merging, rgba volumes are converted to a temporary label store first '''
+		identity = np.arange(256, dtype=np.uint8)
+		if ChunkStore.is_store(path):
+			store = ChunkStore.open(path)
+			if store.shape[:3] != tuple(self.dim):
+				raise ValueError("Annotation store shape %s does not match volume %s" % (store.shape[:3], tuple(self.dim)))
+			if len(store.shape) == 3:
+				return store, self.palette_lut(store.attrs.get('palette', [[0, 0, 0, 0]]))
+			labels = ChunkStore.create(tmp_path, self.dim, np.uint8, store.chunk_shape) # early stores kept the rgba volume
+			for idx, sl, chunk in store.iter_chunks():
+				labels.write_chunk(idx, self.labels_from_rgba(chunk))
+			labels.write_manifest()
+			return labels, identity
+
+		file = open(path, 'rb') # legacy pickled rgba volume, only one is held in memory at a time
+		rgba = pickle.load(file)
 		file.close()
-		self.npspace = np.clip(np.sum(self.npspace_rgba, axis=3), 0, 1) # e.g. [0,0,255,255] sums to 510 then clipped to 1
+		labels = ChunkStore.create(tmp_path, self.dim, np.uint8, self.chunk_shape)
+		labels.write_volume(self.labels_from_rgba(rgba))
+		return labels, identity
 
-		# import mcubes
-		# vertices, triangles = mcubes.marching_cubes(self.npspace, 0)
-		# mcubes.export_obj(vertices, triangles, 'annot.obj')
 
-	def mergeload(self, path_list):
-		self.npspace_rgba = np.zeros((self.dim[0], self.dim[1], self.dim[2], 4), np.uint8)
-		for path in path_list:
-			file = open(path, 'rb')
-			self.npspace_rgba += pickle.load(file)
-			file.close()
+	def begin_operation(self):
+		''' group all following edits into one undo step until the matching end_operation '''
+		self.history.begin()
 
-		self.npspace_rgba = np.clip(self.npspace_rgba, 0, 255)
-		self.npspace = np.clip(np.sum(self.npspace_rgba, axis=3), 0, 1)
 
+	def end_operation(self):
+		self.history.end(self.npspace)
 
-	def save_history(self, plane, curr_slide):
-		if (len(self.undo_stack) == self.MAX_UNDOS): # when max undos reached
-			self.undo_stack.pop(0) # head removed, to make room for more at tail
-		
-		npspace_slice, npspace_rgba_slice = None, None
-		# before modifying original save history of slices
-		if plane == 'xy':
-			npspace_slice, npspace_rgba_slice = self.npspace[curr_slide], self.npspace_rgba[curr_slide]
-		elif plane == 'yz':
-			npspace_slice, npspace_rgba_slice = self.npspace[:,:,curr_slide], self.npspace_rgba[:,:,curr_slide]
-		elif plane == 'xz':
-			npspace_slice, npspace_rgba_slice = self.npspace[:,curr_slide,:], self.npspace_rgba[:,curr_slide,:]
 
-		self.undo_stack.append((plane, curr_slide, np.copy(npspace_slice), np.copy(npspace_rgba_slice)))
+	def operation_open(self): # inside begin_operation/end_operation, e.g. while a stroke is drawn
+		return self.history.depth > 0
 
 
 	def undo_history(self):
-		if (len(self.undo_stack) != 0): # not empty
-			plane, curr_slide, npspace_slice, npspace_rgba_slice = self.undo_stack.pop()
-			if plane == 'xy':
-				self.npspace[curr_slide] = npspace_slice
-				self.npspace_rgba[curr_slide] = npspace_rgba_slice
-
-			elif plane == 'yz':
-				self.npspace[:,:,curr_slide] = npspace_slice
-				self.npspace_rgba[:,:,curr_slide] = npspace_rgba_slice
-
-			elif plane == 'xz':
-				self.npspace[:,curr_slide,:] = npspace_slice
-				self.npspace_rgba[:,curr_slide,:] = npspace_rgba_slice
+		entry = self.history.undo(self.npspace)
+		info = getattr(entry, 'info', None) or {}
+		if info.get('probabilities') == 'stored': # an undone prediction takes its probabilities along
+			info['after'] = self.probabilities.snapshot(info['plane'], info['start'], info['stop'])
+			self.probabilities.restore(info['plane'], info['start'], info['stop'], info['before'])
+		for delta in entry:
+			if not info.get('probabilities'):
+				self.probabilities.invalidate(delta.plane, delta.cs, *delta.rect) # restored labels win over kept predictions
+			self.mark_dirty_slice(delta.plane, delta.cs, *delta.rect)
+
+
+	def redo_history(self):
+		entry = self.history.redo(self.npspace)
+		info = getattr(entry, 'info', None) or {}
+		if info.get('probabilities') == 'stored': # a redone prediction can be re-thresholded again
+			self.probabilities.restore(info['plane'], info['start'], info['stop'], info['after'])
+		for delta in entry:
+			if not info.get('probabilities'):
+				self.probabilities.invalidate(delta.plane, delta.cs, *delta.rect)
+			self.mark_dirty_slice(delta.plane, delta.cs, *delta.rect)
+
+
+	def write_slice(self, p, cs, labels): # replace the whole slide cs on plane p, recorded for undo
+		view = plane_slice(self.npspace, p, cs)
+		self.begin_operation()
+		self.history.record(self.npspace, p, cs, 0, view.shape[0], 0, view.shape[1])
+		view[...] = labels
+		self.end_operation()
+		self.probabilities.invalidate(p, cs, 0, view.shape[0], 0, view.shape[1])
+		self.mark_dirty_slice(p, cs)
 
 
 	def get_npspace(self):
 		return self.npspace
 
 
-	def get_slice(self, p, cs):
-		if p == 'xy':
-			return self.npspace_rgba[cs]
-		elif p == 'xz':
-			return self.npspace_rgba[:,cs,:]
-		elif p == 'yz':
-			return np.swapaxes(self.npspace_rgba, 0, 2)[cs]
+	def get_slice(self, p, cs, rect=None): # rgba image of the labels on slide cs (or its (r0, r1, c0, c1) rect), built through the palette only for display
+		labels = plane_slice(self.npspace, p, cs)
+		if rect is not None:
+			labels = labels[rect[0]:rect[1], rect[2]:rect[3]]
+		return self.palette[labels]
 
-	def get_src_slice(self, p, cs):
-		if p == 'xy':
-			return self.npimages[cs]
-		elif p == 'xz':
-			return self.npimages[:,cs,:]
-		elif p == 'yz':
-			return np.swapaxes(self.npimages, 0, 2)[cs]
+	def get_src_slice(self, p, cs): # npimages can be a np array or a lazily read TiffVolume
+		return plane_slice(self.npimages, p, cs)
 
 
 	def clear_slice(self, p, cs):
-		w,h,d = self.dim
-		if p == 'xy':
-			self.npspace[cs] = np.zeros((h, d), np.uint8)
-			self.npspace_rgba[cs] = np.zeros((h, d, 4), np.uint8)
-		elif p == 'yz':
-			self.npspace[:,:,cs] = np.zeros((h, w), np.uint8)
-			self.npspace_rgba[:,:,cs] = np.zeros((h, w, 4), np.uint8)
-		elif p == 'xz':
-			self.npspace[:,cs,:] = np.zeros((w, h), np.uint8)
-			self.npspace_rgba[:,cs,:] = np.zeros((w, h, 4), np.uint8)
+		self.write_slice(p, cs, 0)
 
 	
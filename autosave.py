@@ -0,0 +1,147 @@
+import hashlib
+import os
+import queue
+import threading
+import time
+
+import numpy as np
+
+from chunkstore import ChunkStore, chunk_slices
+
+AUTOSAVE_ROOT = os.path.join(os.path.expanduser('~'), '.cache', 'annot3d', 'autosave')
+DEFAULT_SLOTS = 3
+EMPTY = np.zeros(0, np.uint8) # written for chunks that became all zero, ChunkStore.write_chunk removes those
+
+
+def session_dir(source_path, shape, root=AUTOSAVE_ROOT):
+    ''' autosave directory of one source volume, named by its absolute path and shape '''
+    key = hashlib.sha1(('%s%s' % (os.path.abspath(source_path), tuple(shape))).encode()).hexdigest()[:16]
+    return os.path.join(root, key)
+
+
+class Autosaver():
+    ''' Rotating restore points of an AnnotationSpace3D, written on a background thread.
+
+    Each restore point is a chunk store slot with its own dirty tracker, so a snapshot
+    only copies the chunks changed since that slot was last written. All-zero chunks the
+    slot does not hold are skipped, so the first snapshot of a fresh slot copies only the
+    annotated chunks. Copying happens on the calling (GUI) thread, compressing and writing
+    happens on the writer thread. A slot is marked incomplete while it is written, recovery
+    skips those. Chunks that failed to write come back to the GUI thread through a queue
+    and are copied again by that slot's next snapshot.
+    '''
+
+    def __init__(self, annot, directory, source_path, slots=DEFAULT_SLOTS):
+        self.annot = annot
+        self.directory = directory
+        self.source_path = os.path.abspath(source_path)
+        self.slots = slots
+        self.next_slot = 0
+        self.revision = annot.revision
+        self.stored = [] # per slot, chunks its store holds as far as the GUI thread knows
+        for i in range(slots): # every slot starts out needing all chunks
+            annot.track_dirty(self.tracker(i), everything=True)
+            self.stored.append(set(ChunkStore.open(self.slot_path(i)).chunks) if ChunkStore.is_store(self.slot_path(i)) else set())
+        self.queue = queue.Queue()
+        self.failed = queue.Queue() # (slot, chunk indices) the writer could not write
+        self.writer = threading.Thread(target=self._run, name='autosave', daemon=True)
+        self.writer.start()
+
+    def tracker(self, i):
+        return 'autosave-%d' % i
+
+    def slot_path(self, i):
+        return os.path.join(self.directory, 'slot-%d' % i)
+
+    def snapshot(self):
+        ''' queue a restore point if the annotations changed since the last one, returns the slot or None '''
+        annot = self.annot
+        self.requeue_failed()
+        if annot.revision == self.revision:
+            return None
+        i = self.next_slot
+        self.next_slot = (i + 1) % self.slots
+        npspace = annot.get_npspace() # loading or merging replaces it and marks every chunk dirty
+        chunks = {}
+        for idx in annot.take_dirty_chunks(self.tracker(i)): # copy on write: only chunks changed since this slot's last write
+            block = npspace[chunk_slices(idx, annot.dim, annot.chunk_shape)]
+            if block.any():
+                chunks[idx] = block.copy()
+                self.stored[i].add(idx)
+            elif idx in self.stored[i]: # erased since, drop it from the slot
+                chunks[idx] = EMPTY
+                self.stored[i].discard(idx)
+        attrs = {'palette': annot.get_palette().tolist(), 'source': self.source_path, 'time': time.time(),
+                 'revision': annot.revision, 'complete': False}
+        self.revision = annot.revision
+        self.queue.put((i, chunks, attrs))
+        return i
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                self.queue.task_done()
+                return
+            i, chunks, attrs = job
+            try:
+                self._write(i, chunks, attrs)
+            except Exception as e:
+                print("Autosave failed:", e)
+                self.failed.put((i, list(chunks))) # write them again next time, trackers belong to the GUI thread
+            self.queue.task_done()
+
+    def requeue_failed(self):
+        while not self.failed.empty():
+            i, chunks = self.failed.get()
+            self.annot.mark_dirty_chunks(self.tracker(i), chunks)
+            self.stored[i].update(chunks) # the store may still hold them
+            self.revision = None # the next snapshot must not be skipped
+
+    def _write(self, i, chunks, attrs):
+        path = self.slot_path(i)
+        if ChunkStore.is_store(path):
+            store = ChunkStore.open(path)
+        else:
+            store = ChunkStore.create(path, self.annot.dim, np.uint8, self.annot.chunk_shape)
+        store.manifest['attrs'] = dict(store.attrs, complete=False)
+        store.write_manifest() # a crash from here on leaves the slot marked incomplete
+        for idx, data in chunks.items():
+            store.write_chunk(idx, data)
+        store.manifest['attrs'] = dict(attrs, complete=True)
+        store.write_manifest()
+
+    def wait(self):
+        self.queue.join()
+
+    def shutdown(self, clean=False):
+        ''' write a last restore point and stop the writer, a clean shutdown is not offered for recovery '''
+        self.snapshot()
+        self.queue.put(None)
+        self.writer.join()
+        if clean:
+            for i in range(self.slots):
+                if ChunkStore.is_store(self.slot_path(i)):
+                    store = ChunkStore.open(self.slot_path(i))
+                    store.attrs['clean'] = True
+                    store.write_manifest()
+
+
+def newest_restore_point(directory, shape):
+    ''' (path, attrs) of the newest complete slot in directory left by a crash or unsaved changes, else None '''
+    best = None
+    if not os.path.isdir(directory):
+        return None
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if not ChunkStore.is_store(path):
+            continue
+        store = ChunkStore.open(path)
+        attrs = store.attrs
+        if store.shape[:3] != tuple(shape) or not attrs.get('complete'):
+            continue
+        if best is None or attrs['time'] > best[1]['time']:
+            best = (path, attrs)
+    if best is None or best[1].get('clean'):
+        return None
+    return best
@@ -0,0 +1,144 @@
+''' Headless prediction and export for many volumes, without the GUI.
+
+    python batch.py "stacks/*.tiff" --weights unet.hdf5 --save out/annotations --export out/datasets
+    python batch.py @volumes.txt --server http://localhost:5000 --planes xz --shards out/shards
+    python batch.py stacks/ --export out/datasets
+
+Volumes are spread over worker processes, each loading the model once.
+'''
+import argparse
+import glob
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from AnnotationSpace3D import AnnotationSpace3D, DEFAULT_THRESHOLD
+from helpers import open_tiff
+from inference import TiledPredictor
+from predcache import file_digest
+
+PREDICTION_COLOR = [255, 0, 0, 255] # label color of predicted annotations, as the GUI's initial color
+RUN_SLIDES = 32 # slides predicted and written per step
+TIFF_EXTENSIONS = ('.tif', '.tiff') # files a directory input expands to
+
+
+def expand_inputs(patterns):
+    ''' tiff paths from globs, directories (their tiff files) and @files listing one of them per line, in order without duplicates '''
+    paths = []
+    for pattern in patterns:
+        if pattern.startswith('@'):
+            with open(pattern[1:], 'r') as f:
+                paths.extend(expand_inputs([line.strip() for line in f if line.strip()]))
+            continue
+        if os.path.isdir(pattern):
+            matches = sorted(os.path.join(pattern, f) for f in os.listdir(pattern) if f.lower().endswith(TIFF_EXTENSIONS))
+        else:
+            matches = sorted(glob.glob(pattern))
+        if len(matches) == 0:
+            print("No files match", pattern)
+        paths.extend(matches)
+    return list(dict.fromkeys(paths))
+
+
+_worker = {} # per worker process: the loaded model, shared by all volumes it processes
+
+
+def init_worker(weights, server_url, cpu):
+    if cpu:
+        os.environ['CUDA_VISIBLE_DEVICES'] = '-1' # before tensorflow is imported
+    if weights: # same model setup as AnnotationSpace3D.load_model_weights
+        import models
+        model = models.unet(pretrained_weights=weights, input_size=(None, None, 1))
+        _worker['model'] = (model, TiledPredictor(model), 'unet:' + file_digest(weights))
+    _worker['server_url'] = server_url
+
+
+def process_volume(path, args):
+    ''' predict and save/export one volume, returns a summary dict '''
+    started = time.perf_counter()
+    npimages = open_tiff(path)
+    annot = AnnotationSpace3D(npimages, npimages.shape, PREDICTION_COLOR)
+    annot.threshold = args.threshold
+    if _worker.get('server_url'):
+        annot.set_server_url(_worker['server_url'])
+    elif 'model' in _worker:
+        annot.model, annot.predictor, annot.model_id = _worker['model']
+
+    name = os.path.splitext(os.path.basename(path))[0]
+    if args.load: # start from existing annotations, predictions are painted over them
+        annot.load(os.path.join(args.load, name))
+
+    slides = 0
+    if args.predict:
+        for plane in args.planes:
+            depth = annot.npspace.shape[{'xy': 0, 'xz': 1, 'yz': 2}[plane]]
+            for start in range(0, depth, RUN_SLIDES):
+                annot.predict_slices(plane, start, min(start + RUN_SLIDES, depth), args.batch_size)
+                annot.history.clear() # nothing to undo headless, keep memory flat
+            slides += depth
+
+    if args.save:
+        os.makedirs(args.save, exist_ok=True)
+        annot.save(os.path.join(args.save, name))
+    if args.export:
+        annot.export(os.path.join(args.export, name), args.planes, workers=0) # volumes are the parallel unit already
+    if args.shards:
+        annot.export_shards(os.path.join(args.shards, name), args.planes, patch=args.patch)
+
+    return {'path': path, 'slides': slides, 'voxels': int(annot.npspace.size), 'seconds': time.perf_counter() - started,
+            'annotated': int((annot.npspace > 0).sum())}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Predict and export annotations for many tiff volumes without the GUI')
+    parser.add_argument('inputs', nargs='+', help='tiff paths, globs, directories or @file listing them')
+    parser.add_argument('--weights', help='unet weights (hdf5) for local predictions')
+    parser.add_argument('--server', help='prediction server URL instead of local weights')
+    parser.add_argument('--planes', nargs='+', default=['xz'], choices=['xy', 'xz', 'yz'])
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD)
+    parser.add_argument('--batch-size', type=int, default=8, help='slides per model batch')
+    parser.add_argument('--load', help='directory of annotation stores named like the volumes to start from')
+    parser.add_argument('--save', help='directory for annotation stores, one per volume')
+    parser.add_argument('--export', help='directory for PNG datasets, one per volume')
+    parser.add_argument('--shards', help='directory for training shards, one per volume')
+    parser.add_argument('--patch', type=int, nargs=2, help='patch size (rows cols) for --shards')
+    parser.add_argument('--workers', type=int, default=1, help='volumes processed in parallel, each worker loads the model')
+    parser.add_argument('--cpu', action='store_true', help='hide GPUs from tensorflow')
+    args = parser.parse_args()
+
+    args.predict = bool(args.weights or args.server)
+    if not (args.predict or args.export or args.shards):
+        parser.error('nothing to do, give --weights/--server and/or --export/--shards')
+    if args.predict and not (args.save or args.export or args.shards):
+        parser.error('predictions would be lost, give --save, --export or --shards')
+
+    paths = expand_inputs(args.inputs)
+    if len(paths) == 0:
+        parser.error('no tiff volumes found')
+    print("Processing", len(paths), "volumes with", args.workers, "workers")
+    started = time.perf_counter()
+    results, failed = [], []
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=init_worker, initargs=(args.weights, args.server, args.cpu)) as pool:
+        futures = {pool.submit(process_volume, path, args): path for path in paths}
+        for future in as_completed(futures):
+            try:
+                r = future.result()
+            except Exception as e:
+                print("Failed", futures[future], e)
+                failed.append(futures[future])
+                continue
+            results.append(r)
+            print("[%d/%d] %s: %d slides in %.1fs, %d annotated voxels" % (len(results) + len(failed), len(paths),
+                  r['path'], r['slides'], r['seconds'], r['annotated']))
+
+    elapsed = time.perf_counter() - started
+    slides = sum(r['slides'] for r in results)
+    voxels = sum(r['voxels'] for r in results)
+    print("Done: %d volumes (%d failed) in %.1fs, %.2f volumes/s, %.1f slides/s, %.1f Mvoxels/s" % (
+        len(results), len(failed), elapsed, len(results) / elapsed, slides / elapsed, voxels / elapsed / 1e6))
+    for path in failed:
+        print("  failed:", path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+''' micro-benchmark of the cached helpers.disk against the original per-call implementation
+
+run from the repository root: python benchmarks/bench_disk.py
+'''
+import os
+import sys
+import timeit
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from helpers import disk
+
+
+def disk_reference(center, radius, *, shape=None): # helpers.disk before the stencil cache
+    radii = np.array([radius, radius])
+
+    upper_left = np.ceil(center - radii).astype(int)
+    upper_left = np.maximum(upper_left, np.array([0, 0]))
+
+    lower_right = np.floor(center + radii).astype(int)
+    lower_right = np.minimum(lower_right, np.array(shape[:2]) - 1)
+
+    shifted_center = center - upper_left
+    bounding_shape = lower_right - upper_left + 1
+
+    r_lim, c_lim = np.ogrid[0:float(bounding_shape[0]), 0:float(bounding_shape[1])]
+    r_org, c_org = shifted_center
+    r_rad, c_rad = radii
+
+    r, c = (r_lim - r_org), (c_lim - c_org)
+    distances = (r / r_rad) ** 2 + (-c / c_rad) ** 2
+    rr, cc = np.nonzero(distances < 1)
+
+    rr.flags.writeable = True
+    cc.flags.writeable = True
+    rr += upper_left[0]
+    cc += upper_left[1]
+
+    return rr, cc
+
+
+def main(number=2000):
+    shape = (500, 500)
+    print('%6s %14s %14s %8s' % ('radius', 'reference us', 'cached us', 'speedup'))
+    for radius in (1, 5, 10, 15, 40):
+        for center in [(250, 250), (3, 497), (120.5, 80.25)]: # interior, clipped and sub-pixel centers
+            a = disk_reference(center, radius, shape=shape)
+            b = disk(center, radius, shape=shape)
+            assert np.array_equal(a[0], b[0]) and np.array_equal(a[1], b[1]), (center, radius)
+
+        center = (250, 250)
+        ref = timeit.timeit(lambda: disk_reference(center, radius, shape=shape), number=number) / number * 1e6
+        new = timeit.timeit(lambda: disk(center, radius, shape=shape), number=number) / number * 1e6
+        print('%6d %14.1f %14.1f %7.1fx' % (radius, ref, new, ref / new))
+
+
+if __name__ == '__main__':
+    main()
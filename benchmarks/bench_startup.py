@@ -0,0 +1,53 @@
+''' startup time of the annotation tool: module imports and launch to first paint, each in fresh interpreters
+
+run from the repository root: python benchmarks/bench_startup.py [runs]
+'''
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+DEFERRED = ['mayavi.mlab', 'keras', 'tensorflow'] # imported on first use, shown for comparison
+
+
+def import_seconds(module):
+    ''' seconds to import module in a fresh interpreter, None if it is not installed '''
+    code = 'import sys, time; sys.path.insert(0, %r); t = time.perf_counter(); import %s; print(time.perf_counter() - t)' % (ROOT, module)
+    r = subprocess.run([sys.executable, '-c', code], cwd=ROOT, capture_output=True, text=True)
+    return float(r.stdout.split()[-1]) if r.returncode == 0 else None
+
+
+def launch_seconds():
+    ''' (wall seconds, startup line) of main.py quitting right after its first paint, None if it fails '''
+    env = dict(os.environ, ANNOT3D_QUIT_AFTER_STARTUP='1')
+    started = time.perf_counter()
+    r = subprocess.run([sys.executable, 'main.py'], cwd=ROOT, env=env, capture_output=True, text=True)
+    lines = [l for l in r.stdout.splitlines() if l.startswith('Startup:')]
+    if r.returncode != 0 or len(lines) == 0:
+        return None
+    return time.perf_counter() - started, lines[-1]
+
+
+def report(name, samples):
+    samples = [s for s in samples if s is not None]
+    if len(samples) == 0:
+        print('%-24s %10s' % (name, 'n/a'))
+    else:
+        print('%-24s %9.2fs %9.2fs' % (name, statistics.median(samples), min(samples)))
+
+
+def main(runs=5):
+    print('%-24s %10s %10s' % ('', 'median', 'best'))
+    for module in ['AnnotationSpace3D', 'main'] + DEFERRED:
+        report('import ' + module, [import_seconds(module) for _ in range(runs)])
+
+    launches = [launch_seconds() for _ in range(runs)]
+    report('launch to first paint', [l[0] if l else None for l in launches])
+    if launches[-1]:
+        print(launches[-1][1])
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
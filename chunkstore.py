@@ -0,0 +1,163 @@
+import json
+import os
+import zlib
+from itertools import product
+
+import numpy as np
+
+MANIFEST_NAME = 'manifest.json'
+CHUNKS_DIR = 'chunks'
+FORMAT_NAME = 'annot3d-chunks'
+FORMAT_VERSION = 1
+DEFAULT_CHUNK_SHAPE = (32, 128, 128) # z, y, x voxels per chunk
+
+
+def chunk_grid(shape, chunk_shape): # number of chunks along each of the 3 spatial axes
+    return tuple(-(-s // c) for s, c in zip(shape[:3], chunk_shape))
+
+
+def chunk_slices(idx, shape, chunk_shape): # voxel region covered by chunk idx
+    return tuple(slice(i*c, min((i+1)*c, s)) for i, c, s in zip(idx, chunk_shape, shape[:3]))
+
+
+def chunks_in_region(region, shape, chunk_shape):
+    ''' indices of all chunks overlapping region, a (z0, z1, y0, y1, x0, x1) voxel box with exclusive ends '''
+    ranges = []
+    for axis in range(3):
+        start = max(region[2*axis], 0)
+        stop = min(region[2*axis+1], shape[axis])
+        if stop <= start:
+            return []
+        ranges.append(range(start // chunk_shape[axis], (stop-1) // chunk_shape[axis] + 1))
+    return list(product(*ranges))
+
+
+def store_root(path): # accept the manifest file itself, as picked in a file dialog
+    if os.path.basename(path) == MANIFEST_NAME:
+        return os.path.dirname(path)
+    return path
+
+
+class ChunkStore():
+    ''' Annotation volume stored on disk as separately zlib compressed 3D chunks.
+
+    The store is a directory with a json manifest and one file per chunk under chunks/.
+    Only chunks holding non-zero voxels are written, so an empty or sparse volume
+    takes almost no space, and rewriting a chunk never touches the others.
+    '''
+
+    def __init__(self, path, manifest):
+        self.path = path
+        self.manifest = manifest
+        self.shape = tuple(manifest['shape'])
+        self.dtype = np.dtype(manifest['dtype'])
+        self.chunk_shape = tuple(manifest['chunk_shape'])
+        self.chunks = set(tuple(int(i) for i in name.split('.')) for name in manifest['chunks'])
+
+    @staticmethod
+    def is_store(path):
+        return os.path.isfile(os.path.join(store_root(path), MANIFEST_NAME))
+
+    @classmethod
+    def create(cls, path, shape, dtype, chunk_shape=DEFAULT_CHUNK_SHAPE, attrs=None, level=3):
+        ''' new empty store at path, an existing store there is reused and its chunks dropped '''
+        os.makedirs(os.path.join(path, CHUNKS_DIR), exist_ok=True)
+        manifest = {
+            'format': FORMAT_NAME,
+            'version': FORMAT_VERSION,
+            'shape': list(shape),
+            'dtype': np.dtype(dtype).str,
+            'chunk_shape': list(chunk_shape),
+            'compression': 'zlib',
+            'level': level,
+            'chunks': [],
+            'attrs': attrs or {},
+        }
+        store = cls(path, manifest)
+        if cls.is_store(path):
+            for idx in cls.open(path).chunks:
+                store._remove(idx)
+        store.write_manifest()
+        return store
+
+    @classmethod
+    def open(cls, path):
+        path = store_root(path)
+        with open(os.path.join(path, MANIFEST_NAME), 'r') as f:
+            manifest = json.load(f)
+        if manifest.get('format') != FORMAT_NAME:
+            raise ValueError('Not an annotation chunk store: ' + str(path))
+        return cls(path, manifest)
+
+    @property
+    def attrs(self):
+        return self.manifest['attrs']
+
+    @property
+    def grid(self):
+        return chunk_grid(self.shape, self.chunk_shape)
+
+    def slices(self, idx):
+        return chunk_slices(idx, self.shape, self.chunk_shape)
+
+    def chunk_file(self, idx):
+        return os.path.join(self.path, CHUNKS_DIR, '.'.join(str(i) for i in idx))
+
+    def read_chunk(self, idx):
+        ''' decompressed chunk idx, zeros if it was never written '''
+        shape = tuple(s.stop - s.start for s in self.slices(idx)) + self.shape[3:]
+        if idx not in self.chunks:
+            return np.zeros(shape, self.dtype)
+        with open(self.chunk_file(idx), 'rb') as f:
+            data = zlib.decompress(f.read())
+        return np.frombuffer(data, dtype=self.dtype).reshape(shape).copy()
+
+    def read_region(self, region):
+        ''' voxels of region, a tuple of 3 slices with explicit bounds, assembled from the stored chunks it overlaps '''
+        out = np.zeros(tuple(s.stop - s.start for s in region) + self.shape[3:], self.dtype)
+        box = [b for s in region for b in (s.start, s.stop)]
+        for idx in chunks_in_region(box, self.shape, self.chunk_shape):
+            if idx not in self.chunks:
+                continue
+            sl = self.slices(idx)
+            src = tuple(slice(max(a.start, b.start) - a.start, min(a.stop, b.stop) - a.start) for a, b in zip(sl, region))
+            dst = tuple(slice(max(a.start, b.start) - b.start, min(a.stop, b.stop) - b.start) for a, b in zip(sl, region))
+            out[dst] = self.read_chunk(idx)[src]
+        return out
+
+    def iter_chunks(self):
+        ''' (idx, voxel slices, array) for every stored chunk, read one at a time '''
+        for idx in sorted(self.chunks):
+            yield idx, self.slices(idx), self.read_chunk(idx)
+
+    def write_chunk(self, idx, data):
+        ''' compress and write one chunk, all-zero chunks are removed from the store instead '''
+        if not data.any():
+            self._remove(idx)
+            return
+        data = np.ascontiguousarray(data, dtype=self.dtype)
+        tmp = self.chunk_file(idx) + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(zlib.compress(data.tobytes(), self.manifest['level']))
+        os.replace(tmp, self.chunk_file(idx)) # never leave a half written chunk behind
+        self.chunks.add(idx)
+
+    def write_volume(self, volume, indices=None):
+        ''' write the given chunk indices (default all) of volume and update the manifest '''
+        if indices is None:
+            indices = product(*(range(n) for n in self.grid))
+        for idx in indices:
+            self.write_chunk(idx, volume[self.slices(idx)])
+        self.write_manifest()
+
+    def _remove(self, idx):
+        if os.path.exists(self.chunk_file(idx)):
+            os.remove(self.chunk_file(idx))
+        self.chunks.discard(idx)
+
+    def write_manifest(self):
+        self.manifest['chunks'] = ['.'.join(str(i) for i in idx) for idx in sorted(self.chunks)]
+        tmp = os.path.join(self.path, MANIFEST_NAME + '.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(self.manifest, f)
+        os.replace(tmp, os.path.join(self.path, MANIFEST_NAME))
@@ -0,0 +1,143 @@
+''' Parallel export of image/label PNG pairs for training, e.g. with the unet in models.py. '''
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+
+import numpy as np
+from PIL import Image
+
+PLANES = ('xy', 'xz', 'yz')
+PLANE_AXIS = {'xy': 0, 'xz': 1, 'yz': 2}
+SLICES_PER_TASK = 16
+START_METHOD = 'spawn' # the GUI process runs threads, forking it can deadlock workers on locks held at fork time
+
+# label 1 -> 0 black (k -> k-1 for further labels), 0 -> 255 white for 3D annotation matrix
+LABEL_LUT = np.arange(-1, 255).astype(np.uint8)
+
+
+class SharedVolume():
+    ''' picklable handle to a copy of a numpy volume in shared memory, workers attach instead of unpickling the data '''
+
+    def __init__(self, array):
+        self.shape, self.dtype = array.shape, array.dtype
+        self.shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        np.copyto(self.array(), array)
+
+    def array(self):
+        return np.ndarray(self.shape, self.dtype, buffer=self.shm.buf)
+
+    def __getstate__(self):
+        return {'name': self.shm.name, 'shape': self.shape, 'dtype': self.dtype}
+
+    def __setstate__(self, state):
+        self.shape, self.dtype = state['shape'], state['dtype']
+        self.shm = shared_memory.SharedMemory(name=state['name'])
+
+    def close(self, unlink=False):
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+
+def share(volume):
+    ''' volume as something cheap to send to workers: TiffVolumes reopen their file, arrays go to shared memory '''
+    if isinstance(volume, np.ndarray):
+        return SharedVolume(volume)
+    return volume
+
+
+def plane_dirs(path, planes):
+    ''' image and label directory per plane, a single plane keeps the old path/image, path/label layout '''
+    if len(planes) == 1:
+        return {planes[0]: (os.path.join(path, 'image'), os.path.join(path, 'label'))}
+    return {p: (os.path.join(path, p, 'image'), os.path.join(path, p, 'label')) for p in planes}
+
+
+_handles = None # shared volumes attached once per worker process, kept alive while their arrays are used
+_volumes = None # (images, labels)
+
+
+def _attach(images, labels):
+    global _handles, _volumes
+    _handles = (images, labels)
+    _volumes = tuple(v.array() if isinstance(v, SharedVolume) else v for v in _handles)
+
+
+def export_slice(volume, plane, i):
+    ''' slide i of plane as written to PNG, yz keeps the z x y layout of the old export rather than the display orientation '''
+    if plane == 'xy':
+        return volume[i]
+    elif plane == 'xz':
+        return volume[:, i, :]
+    elif plane == 'yz':
+        return volume[:, :, i]
+
+
+def _save_png(array, fname): # written under a temporary name so a resumed export never keeps a partial file
+    tmp = fname + '.part'
+    Image.fromarray(np.ascontiguousarray(array)).save(tmp, 'PNG')
+    os.replace(tmp, fname)
+
+
+def _export_slices(plane, indices, image_dir, label_dir, skip_existing):
+    images, labels = _volumes
+    written = 0
+    for i in indices:
+        fname = str(i) + '.png'
+        image_file, label_file = os.path.join(image_dir, fname), os.path.join(label_dir, fname)
+        if skip_existing and os.path.exists(image_file) and os.path.exists(label_file):
+            continue
+        _save_png(np.asarray(export_slice(images, plane, i)), image_file)
+        _save_png(LABEL_LUT[export_slice(labels, plane, i)], label_file)
+        written += 1
+    return len(indices), written
+
+
+def export_dataset(images, labels, path, planes=('xz',), workers=None, skip_existing=True, progress=None):
+    ''' write image and label PNGs of every slide of the given planes below path using a process pool.
+
+    workers=0 exports in the calling process instead. progress(done, total) is called in
+    the calling thread as tasks finish. Returns the number of slides written, slides whose
+    two files exist already are skipped if skip_existing, so an interrupted export can be
+    resumed.
+    '''
+    dirs = plane_dirs(path, list(planes))
+    for image_dir, label_dir in dirs.values():
+        os.makedirs(image_dir, exist_ok=True)
+        os.makedirs(label_dir, exist_ok=True)
+
+    tasks = []
+    for plane, (image_dir, label_dir) in dirs.items():
+        n = labels.shape[PLANE_AXIS[plane]]
+        for start in range(0, n, SLICES_PER_TASK):
+            tasks.append((plane, range(start, min(start + SLICES_PER_TASK, n)), image_dir, label_dir, skip_existing))
+    total = sum(len(t[1]) for t in tasks)
+
+    done = written = 0
+    if workers == 0: # e.g. inside a worker process of a batch run
+        _attach(images, labels)
+        for t in tasks:
+            n, w = _export_slices(*t)
+            done += n
+            written += w
+            if progress is not None:
+                progress(done, total)
+        return written
+
+    shared = [share(images), share(labels)] # labels are copied once, so edits during the export do not tear it
+    try:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(START_METHOD),
+                                 initializer=_attach, initargs=tuple(shared)) as pool:
+            futures = [pool.submit(_export_slices, *t) for t in tasks]
+            for future in as_completed(futures):
+                n, w = future.result()
+                done += n
+                written += w
+                if progress is not None:
+                    progress(done, total)
+    finally:
+        for v in shared:
+            if isinstance(v, SharedVolume):
+                v.close(unlink=True)
+    return written
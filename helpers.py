@@ -1,57 +1,118 @@
-from PIL import Image
+from collections import OrderedDict
+from functools import lru_cache
+import threading
 import numpy as np
+from volume import TiffVolume
 
-# from skimage draw
-def disk(center, radius, *, shape=None):
-  radii = np.array([radius, radius])
-
-  upper_left = np.ceil(center - radii).astype(int)
-  upper_left = np.maximum(upper_left, np.array([0, 0]))
 
-  lower_right = np.floor(center + radii).astype(int)
-  lower_right = np.minimum(lower_right, np.array(shape[:2]) - 1)
+@lru_cache(maxsize=128)
+def stencil(radius, phase=(0.0, 0.0)):
+    ''' offsets of all pixels (or voxels, for a 3D phase) strictly inside a disk/ball of radius
 
-  shifted_center = center - upper_left
-  bounding_shape = lower_right - upper_left + 1
+    phase is the sub-pixel part of the center, so a center c covers floor(c) + offsets.
+    Offsets are cached per (radius, phase) and returned read-only, one array per axis.
+    '''
+    reach = int(np.ceil(radius)) + 1
+    grids = np.ogrid[tuple(slice(-reach, reach + 1) for _ in phase)]
+    distances = sum((g - f) ** 2 for g, f in zip(grids, phase))
+    offsets = tuple(o - reach for o in np.nonzero(distances < radius ** 2))
+    for o in offsets:
+        o.flags.writeable = False
+    return offsets
 
-  r_lim, c_lim = np.ogrid[0:float(bounding_shape[0]), 0:float(bounding_shape[1])]
-  r_org, c_org = shifted_center
-  r_rad, c_rad = radii
 
-  r, c = (r_lim - r_org), (c_lim - c_org)
-  distances = (r / r_rad) ** 2 + (-c / c_rad) ** 2
-  rr, cc = np.nonzero(distances < 1)
+# same pixels as skimage.draw.disk, served from the stencil cache
+def disk(center, radius, *, shape=None):
+  center = np.asarray(center, dtype=float)
+  base = np.floor(center).astype(int)
+  dr, dc = stencil(float(radius), tuple((center - base).tolist()))
 
-  rr.flags.writeable = True
-  cc.flags.writeable = True
-  rr += upper_left[0]
-  cc += upper_left[1]
+  rr = dr + base[0]
+  cc = dc + base[1]
+  reach = int(np.ceil(radius)) + 1
+  inside = shape is None or (base.min() >= reach and base[0] + reach < shape[0] and base[1] + reach < shape[1])
+  if not inside: # clip against slice bounds
+    keep = (rr >= 0) & (rr < shape[0]) & (cc >= 0) & (cc < shape[1])
+    rr, cc = rr[keep], cc[keep]
 
   return rr, cc
 
 
 
-def read_tiff(path): # returns tiff image stack as np array
-    img = Image.open(path)
-    xy = []
-    xz = []
-    yz = []
+def stroke_mask(points, radius, shape):
+    ''' rasterize the swept capsules between consecutive (row, col) points of a stroke
+
+    returns (r0, c0, mask), the union of all capsules as a boolean mask whose top left corner
+    is at (r0, c0) and clipped to shape, or None if the stroke lies outside. A single point gives
+    the same pixels as disk().
+    '''
+    pts = np.asarray(points, dtype=float).reshape(-1, 2)
+    if len(pts) == 1: # plain stamp, straight from the stencil cache
+        rr, cc = disk(pts[0], radius, shape=shape)
+        if len(rr) == 0:
+            return None
+        r0, c0 = rr.min(), cc.min()
+        mask = np.zeros((rr.max() - r0 + 1, cc.max() - c0 + 1), dtype=bool)
+        mask[rr - r0, cc - c0] = True
+        return r0, c0, mask
+
+    r0 = max(int(np.ceil(pts[:, 0].min() - radius)), 0)
+    c0 = max(int(np.ceil(pts[:, 1].min() - radius)), 0)
+    r1 = min(int(np.floor(pts[:, 0].max() + radius)), shape[0] - 1)
+    c1 = min(int(np.floor(pts[:, 1].max() + radius)), shape[1] - 1)
+    if r1 < r0 or c1 < c0:
+        return None
 
-    for i in range(img.n_frames): #x-y plane
-        img.seek(i)  
-        xy.append(np.array(img))
+    mask = np.zeros((r1 - r0 + 1, c1 - c0 + 1), dtype=bool)
+    for a, b in zip(pts[:-1], pts[1:]):
+        # bounding box of this segment's capsule inside the stroke mask
+        sr0 = max(int(np.ceil(min(a[0], b[0]) - radius)), r0)
+        sc0 = max(int(np.ceil(min(a[1], b[1]) - radius)), c0)
+        sr1 = min(int(np.floor(max(a[0], b[0]) + radius)), r1)
+        sc1 = min(int(np.floor(max(a[1], b[1]) + radius)), c1)
+        if sr1 < sr0 or sc1 < sc0:
+            continue
 
-    xy = np.array(xy)
+        r = np.arange(sr0, sr1 + 1, dtype=float)[:, None] - a[0]
+        c = np.arange(sc0, sc1 + 1, dtype=float)[None, :] - a[1]
+        d = b - a
+        length2 = d[0] ** 2 + d[1] ** 2
+        t = 0.0 if length2 == 0 else np.clip((r * d[0] + c * d[1]) / length2, 0.0, 1.0) # projection onto segment
+        distances = (r - t * d[0]) ** 2 + (c - t * d[1]) ** 2
+        mask[sr0 - r0:sr1 - r0 + 1, sc0 - c0:sc1 - c0 + 1] |= distances < radius ** 2
 
-    for npimg in np.swapaxes(xy, 0, 1): # x with z, x-z plane
-        xz.append(npimg)
+    return r0, c0, mask
 
-    for npimg in np.swapaxes(xy, 0, 2): # x with y, y-z plane
-        yz.append(npimg)
 
+def open_tiff(path): # returns lazy (z, y, x) volume, memory-mapped when the tiff is uncompressed
+    return TiffVolume(path)
+
+
+def read_tiff(path): # returns tiff image stack as np array with x-z and y-z views
+    xy = np.asarray(open_tiff(path))
+    xz = np.swapaxes(xy, 0, 1) # x with z, x-z plane
+    yz = np.swapaxes(xy, 0, 2) # x with y, y-z plane
     return xy, xz, yz
 
 
+def plane_block(volume, p, start, stop): # slides start:stop of plane p as a (n, rows, cols) view, each like plane_slice
+    if p == 'xy':
+        return volume[start:stop]
+    elif p == 'xz':
+        return volume[:, start:stop, :].transpose(1, 0, 2)
+    elif p == 'yz':
+        return volume[:, :, start:stop].transpose(2, 1, 0)
+
+
+def plane_slice(volume, p, cs): # 2D view of slide cs on plane p, works for np arrays and TiffVolume
+    if p == 'xy':
+        return volume[cs]
+    elif p == 'xz':
+        return volume[:, cs, :]
+    elif p == 'yz':
+        return volume[:, :, cs].T
+
+
 def apply_contrast(npslice, f):
     minval = np.percentile(npslice, f) # vary threshold between 1st and 99th percentiles, when f=1
     maxval = np.percentile(npslice, 100-f)
@@ -61,4 +122,163 @@ def apply_contrast(npslice, f):
 
 
 def apply_brightness(npslice, f):
-    return (npslice*f).astype(np.short)
\ No newline at end of file
+    return (npslice*f).astype(np.short)
+
+def histogram(npimages):
+    ''' (counts, offset) of an 8/16 bit integer image or volume, counts[v - offset] voxels have value v.
+    Volumes are counted page by page. Returns None for dtypes without a small value range. '''
+    dtype = np.dtype(npimages.dtype)
+    if dtype.kind not in 'ui' or dtype.itemsize > 2:
+        return None
+    offset = int(np.iinfo(dtype).min)
+    counts = np.zeros(1 << (8 * dtype.itemsize), np.int64)
+    pages = [npimages] if npimages.ndim == 2 else (npimages[i] for i in range(npimages.shape[0]))
+    for page in pages:
+        page = np.asarray(page)
+        if offset != 0:
+            page = page.astype(np.int32) - offset
+        counts += np.bincount(page.ravel(), minlength=len(counts))
+    return counts, offset
+
+
+def histogram_percentile(counts, offset, q):
+    ''' same value as np.percentile(data, q) (linear interpolation) computed from the histogram of data '''
+    cumulative = np.cumsum(counts)
+    pos = q / 100.0 * (cumulative[-1] - 1)
+    lo = int(np.floor(pos))
+    v_lo = np.searchsorted(cumulative, lo, side='right')
+    v_hi = np.searchsorted(cumulative, min(lo + 1, cumulative[-1] - 1), side='right')
+    return offset + v_lo + (pos - lo) * (v_hi - v_lo)
+
+
+def contrast_lut(counts, offset, contrast, brightness):
+    ''' apply_contrast followed by apply_brightness for every possible intensity, as one int16 table '''
+    minval = histogram_percentile(counts, offset, contrast)
+    maxval = histogram_percentile(counts, offset, 100-contrast)
+    if maxval <= minval: # flat image
+        return np.zeros(len(counts), np.short)
+    result = np.clip(np.arange(len(counts)) + offset, minval, maxval)
+    result = (((result - minval) / (maxval - minval)) * 1024).astype(np.short)
+    return (result*brightness).astype(np.short)
+
+
+class IntensityLUT():
+    ''' Contrast/brightness filtering through precomputed lookup tables.
+
+    The intensity histogram of the volume is counted once, so changing the contrast only
+    rebuilds a small table and filtering a slice is a single gather. With per_slice=True
+    the percentiles come from each slice's own histogram (as apply_contrast does), counted
+    lazily and cached per (plane, slide), at most max_slice_hists of them. Float volumes
+    fall back to apply_contrast. Safe to use from several threads.
+
+    With background=True the volume histogram is counted on a thread, slices are filtered
+    with apply_contrast until it is ready and on_ready() is called from that thread then.
+    '''
+
+    def __init__(self, npimages, per_slice=False, max_luts=16, max_slice_hists=4096, background=False, on_ready=None):
+        self.per_slice = per_slice
+        self.max_luts = max_luts
+        self.max_slice_hists = max_slice_hists
+        self.hist = None
+        self.on_ready = on_ready
+        self.counter = None
+        if not per_slice and background:
+            self.counter = threading.Thread(target=self._count, args=(npimages,), name='histogram', daemon=True)
+            self.counter.start()
+        elif not per_slice:
+            self.hist = histogram(npimages)
+        self.enabled = np.dtype(npimages.dtype).kind in 'ui' and np.dtype(npimages.dtype).itemsize <= 2
+        self.slice_hists = OrderedDict() # (plane, slide) -> (counts, offset), least recently used first
+        self.luts = OrderedDict() # (slice key or None, contrast, brightness) -> table
+        self._lock = threading.Lock() # prefetch workers filter slices concurrently
+
+    def _count(self, npimages):
+        self.hist = histogram(npimages)
+        if self.on_ready is not None:
+            self.on_ready()
+
+    @property
+    def ready(self): # tables can be used, else slices are filtered with apply_contrast
+        return self.per_slice or self.hist is not None
+
+    def slice_hist(self, npslice, key):
+        with self._lock:
+            if key in self.slice_hists:
+                self.slice_hists.move_to_end(key)
+                return self.slice_hists[key]
+        hist = histogram(npslice) # counted outside the lock, two threads may count the same slice once
+        with self._lock:
+            self.slice_hists[key] = hist
+            while len(self.slice_hists) > self.max_slice_hists:
+                self.slice_hists.popitem(last=False)
+        return hist
+
+    def lut(self, contrast, brightness, key=None, hist=None):
+        ''' table for contrast/brightness, hist (counts, offset) of slice key when per_slice '''
+        lut_key = (key if self.per_slice else None, contrast, brightness)
+        with self._lock:
+            if lut_key in self.luts:
+                self.luts.move_to_end(lut_key)
+                return self.luts[lut_key]
+        counts, offset = hist if self.per_slice else self.hist
+        table = contrast_lut(counts, offset, contrast, brightness)
+        with self._lock:
+            self.luts[lut_key] = table
+            while len(self.luts) > self.max_luts:
+                self.luts.popitem(last=False)
+        return table
+
+    def apply(self, npslice, contrast, brightness, key=None):
+        ''' filtered int16 slice, key (plane, slide) identifies the slice for per-slice histograms '''
+        if not self.enabled or not self.ready:
+            return apply_brightness(apply_contrast(npslice, contrast), brightness)
+        npslice = np.asarray(npslice)
+        hist = self.slice_hist(npslice, key) if self.per_slice else None
+        offset = np.iinfo(npslice.dtype).min
+        index = npslice if offset == 0 else npslice.astype(np.int32) - offset
+        return self.lut(contrast, brightness, key, hist)[index]
+
+
+class SliceCache():
+    ''' thread-safe LRU cache of numpy slices, evicting the least recently used ones above max_bytes '''
+
+    def __init__(self, max_bytes=256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._items:
+                return None
+            self._items.move_to_end(key)
+            return self._items[key]
+
+    def put(self, key, value):
+        with self._lock:
+            if key in self._items:
+                self.nbytes -= self._items.pop(key).nbytes
+            self._items[key] = value
+            self.nbytes += value.nbytes
+            while self.nbytes > self.max_bytes and len(self._items) > 1:
+                self.nbytes -= self._items.popitem(last=False)[1].nbytes
+
+    def get_or_compute(self, key, compute):
+        value = self.get(key)
+        if value is None:
+            value = compute()
+            self.put(key, value)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.nbytes = 0
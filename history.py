@@ -0,0 +1,152 @@
+from collections import deque
+
+import numpy as np
+
+from helpers import plane_slice
+
+DEFAULT_BUDGET = 256 * 1024 * 1024 # bytes of undo/redo deltas kept
+TILE_SIZE = 64 # before-values are captured per tile of a slice, on first touch within an operation
+
+
+class Delta():
+    ''' changed voxels of one tile: bounding box, bit-packed change mask and the before/after values '''
+
+    def __init__(self, plane, cs, r0, c0, before, after):
+        changed = before != after
+        rows = np.nonzero(changed.any(axis=1))[0]
+        cols = np.nonzero(changed.any(axis=0))[0]
+        box = (slice(rows[0], rows[-1] + 1), slice(cols[0], cols[-1] + 1)) # shrink to the changed voxels
+        changed = changed[box]
+
+        self.plane, self.cs = plane, cs
+        self.r0, self.c0 = r0 + int(rows[0]), c0 + int(cols[0])
+        self.shape = changed.shape
+        self.mask = np.packbits(changed)
+        self.before = before[box][changed]
+        self.after = after[box][changed]
+
+    @property
+    def nbytes(self):
+        return self.mask.nbytes + self.before.nbytes + self.after.nbytes
+
+    @property
+    def rect(self): # (r0, r1, c0, c1) on the delta's slice
+        return self.r0, self.r0 + self.shape[0], self.c0, self.c0 + self.shape[1]
+
+    def apply(self, volume, values):
+        changed = np.unpackbits(self.mask, count=self.shape[0] * self.shape[1]).reshape(self.shape).astype(bool)
+        view = plane_slice(volume, self.plane, self.cs)
+        view[self.r0:self.r0+self.shape[0], self.c0:self.c0+self.shape[1]][changed] = values
+
+
+class Entry(list):
+    ''' deltas of one operation, plus whatever the caller attached to it while it was open '''
+
+    def __init__(self, deltas=(), info=None, info_bytes=0):
+        super().__init__(deltas)
+        self.info = info
+        self.info_bytes = info_bytes
+
+    @property
+    def nbytes(self):
+        return sum(d.nbytes for d in self) + self.info_bytes
+
+
+class History():
+    ''' Undo/redo for label volume edits, kept as sparse deltas under a memory budget.
+
+    Edits happen inside operations (begin/end, nestable). The first time an operation
+    touches a tile of a slice, the tile's current values are copied. When the outermost
+    operation ends, every touched tile is compared with its final state and only the
+    changed voxels are kept, so a whole multi-slice prediction is one undo step.
+    '''
+
+    def __init__(self, budget_bytes=DEFAULT_BUDGET, tile_size=TILE_SIZE):
+        self.budget_bytes = budget_bytes
+        self.tile_size = tile_size
+        self.undo_stack = deque() # Entry per operation, oldest on the left
+        self.redo_stack = []
+        self.nbytes = 0
+        self.depth = 0
+        self.pending = {} # (plane, cs, tile row, tile col) -> tile values before the operation
+        self.info = None # (info, bytes) attached to the open operation
+
+    def clear(self):
+        self.undo_stack.clear()
+        self.redo_stack = []
+        self.nbytes = 0
+        self.depth = 0
+        self.pending = {}
+        self.info = None
+
+    def can_undo(self):
+        return len(self.undo_stack) > 0
+
+    def can_redo(self):
+        return len(self.redo_stack) > 0
+
+    def begin(self):
+        self.depth += 1
+
+    def attach(self, info, nbytes=0):
+        ''' attach info to the open operation, undo/redo return it as entry.info. nbytes counts against the budget '''
+        self.info = (info, nbytes)
+
+    def record(self, volume, plane, cs, r0, r1, c0, c1):
+        ''' call before writing rows r0:r1, columns c0:c1 of slide cs on plane '''
+        t = self.tile_size
+        view = plane_slice(volume, plane, cs)
+        for tr in range(r0 // t, (r1 - 1) // t + 1):
+            for tc in range(c0 // t, (c1 - 1) // t + 1):
+                key = (plane, cs, tr, tc)
+                if key not in self.pending:
+                    self.pending[key] = view[tr*t:(tr+1)*t, tc*t:(tc+1)*t].copy()
+
+    def end(self, volume):
+        ''' close an operation, the outermost one turns the recorded tiles into one undo entry '''
+        self.depth = max(self.depth - 1, 0)
+        if self.depth > 0:
+            return
+        info, self.info = self.info or (None, 0), None
+        if len(self.pending) == 0:
+            return
+
+        t = self.tile_size
+        entry = Entry(info=info[0], info_bytes=info[1])
+        for (plane, cs, tr, tc), before in self.pending.items():
+            after = plane_slice(volume, plane, cs)[tr*t:tr*t+before.shape[0], tc*t:tc*t+before.shape[1]]
+            if np.array_equal(before, after):
+                continue
+            entry.append(Delta(plane, cs, tr*t, tc*t, before, after))
+        self.pending = {}
+
+        if len(entry) == 0:
+            return
+        self.nbytes -= sum(e.nbytes for e in self.redo_stack)
+        self.redo_stack = []
+        self._push_undo(entry)
+
+    def undo(self, volume):
+        ''' revert the last operation, returns its deltas so callers can refresh what changed '''
+        if self.depth > 0 or not self.can_undo():
+            return []
+        entry = self.undo_stack.pop()
+        for delta in reversed(entry):
+            delta.apply(volume, delta.before)
+        self.redo_stack.append(entry)
+        return entry
+
+    def redo(self, volume):
+        if self.depth > 0 or not self.can_redo():
+            return []
+        entry = self.redo_stack.pop()
+        for delta in entry:
+            delta.apply(volume, delta.after)
+        self.undo_stack.append(entry)
+        return entry
+
+    def _push_undo(self, entry):
+        self.undo_stack.append(entry)
+        self.nbytes += entry.nbytes
+        while self.nbytes > self.budget_bytes and len(self.undo_stack) > 1: # oldest steps go first, the newest is always kept
+            self.nbytes -= self.undo_stack.popleft().nbytes
@@ -0,0 +1,94 @@
+import numpy as np
+
+from models import DOWNSAMPLING_FACTOR
+
+DEFAULT_TILE_SHAPE = (32, 640) # the xz slide size the unet was trained on
+DEFAULT_OVERLAP = (8, 64)
+DEFAULT_BATCH_SIZE = 8
+
+
+def normalize_batch(imgs): # normalize each (rows, cols) slide of a (n, rows, cols) stack between -1 and 1, flat slides become 0
+    imgs = np.asarray(imgs, np.float32)
+    min = imgs.min(axis=(1, 2), keepdims=True)
+    rng = imgs.max(axis=(1, 2), keepdims=True) - min
+    return np.where(rng > 0, 2.0 * (imgs - min) / np.where(rng > 0, rng, 1) - 1.0, 0.0)
+
+
+def round_up(n, factor):
+    return -(-n // factor) * factor
+
+
+def tile_starts(length, tile, overlap):
+    ''' start offsets of tiles covering 0:length with at least overlap shared pixels, the last one aligned to the end '''
+    if length <= tile:
+        return [0]
+    stride = max(tile - overlap, 1)
+    starts = list(range(0, length - tile, stride))
+    starts.append(length - tile)
+    return starts
+
+
+def blend_window(shape, overlap):
+    ''' per-pixel tile weights ramping up linearly over the overlap, so neighbouring tiles fade into each other '''
+    ramps = []
+    for size, o in zip(shape, overlap):
+        i = np.arange(size, dtype=np.float32)
+        ramps.append(np.minimum(1.0, np.minimum(i + 1, size - i) / (o + 1)))
+    return np.outer(ramps[0], ramps[1])
+
+
+class TiledPredictor():
+    ''' Runs a fully convolutional model on slides of any size.
+
+    Each slide is covered by overlapping tiles whose sides are multiples of the network's
+    downsampling factor. Tiles of all slides are predicted together in batches and the
+    overlaps are blended with a linear ramp. Slides smaller than a tile are zero padded to
+    the full tile and predicted without blending, which reproduces the old single padded
+    prediction (a 32x640 input) for 25x500 slides bit for bit.
+    '''
+
+    def __init__(self, model, tile_shape=DEFAULT_TILE_SHAPE, overlap=DEFAULT_OVERLAP, batch_size=DEFAULT_BATCH_SIZE):
+        self.model = model
+        self.batch_size = batch_size
+        self.overlap = tuple(overlap)
+        fixed = tuple(model.input_shape[1:3]) if hasattr(model, 'input_shape') else (None, None)
+        self.fixed = tuple(f is not None for f in fixed) # axes where the model only accepts one size
+        self.tile_shape = tuple(f if f is not None else round_up(t, DOWNSAMPLING_FACTOR) for f, t in zip(fixed, tile_shape))
+
+    @property
+    def params(self): # everything that changes the output for the same input, e.g. for cache keys
+        return {'tile_shape': list(self.tile_shape), 'overlap': list(self.overlap), 'small_slides': 'full-tile'}
+
+    def predict(self, imgs, progress=None):
+        ''' (n, rows, cols) normalized slides -> (n, rows, cols) float32 model output '''
+        imgs = np.asarray(imgs, np.float32)
+        n, h, w = imgs.shape
+        th, tw = self.tile_shape
+        ph, pw = max(h, th), max(w, tw)
+        if (ph, pw) != (h, w):
+            padded = np.zeros((n, ph, pw), np.float32)
+            padded[:, :h, :w] = imgs
+            imgs = padded
+
+        overlap = (min(self.overlap[0], th // 2), min(self.overlap[1], tw // 2))
+        tiles = [(r, c) for r in tile_starts(ph, th, overlap[0]) for c in tile_starts(pw, tw, overlap[1])]
+        window = blend_window((th, tw), overlap) if len(tiles) > 1 else np.ones((th, tw), np.float32) # one tile is the plain model output
+        out = np.zeros((n, ph, pw), np.float32)
+        weight = np.zeros((ph, pw), np.float32)
+        for r, c in tiles: # weights are the same for every slide
+            weight[r:r+th, c:c+tw] += window
+
+        jobs = [(i, r, c) for i in range(n) for r, c in tiles]
+        batch = np.empty((self.batch_size, th, tw, 1), np.float32)
+        for b in range(0, len(jobs), self.batch_size):
+            chunk = jobs[b:b+self.batch_size]
+            for k, (i, r, c) in enumerate(chunk):
+                batch[k, :, :, 0] = imgs[i, r:r+th, c:c+tw]
+            pred = self.model.predict(batch[:len(chunk)], batch_size=self.batch_size, verbose=0)
+            for k, (i, r, c) in enumerate(chunk):
+                out[i, r:r+th, c:c+tw] += pred[k, :, :, 0] * window
+            if progress is not None:
+                progress(min(b + self.batch_size, len(jobs)), len(jobs))
+
+        out /= weight
+        return out[:, :h, :w]
@@ -0,0 +1,73 @@
+import numpy as np
+
+SLAB_PAGES = 64 # xy pages read at once while downsampling
+MAX_LEVELS = 6
+
+
+def reduce_blocks(arr, factor, reduce):
+    ''' reduce factor^3 blocks of a (z, y, x) array by max or mean, partial blocks at the far edges included '''
+    for axis in range(3):
+        starts = np.arange(0, arr.shape[axis], factor)
+        if reduce == 'max':
+            arr = np.maximum.reduceat(arr, starts, axis=axis)
+        else:
+            sizes = np.minimum(starts + factor, arr.shape[axis]) - starts
+            shape = [1, 1, 1]
+            shape[axis] = len(sizes)
+            arr = np.add.reduceat(arr.astype(np.float32, copy=False), starts, axis=axis) / sizes.reshape(shape)
+    return arr if reduce == 'max' else arr.astype(np.float32)
+
+
+def downsample(volume, factor, reduce='max', region=None):
+    ''' volume (or a region of it, 3 slices aligned to factor) downsampled by factor along every axis, read in slabs of xy pages '''
+    if region is None:
+        region = tuple(slice(0, s) for s in volume.shape[:3])
+    z, y, x = region
+    step = factor * max(SLAB_PAGES // factor, 1)
+    parts = [reduce_blocks(np.asarray(volume[z0:min(z0 + step, z.stop), y, x]), factor, reduce)
+             for z0 in range(z.start, z.stop, step)]
+    return np.concatenate(parts, axis=0)
+
+
+class LODPyramid():
+    ''' Level-of-detail copies of a (z, y, x) volume, level k downsampled by 2^k.
+
+    Levels are built on first use, level 0 is the volume itself. Labels use max so thin
+    annotations survive downsampling, images use mean. update(region) refreshes only the
+    blocks of every built level that cover the region.
+    '''
+
+    def __init__(self, volume, reduce='max', max_levels=MAX_LEVELS):
+        self.volume = volume
+        self.reduce = reduce
+        self.max_levels = max_levels
+        self.levels = {}
+
+    def shape_at(self, k):
+        f = 2 ** k
+        return tuple(-(-s // f) for s in self.volume.shape[:3])
+
+    def level_for(self, max_voxels):
+        ''' finest level with at most max_voxels voxels '''
+        for k in range(self.max_levels):
+            if np.prod(self.shape_at(k)) <= max_voxels:
+                return k
+        return self.max_levels - 1
+
+    def level(self, k):
+        if k == 0:
+            return self.volume
+        if k not in self.levels:
+            self.levels[k] = downsample(self.volume, 2 ** k, self.reduce)
+        return self.levels[k]
+
+    def update(self, region):
+        ''' recompute built levels under region, a (z0, z1, y0, y1, x0, x1) voxel box of level 0 '''
+        for k, arr in self.levels.items():
+            f = 2 ** k
+            lo = [region[2*a] // f for a in range(3)]
+            hi = [min(-(-region[2*a+1] // f), arr.shape[a]) for a in range(3)]
+            if any(h <= l for l, h in zip(lo, hi)):
+                continue
+            src = tuple(slice(l * f, min(h * f, s)) for l, h, s in zip(lo, hi, self.volume.shape))
+            arr[tuple(slice(l, h) for l, h in zip(lo, hi))] = downsample(self.volume, f, self.reduce, src)
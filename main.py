@@ -1,24 +1,24 @@
+import time
+STARTED = time.perf_counter() # startup is measured from here to the first paint of the window
+
 from PySide2.QtUiTools import QUiLoader
-from PySide2.QtCore import QCoreApplication, QEvent, QSize, QMetaObject, Qt, SLOT, Slot
+from PySide2.QtCore import QCoreApplication, QEvent, QObject, QSize, QMetaObject, Qt, QTimer, Signal, SLOT, Slot
 from PySide2.QtGui import QBitmap, QColor, QCursor, QIcon, QImage, QKeySequence, QPainter, QPalette, QPixmap, QResizeEvent
-from PySide2.QtWidgets import QApplication, QCheckBox, QComboBox, QDateEdit, QDateTimeEdit, QDial, QDockWidget, QDoubleSpinBox, QFileDialog, QFontComboBox, QGraphicsGridLayout, QGraphicsOpacityEffect, QHBoxLayout, QInputDialog, QLCDNumber, QLabel, QLineEdit, QMainWindow, QMenu, QProgressBar, QPushButton, QRadioButton, QScrollArea, QSizePolicy, QSlider, QSpinBox, QStatusBar, QTimeEdit, QToolBar, QGridLayout, QVBoxLayout, QWidget, QAction, QShortcut
-
-
-from traits.api import HasTraits, Instance, on_trait_change, Range
-from traitsui.api import View, Item
-from mayavi.core.ui.api import MayaviScene, MlabSceneModel, SceneEditor
-from mayavi import mlab
+from PySide2.QtWidgets import QApplication, QCheckBox, QComboBox, QDateEdit, QDateTimeEdit, QDial, QDockWidget, QDoubleSpinBox, QFileDialog, QFontComboBox, QGraphicsGridLayout, QGraphicsOpacityEffect, QHBoxLayout, QInputDialog, QLCDNumber, QLabel, QLineEdit, QMainWindow, QMenu, QMessageBox, QProgressBar, QPushButton, QRadioButton, QScrollArea, QSizePolicy, QSlider, QSpinBox, QStatusBar, QTimeEdit, QToolBar, QGridLayout, QWidget, QAction, QShortcut
 
 
 import numpy as np
 import os
-from PIL import Image, ImageQt
+from functools import lru_cache
 from AnnotationSpace3D import AnnotationSpace3D
 import random
 import sys
-import matplotlib.pyplot as plt
-from helpers import read_tiff, apply_contrast, apply_brightness, disk
-import asyncio
+import threading
+from helpers import open_tiff, IntensityLUT, SliceCache, disk
+from prefetch import Prefetcher
+from predict_jobs import PredictionScheduler
+from autosave import Autosaver, newest_restore_point, session_dir
+IMPORTED = time.perf_counter() # heavy modules (tensorflow, mayavi) are imported on first use, not above
 
 
 COLORS = {
@@ -42,6 +42,13 @@ global_contrast = 1
 global_brightness = 15
 global_annot_opacity = 0.8
 global_zoom = 0.0
+STROKE_TICK_MS = 16 # buffered mouse moves are committed to the annotation once per paint tick
+SLICE_CACHE_BYTES = 256 * 1024 * 1024 # memory cap for filtered background slices kept for paging back and forth
+PREFETCH_AHEAD = 4 # slides prepared in advance in the direction of navigation
+PREFETCH_WORKERS = 2
+RENDER_REFRESH_MS = 500 # changed chunks are pushed to the render view this often
+AUTOSAVE_MS = 60 * 1000
+PREDICTION_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'annot3d', 'predictions') # model outputs reused across sessions
 
 def get_filled_pixmap(pixmap_file):
     pixmap = QPixmap(pixmap_file)
@@ -52,6 +59,11 @@ def get_filled_pixmap(pixmap_file):
 
 
 def get_circle_cursor(brush_size, color_rgba):
+    return circle_cursor(brush_size, tuple(color_rgba))
+
+
+@lru_cache(maxsize=64)
+def circle_cursor(brush_size, color_rgba): # cached per size and color, slider moves reuse built cursors
     x, y = (brush_size*2+1, brush_size*2+1)
     circle_img = np.zeros((x, y, 4))
     rr, cc = disk(center=(x//2, y//2), radius=brush_size, shape=(x, y))
@@ -62,43 +74,23 @@ def get_circle_cursor(brush_size, color_rgba):
 
 
 
-class Visualization(HasTraits):
-    scene = Instance(MlabSceneModel, ())
-
-    @on_trait_change('scene.activated')
-    def update_plot(self):
-        global annot3D
-        npimages = annot3D.get_npimages()
-        npspace = annot3D.get_npspace()
-        self.npspace_sf = mlab.pipeline.scalar_field(npspace) # scalar field to update later
-        bg_original = mlab.pipeline.volume(mlab.pipeline.scalar_field(npimages))
-        segmask = mlab.pipeline.iso_surface(self.npspace_sf, color=(1.0, 0.0, 0.0))
-        # self.scene.scene.disable_render = False
-
-
-    def update_annot(self): # update the scalar field and visualization auto updates
-        npspace = annot3D.get_npspace()
-        self.npspace_sf.mlab_source.trait_set(scalars=npspace) 
-
-
-    view = View(Item('scene', editor=SceneEditor(scene_class=MayaviScene), height=250, width=300, show_label=False), resizable=True )
+class PredictionSignals(QObject):
+    ''' carries results from the prediction worker thread over to the GUI thread '''
+    ready = Signal(int, str, int, object) # job id, plane, first slide, model output
+    progress = Signal(int, str, int, int) # job id, plane, slides done, slides total
+    finished = Signal(int, str) # job id, plane
 
 
+class MergeSignals(QObject):
+    ''' progress of annotation files merged on a background thread '''
+    progress = Signal(int, int) # chunks done, chunks total
+    finished = Signal(object) # merged label volume, None if the merge failed
 
-class MayaviQWidget(QWidget):
-    def __init__(self, parent=None):
-        QWidget.__init__(self, parent)
-        layout = QVBoxLayout(self)
-        layout.setContentsMargins(0,0,0,0)
-        layout.setSpacing(0)
-        self.visualization = Visualization()
 
-        self.ui = self.visualization.edit_traits(parent=self, kind='subpanel').control
-        layout.addWidget(self.ui)
-        self.ui.setParent(self)
-    
-    def update_annot(self):
-        self.visualization.update_annot()
+class ExportSignals(QObject):
+    ''' progress of a dataset export running on a background thread '''
+    progress = Signal(int, int) # slides done, slides total
+    finished = Signal(str, int) # path, slides written
 
 
 
@@ -147,6 +139,39 @@ class Label(QLabel):
             self.setContentsMargins(0, m, 0, m)
 
 
+class Overlay(QWidget):
+    ''' annotation layer kept as one persistent pixmap, edits re-upload and repaint only their dirty rectangle '''
+
+    def __init__(self, width, height):
+        super().__init__()
+        self.setFixedSize(width, height)
+        self.setAttribute(Qt.WA_TransparentForMouseEvents) # strokes are handled by the Canvas
+        self.overlay = QPixmap(width, height)
+        self.overlay.fill(Qt.transparent)
+
+
+    def set_image(self, image): # replace the whole overlay
+        self.update_rect(image, 0, 0)
+
+
+    def update_rect(self, image, r0, c0): # rgba (h, w, 4) image placed with its top left corner at row r0, column c0
+        image = np.require(image, np.uint8, 'C')
+        h, w = image.shape[:2]
+        qimg = QImage(image.data, w, h, 4 * w, QImage.Format_RGBA8888)
+        painter = QPainter(self.overlay)
+        painter.setCompositionMode(QPainter.CompositionMode_Source) # replace pixels, erased areas become transparent
+        painter.drawImage(c0, r0, qimg)
+        painter.end()
+        self.update(c0, r0, w, h)
+
+
+    def paintEvent(self, e):
+        painter = QPainter(self)
+        painter.drawPixmap(e.rect(), self.overlay, e.rect())
+        painter.end()
+
+
+
 class Canvas(QWidget):
 
     def __init__(self, image, plane):
@@ -163,7 +188,7 @@ class Canvas(QWidget):
         # self.bg.setMinimumSize(QSize(0,0))
         # self.bg.setMaximumSize(QSize(16777215, 16777215))
 
-        self.annot = QLabel()
+        self.annot = Overlay(self.dy, self.dx)
         # self.annot.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Expanding)
         # self.annot.setScaledContents(True)
         # self.annot.setMinimumSize(QSize(0,0))
@@ -175,11 +200,6 @@ class Canvas(QWidget):
         qimg = QImage(image.data, self.dy, self.dx, 2 * self.dy , QImage.Format_Grayscale16)
         self.bg.setPixmap(QPixmap(qimg))
 
-        image = np.zeros((self.dx, self.dy, 4))
-        image = np.require(image, np.uint8, 'C') 
-        qimg = QImage(image.data, self.dy, self.dx, 4 * self.dy , QImage.Format_RGBA8888)
-        self.annot.setPixmap(QPixmap(qimg))
-
         self.opacity_effect = QGraphicsOpacityEffect() 
         self.opacity_effect.setOpacity(0.5) 
         self.annot.setGraphicsEffect(self.opacity_effect)
@@ -189,10 +209,24 @@ class Canvas(QWidget):
 
         self.l.addWidget(self.bg, 0, 0, Qt.AlignLeft | Qt.AlignTop)
         self.l.addWidget(self.annot, 0, 0, Qt.AlignLeft | Qt.AlignTop)
+
+        self.progress = QProgressBar() # prediction progress of this plane
+        self.progress.setMaximumHeight(6)
+        self.progress.setTextVisible(False)
+        self.progress.hide()
+        self.l.addWidget(self.progress, 1, 0)
         
         self.setLayout(self.l)
 
         self.pen_color_rgba = INIT_COLOR_RGBA
+
+        self.pending_points = [] # mouse positions buffered since the last paint tick
+        self.last_point = None # end of the stroke committed so far, next segment starts here
+        self.stroking = False # between press and release
+        self.stroke_timer = QTimer(self)
+        self.stroke_timer.setSingleShot(True)
+        self.stroke_timer.setInterval(STROKE_TICK_MS)
+        self.stroke_timer.timeout.connect(self.flush_stroke)
         
         self.update_cursor()
 
@@ -204,6 +238,15 @@ class Canvas(QWidget):
             self.setCursor(get_circle_cursor(brush_size, self.pen_color_rgba))
 
 
+    def set_progress(self, done, total):
+        if done >= total:
+            self.progress.hide()
+            return
+        self.progress.setMaximum(total)
+        self.progress.setValue(done)
+        self.progress.show()
+
+
     def update_annot_opacity(self):
         self.opacity_effect.setOpacity(global_annot_opacity) 
 
@@ -214,23 +257,51 @@ class Canvas(QWidget):
 
 
     def mouseMoveEvent(self, e):   
-        global current_slide, annot3D    
-        x = e.x()-10
-        y = e.y()-10
-        
+        self.pending_points.append((e.x()-10, e.y()-10))
+        if not self.stroke_timer.isActive():
+            self.stroke_timer.start()
+
+
+    def mousePressEvent(self, e):
+        if self.stroking: # release of the previous stroke was never seen
+            self.mouseReleaseEvent(e)
+        while annot3D.operation_open(): # a release lost on another canvas would block undo for good
+            annot3D.end_operation()
+        annot3D.begin_operation() # the whole line stroke is one undo step
+        self.stroking = True
+        self.last_point = None
+        self.pending_points = [(e.x()-10, e.y()-10)]
+        self.stroke_timer.start()
+
+
+    def mouseReleaseEvent(self, e):
+        if not self.stroking: # a stray release must not close someone else's operation
+            return
+        self.stroking = False
+        self.stroke_timer.stop()
+        self.flush_stroke()
+        self.last_point = None
+        annot3D.end_operation()
+
+
+    def flush_stroke(self):
+        ''' commit all buffered mouse positions as one stroke segment chain '''
+        global current_slide, annot3D
+        if len(self.pending_points) == 0:
+            return
+
+        points = self.pending_points if self.last_point is None else [self.last_point] + self.pending_points
+        self.last_point = self.pending_points[-1]
+        self.pending_points = []
         d = current_slide[self.p]
 
         if (eraser_on): 
-            annot3D.draw(self.p, d, x, y, eraser_size, 0, [0,0,0,0])
+            rect = annot3D.draw_stroke(self.p, d, points, eraser_size, 0, [0,0,0,0])
         else:
-            annot3D.draw(self.p, d, x, y, brush_size, 1, self.pen_color_rgba)
-
-        self.change_annot(annot3D.get_slice(self.p, d))
-        self.annot.update()
-
+            rect = annot3D.draw_stroke(self.p, d, points, brush_size, 1, self.pen_color_rgba)
 
-    def mousePressEvent(self, e):
-        annot3D.save_history(self.p, current_slide[self.p]) # save history after every line stroke
+        if rect is not None:
+            self.change_annot(annot3D.get_slice(self.p, d, rect), rect)
         
 
     def change_bg(self, image):
@@ -244,23 +315,22 @@ class Canvas(QWidget):
         self.bg.update()
 
 
-    def change_annot(self, image):
-        annot = np.require(image, np.uint8, 'C') 
-        qimg = QImage(annot.data, self.dy, self.dx, 4 * self.dy , QImage.Format_RGBA8888)
-        qpixmap = QPixmap(qimg)
+    def change_annot(self, image, rect=None): # rect (r0, r1, c0, c1) when image only covers that part of the slice
         # self.annot.resize((1+global_zoom)*self.annot.pixmap().size())
-        self.annot.setPixmap(qpixmap)
-        self.annot.update()
+        if rect is None:
+            self.annot.set_image(image)
+        else:
+            self.annot.update_rect(image, rect[0], rect[2])
 
 
 
 
 
 class MainWindow(QMainWindow):
+    histogram_ready = Signal() # volume histogram counted, backgrounds can switch to table filtering
     c = {'xy': 0, 'xz': 0, 'yz': 0}
     
     dims = (500, 500, 25) # w, h, d
-    slides={}
     plane_depth = {}
     slide_annotations = {}
     num_slides = 0
@@ -270,14 +340,18 @@ class MainWindow(QMainWindow):
     def load_source_file(self, filename):
         global COLORS, p, current_slide, annot3D
 
-        self.slides['xy'], self.slides['xz'], self.slides['yz'] = read_tiff(filename)
-        self.npimages = self.slides['xy']
+        self.source_file = filename
+        self.npimages = open_tiff(filename) # lazy volume, slices are read on demand
+        self.intensity = IntensityLUT(self.npimages, background=True, on_ready=self.histogram_ready.emit) # volume histogram counted once in the background, filters then become table lookups
+        self.bg_cache = SliceCache(SLICE_CACHE_BYTES) # (plane, slide, contrast, brightness) -> filtered slice
+        self.shown_bg = {'xy': None, 'xz': None, 'yz': None} # cache key currently displayed per plane
+        self.annot_cache = SliceCache(SLICE_CACHE_BYTES // 2) # (plane, slide, annotation revision) -> rgba overlay
+        self.prefetcher = Prefetcher(PREFETCH_AHEAD, PREFETCH_WORKERS)
         
-        w = self.npimages[0].shape[0]
-        h = self.npimages[0].shape[1]
-        d = self.npimages.shape[0]
+        d, w, h = self.npimages.shape
 
         annot3D = AnnotationSpace3D(self.npimages, (d, w, h), INIT_COLOR_RGBA)
+        annot3D.set_prediction_cache_dir(PREDICTION_CACHE_DIR)
 
         self.plane_depth = {
             'xy': d,
@@ -298,6 +372,7 @@ class MainWindow(QMainWindow):
 
     def __init__(self):
         super().__init__()
+        self.histogram_ready.connect(self.change_gfilter)
         
     # INIT ANNOT LOAD UP
         self.load_source_file('data/src.tiff')
@@ -307,8 +382,26 @@ class MainWindow(QMainWindow):
             print("Set server URL to", sys.argv[1])
             annot3D.set_server_url(sys.argv[1])
 
+    # PREDICTIONS RUN ON A WORKER THREAD, RESULTS ARE APPLIED HERE ON THE GUI THREAD
+        self.prediction_signals = PredictionSignals()
+        self.prediction_signals.ready.connect(self.on_prediction_ready)
+        self.prediction_signals.progress.connect(self.on_prediction_progress)
+        self.prediction_signals.finished.connect(self.on_prediction_finished)
+        self.predictions = PredictionScheduler(
+            lambda plane, start, stop: annot3D.predict_probabilities(plane, start, stop),
+            on_ready=lambda job, plane, start, output: self.prediction_signals.ready.emit(job.id, plane, start, output),
+            on_progress=lambda job: self.prediction_signals.progress.emit(job.id, job.plane, job.done, len(job.indices)),
+            on_finished=lambda job: self.prediction_signals.finished.emit(job.id, job.plane),
+        )
+        self.job_sources = {} # job id -> AnnotationSpace3D it was submitted for
+        self.ready_predictions = [] # (plane, start, output) waiting for the current stroke to end
+        self.prediction_retry = QTimer(self)
+        self.prediction_retry.setSingleShot(True)
+        self.prediction_retry.setInterval(STROKE_TICK_MS)
+        self.prediction_retry.timeout.connect(self.apply_ready_predictions)
+
         for p in ['xy', 'xz', 'yz']:
-            self.c[p] = Canvas(image=self.slides[p][0], plane=p)
+            self.c[p] = Canvas(image=annot3D.get_src_slice(p, 0), plane=p)
             
         self.change_gfilter()
 
@@ -368,14 +461,28 @@ class MainWindow(QMainWindow):
     # SLIDERS
         self.setup_sliders()
 
-    # MAYAVI RENDER VIEW
+    # MAYAVI RENDER VIEW, BUILT WHEN FIRST SHOWN (VIEW MENU OR R), MAYAVI TAKES SECONDS TO IMPORT
         self.rdock = QDockWidget("Render View", self) # render dock
-        self.rdock.setFeatures(self.rdock.features() & ~QDockWidget.DockWidgetClosable) # unclosable
         self.rdock.setAllowedAreas(Qt.LeftDockWidgetArea | Qt.RightDockWidgetArea)
-        container = QWidget(self.rdock)
-        self.mayavi_widget = MayaviQWidget(container)
-        self.rdock.setWidget(self.mayavi_widget)
+        loading = QLabel("Loading render view...")
+        loading.setAlignment(Qt.AlignCenter)
+        self.rdock.setWidget(loading)
         self.addDockWidget(Qt.RightDockWidgetArea, self.rdock)
+        self.rdock.hide()
+        self.rdock.visibilityChanged.connect(self.on_render_dock_visible)
+        self.menuBar().addMenu('&View').addAction(self.rdock.toggleViewAction())
+        self.mayavi_widget = None
+        self.render_timer = QTimer(self) # edits reach the render view chunk by chunk without pressing R, started once built
+        self.render_timer.timeout.connect(self.render)
+        self.first_paint = None
+
+    # AUTOSAVE, RESTORE POINTS ARE COPIED HERE AND WRITTEN ON A BACKGROUND THREAD
+        autosave_dir = session_dir(self.source_file, self.npimages.shape)
+        self.offer_recovery(autosave_dir)
+        self.autosaver = Autosaver(annot3D, autosave_dir, self.source_file)
+        self.autosave_timer = QTimer(self)
+        self.autosave_timer.timeout.connect(self.autosaver.snapshot)
+        self.autosave_timer.start(AUTOSAVE_MS)
     
     # GENERAL WINDOW PROPS
         self.setWindowTitle("Annotation Toolbox 3D")
@@ -384,6 +491,18 @@ class MainWindow(QMainWindow):
 
     def setup_bar_actions(self):
         self.statusBar()
+        self.export_progress = QProgressBar()
+        self.export_progress.setMaximumWidth(200)
+        self.export_progress.hide()
+        self.statusBar().addPermanentWidget(self.export_progress)
+        self.export_thread = None
+        self.export_signals = ExportSignals()
+        self.export_signals.progress.connect(self.on_export_progress)
+        self.export_signals.finished.connect(self.on_export_finished)
+        self.merge_thread = None
+        self.merge_signals = MergeSignals()
+        self.merge_signals.progress.connect(self.on_merge_progress)
+        self.merge_signals.finished.connect(self.on_merge_finished)
         
         exitAction = QAction(QIcon(get_filled_pixmap('graphics/delete.png')), 'Exit', self)
         exitAction.setShortcut(QKeySequence.Quit) # Ctrl+Q
@@ -415,6 +534,15 @@ class MainWindow(QMainWindow):
         exportAction.setStatusTip('Export source and annotations as dataset directory')
         exportAction.triggered.connect(self.export_dialog)
 
+        exportShardsAction = QAction(QIcon(get_filled_pixmap('graphics/render.png')), 'Export training shards', self)
+        exportShardsAction.setShortcut('Ctrl+Shift+E')
+        exportShardsAction.setStatusTip('Export annotated slides as large shards for fast training')
+        exportShardsAction.triggered.connect(self.export_shards_dialog)
+
+        exportMeshAction = QAction(QIcon(get_filled_pixmap('graphics/render.png')), 'Export surface mesh', self)
+        exportMeshAction.setStatusTip('Export the annotation surface as OBJ or PLY')
+        exportMeshAction.triggered.connect(self.export_mesh_dialog)
+
         selectEraserAction = QAction(QIcon(get_filled_pixmap('graphics/eraser.png')), 'Toggle Eraser', self)
         selectEraserAction.setShortcut('E')
         selectEraserAction.setStatusTip('Toggle eraser')
@@ -461,6 +589,11 @@ class MainWindow(QMainWindow):
         undoAction.setStatusTip('Undo last annotation')
         undoAction.triggered.connect(self.undo)
 
+        redoAction = QAction('Redo', self)
+        redoAction.setShortcut(QKeySequence.Redo)
+        redoAction.setStatusTip('Redo last undone annotation')
+        redoAction.triggered.connect(self.redo)
+
         renderAction = QAction('Render', self)
         renderAction.setShortcut('R')
         renderAction.setStatusTip('Update annotation render')
@@ -476,12 +609,25 @@ class MainWindow(QMainWindow):
         predict5Action.setStatusTip('Predict for current 5 slides')
         predict5Action.triggered.connect(lambda: self.predict_slide(num_slides=5))
 
+        cancelPredictAction = QAction('Cancel Predictions', self)
+        cancelPredictAction.setShortcut('Escape')
+        cancelPredictAction.setStatusTip('Cancel queued predictions')
+        cancelPredictAction.triggered.connect(self.cancel_predictions)
+
+        predictAllAction = QAction('Predict Plane', self)
+        predictAllAction.setShortcut('Ctrl+Shift+P')
+        predictAllAction.setStatusTip('Predict for all slides of the current plane from the current slide on')
+        predictAllAction.triggered.connect(lambda: self.predict_slide(num_slides=self.plane_depth[p]))
+
         self.addAction(slideLeftAction)
         self.addAction(slideRightAction)
         self.addAction(undoAction)
+        self.addAction(redoAction)
         self.addAction(renderAction)
         self.addAction(predictAction)
         self.addAction(predict5Action)
+        self.addAction(predictAllAction)
+        self.addAction(cancelPredictAction)
         
     
     # adding menubar actions 
@@ -492,6 +638,8 @@ class MainWindow(QMainWindow):
         fileMenu.addAction(mergeAnnotAction)
         fileMenu.addAction(loadWeightsAction)
         fileMenu.addAction(exportAction)
+        fileMenu.addAction(exportShardsAction)
+        fileMenu.addAction(exportMeshAction)
         fileMenu.addAction(exitAction)
 
     # adding toolbar actions
@@ -533,6 +681,13 @@ class MainWindow(QMainWindow):
         self.annot_opacity_slider.setMaximum(10)
         self.annot_opacity_slider.valueChanged.connect(self.change_annot_opacity)
 
+        self.threshold_slider = QSlider(Qt.Horizontal)
+        self.threshold_slider.setMinimum(1)
+        self.threshold_slider.setMaximum(99)
+        self.threshold_slider.setValue(int(round(annot3D.threshold*100))) # percent
+        self.threshold_slider.setTracking(False) # re-binarize once the slider is released, not on every step
+        self.threshold_slider.valueChanged.connect(self.change_threshold)
+
         self.zoom_slider = QSlider(Qt.Horizontal)
         self.zoom_slider.setValue(int(global_zoom*10))
         self.zoom_slider.setSingleStep(2) # 0.1 * scaled later
@@ -553,6 +708,8 @@ class MainWindow(QMainWindow):
         self.toolbar.addWidget(self.eraser_size_slider)
         self.toolbar.addWidget(QLabel('Annotation Opacity'))
         self.toolbar.addWidget(self.annot_opacity_slider)
+        self.toolbar.addWidget(QLabel('Prediction Threshold'))
+        self.toolbar.addWidget(self.threshold_slider)
         # self.toolbar.addWidget(QLabel('Zoom'))
         # self.toolbar.addWidget(self.zoom_slider)
 
@@ -570,8 +727,46 @@ class MainWindow(QMainWindow):
         fnames_list, _ = QFileDialog.getOpenFileNames(self, 'Select multiple annotation files to merge and load', '.')
 
         global annot3D, current_slide
-        if len(fnames_list) > 0:
-            annot3D.mergeload(fnames_list)
+        if len(fnames_list) == 0:
+            return
+        mode, ok = QInputDialog.getItem(self, 'Merge mode', 'Keep a voxel label when', ['union', 'majority', 'intersection', 'k-of-n'], 0, False)
+        if not ok:
+            return
+        k = None
+        if mode == 'k-of-n':
+            k, ok = QInputDialog.getInt(self, 'Merge votes', 'Annotators that must agree', (len(fnames_list) + 1) // 2, 1, len(fnames_list))
+            if not ok:
+                return
+        if self.merge_thread is not None and self.merge_thread.is_alive():
+            self.statusBar().showMessage('A merge is still running')
+            return
+        merging = annot3D
+        signals = self.merge_signals
+        def run(): # the GUI keeps painting progress, the merged labels are swapped in on the GUI thread
+            try:
+                labels = merging.merge_files(fnames_list, mode, k, progress=signals.progress.emit)
+            except Exception as e:
+                print("Merge failed:", e)
+                labels = None
+            signals.finished.emit(labels)
+        self.statusBar().showMessage('Merging ' + str(len(fnames_list)) + ' annotation files')
+        self.merge_thread = threading.Thread(target=run, name='merge', daemon=True)
+        self.merge_thread.start()
+
+
+    def on_merge_progress(self, done, total):
+        self.statusBar().showMessage('Merged ' + str(done) + '/' + str(total) + ' chunks')
+
+
+    def on_merge_finished(self, labels):
+        global annot3D, current_slide
+        if labels is None:
+            self.statusBar().showMessage('Merge failed')
+            return
+        annot3D.set_merged(labels) # edits made while merging are replaced, as with loading
+        for p in ['xy', 'xz', 'yz']:
+            self.c[p].change_annot(annot3D.get_slice(p, current_slide[p]))
+        self.statusBar().showMessage('Merged annotations loaded')
 
 
     def load_weights_dialog(self):
@@ -591,9 +786,70 @@ class MainWindow(QMainWindow):
     def export_dialog(self):
         fname, _ = QFileDialog.getSaveFileName(self, 'Export dataset directory (src and annot)', '.') # here fname is folder/dir name
         global annot3D
-        print(fname)
-        if fname:
-            annot3D.export(fname, 'xz')
+        if not fname:
+            return
+        choice, ok = QInputDialog.getItem(self, 'Export planes', 'Planes to export', ['xz', 'xy', 'yz', 'xy, xz, yz'], 0, False)
+        if not ok:
+            return
+        planes = tuple(choice.split(', '))
+        # pool workers read the shared volumes, the thread only waits and reports. Existing files are skipped, so a rerun resumes
+        self.run_export(fname, lambda progress: annot3D.export(fname, planes, progress=progress))
+
+
+    def export_shards_dialog(self):
+        fname, _ = QFileDialog.getSaveFileName(self, 'Export training shards directory', '.')
+        global annot3D
+        if not fname:
+            return
+        choice, ok = QInputDialog.getItem(self, 'Export planes', 'Planes to export', ['xz', 'xy', 'yz', 'xy, xz, yz'], 0, False)
+        if not ok:
+            return
+        patch, ok = QInputDialog.getInt(self, 'Patch size', 'Patch size in pixels (0 for whole slides)', 0, 0, 4096)
+        if not ok:
+            return
+        planes = tuple(choice.split(', '))
+        patch = (patch, patch) if patch > 0 else None
+        self.run_export(fname, lambda progress: annot3D.export_shards(fname, planes, patch=patch, progress=progress))
+
+
+    def export_mesh_dialog(self):
+        fname, _ = QFileDialog.getSaveFileName(self, 'Export surface mesh', '.', 'Meshes (*.obj *.ply)')
+        global annot3D
+        if not fname:
+            return
+        if os.path.splitext(fname)[1].lower() not in ('.obj', '.ply'):
+            fname += '.obj'
+        self.run_export(fname, lambda progress: annot3D.export_mesh(fname, progress=progress)) # cached chunk meshes are reused
+
+
+    def run_export(self, path, export):
+        ''' run export(progress) on a background thread, one export at a time '''
+        if self.export_thread is not None and self.export_thread.is_alive():
+            self.statusBar().showMessage('An export is still running')
+            return
+        signals = self.export_signals
+        def run():
+            try:
+                written = export(signals.progress.emit)
+            except Exception as e:
+                print("Export failed:", e)
+                written = 0
+            signals.finished.emit(path, written)
+        self.export_progress.setValue(0)
+        self.export_progress.show()
+        self.export_thread = threading.Thread(target=run, name='export', daemon=True)
+        self.export_thread.start()
+
+
+    def on_export_progress(self, done, total):
+        self.export_progress.setMaximum(total)
+        self.export_progress.setValue(done)
+        self.statusBar().showMessage('Exported ' + str(done) + '/' + str(total) + ' slides')
+
+
+    def on_export_finished(self, path, written):
+        self.export_progress.hide()
+        self.statusBar().showMessage('Exported ' + str(written) + ' items to ' + path)
 
     def goto_slide(self):
         global p, annot3D
@@ -607,10 +863,11 @@ class MainWindow(QMainWindow):
             current_slide[p] = cs
             self.slide_label.setText(p + ': ' + str(cs+1))
 
-            self.c[p].change_bg(self.slides[p][cs])
-            self.c[p].change_annot(annot3D.get_slice(p, cs))
+            self.prefetcher.cancel() # queued slides around the old position are stale now
+            self.c[p].change_annot(self.overlay_slice(p, cs))
 
-            self.change_gfilter()
+            self.change_gfilter([p])
+            self.prefetch(p, cs, 0)
 
 
     def update_canvas_cursors(self):
@@ -653,6 +910,14 @@ class MainWindow(QMainWindow):
         self.c['yz'].update_annot_opacity()
 
 
+    def change_threshold(self):
+        global annot3D, current_slide
+        annot3D.set_threshold(self.threshold_slider.value() * 0.01) # kept probabilities only, the model is not run
+        self.statusBar().showMessage('Prediction threshold ' + str(self.threshold_slider.value()) + '%')
+        for p in ['xy', 'xz', 'yz']:
+            self.c[p].change_annot(annot3D.get_slice(p, current_slide[p]))
+
+
     def change_brightness(self):
         global global_brightness
         global_brightness = self.brightness_slider.value()
@@ -683,7 +948,35 @@ class MainWindow(QMainWindow):
         
 
 
+    def on_render_dock_visible(self, visible):
+        if visible and self.mayavi_widget is None:
+            QTimer.singleShot(0, self.build_render_view) # let the dock paint its loading label first
+        elif visible:
+            self.render_timer.start(RENDER_REFRESH_MS)
+            self.render() # catch up on edits made while hidden
+        else:
+            self.render_timer.stop() # edits pile up as dirty chunks until the view is shown again
+
+
+    def build_render_view(self):
+        if self.mayavi_widget is not None:
+            return
+        started = time.perf_counter()
+        from render_view import MayaviQWidget
+        self.mayavi_widget = MayaviQWidget(lambda: annot3D, self.rdock)
+        self.rdock.setWidget(self.mayavi_widget)
+        self.render_timer.start(RENDER_REFRESH_MS)
+        print("Render view built in %.2fs" % (time.perf_counter() - started))
+
+
     def render(self):
+        if self.mayavi_widget is None: # R before the render view was ever shown
+            self.rdock.show()
+            self.build_render_view()
+            return
+        if not self.rdock.isVisible(): # closed since, showing it pushes the pending edits
+            self.rdock.show()
+            return
         self.mayavi_widget.update_annot()
 
     
@@ -709,12 +1002,46 @@ class MainWindow(QMainWindow):
             if num_slides is None: # not specified
                 num_slides = 1
 
-            for i in range(num_slides):
-                if current_slide[p]+i >= self.dims[0]: # does not exceed slide range
-                    break
+            cs = current_slide[p]
+            job = self.predictions.submit(p, cs, min(cs+num_slides, self.plane_depth[p])) # slides being predicted are skipped, queued ones move to this job
+            if job is not None:
+                self.job_sources[job.id] = annot3D
+                self.statusBar().showMessage('Predicting ' + str(len(job.indices)) + ' slides on ' + p)
+
+
+    def on_prediction_ready(self, job_id, plane, start, output):
+        global annot3D
+        if self.job_sources.get(job_id) is not annot3D: # submitted before another source was loaded
+            return
+        self.ready_predictions.append((plane, start, output))
+        self.apply_ready_predictions()
+
+
+    def apply_ready_predictions(self):
+        global annot3D, current_slide
+        if annot3D.operation_open(): # mid-stroke, the prediction would become part of the stroke's undo step
+            self.prediction_retry.start()
+            return
+        for plane, start, output in self.ready_predictions:
+            annot3D.apply_prediction(plane, start, output) # batched, one undo step per run of slides
+        self.ready_predictions = []
+        for p in ['xy', 'xz', 'yz']: # predicted slides cross the current slides of the other planes too
+            self.c[p].change_annot(annot3D.get_slice(p, current_slide[p]))
+
 
-                annot3D.model_predict(p, current_slide[p]+i)
-                self.c[p].change_annot(annot3D.get_slice(p, current_slide[p]+i))
+    def on_prediction_progress(self, job_id, plane, done, total):
+        self.c[plane].set_progress(done, total)
+        self.statusBar().showMessage('Predicted ' + str(done) + '/' + str(total) + ' slides on ' + plane)
+
+
+    def on_prediction_finished(self, job_id, plane):
+        self.job_sources.pop(job_id, None)
+        self.c[plane].set_progress(1, 1)
+
+
+    def cancel_predictions(self):
+        self.predictions.cancel_all()
+        self.statusBar().showMessage('Predictions cancelled')
 
 
     def slide_left(self):
@@ -730,38 +1057,56 @@ class MainWindow(QMainWindow):
 
 
     def change_slide(self, step):
-        global current_slide, p, annot3D, slides
+        global current_slide, p, annot3D
         
         current_slide[p] += step
         cs = current_slide[p]
 
         self.slide_label.setText(p + ': ' + str(cs+1))
 
-        self.c[p].change_bg(self.slides[p][cs])
-        self.c[p].change_annot(annot3D.get_slice(p, cs))
+        self.c[p].change_annot(self.overlay_slice(p, cs))
+
+        self.change_gfilter([p])
+        self.prefetch(p, cs, step)
+
+
+    def overlay_slice(self, p, cs):
+        ''' rgba annotation overlay of a slide, reused while the annotations are unchanged '''
+        global annot3D
+        revision = annot3D.revision
+        return self.annot_cache.get_or_compute((p, cs, revision), lambda: annot3D.get_slice(p, cs))
 
-        self.change_gfilter()
 
+    def prefetch(self, p, cs, step):
+        ''' prepare filtered backgrounds and overlays of the slides likely to be shown next, off the GUI thread '''
+        tasks = []
+        for i in self.prefetcher.targets(p, cs, step, self.plane_depth[p]):
+            tasks.append((self.filtered_slice, (p, i)))
+            tasks.append((self.overlay_slice, (p, i)))
+        self.prefetcher.schedule(tasks)
 
-    def change_gfilter(self):
-        global slides, current_slide, npimages, global_contrast, global_brightness
 
-        for p in ['xy','xz','yz']:
+    def filtered_slice(self, p, cs):
+        ''' background slice with the current contrast and brightness, from the LRU cache when seen before '''
+        global annot3D, global_contrast, global_brightness
+        contrast, brightness = global_contrast, global_brightness
+        return self.bg_cache.get_or_compute(
+            (p, cs, contrast, brightness, self.intensity.ready), # slices filtered before the histogram was ready are redone
+            lambda: self.intensity.apply(annot3D.get_src_slice(p, cs), contrast, brightness, key=(p, cs))
+        )
+
+
+    def change_gfilter(self, planes=('xy', 'xz', 'yz')):
+        global current_slide, global_contrast, global_brightness
+
+        for p in planes: # only planes whose slide or filter settings changed are redrawn
+            key = (p, current_slide[p], global_contrast, global_brightness, self.intensity.ready)
+            if self.shown_bg[p] == key:
+                continue
+
             # new np slices produced from filter effects
-            np_slice = None
-            cs = current_slide[p]
-            
-            if (p == 'xy'):
-                np_slice = self.npimages[cs]
-            elif (p == 'xz'):
-                np_slice = np.swapaxes(self.npimages, 0, 1)[cs]
-            elif (p == 'yz'):
-                np_slice = np.swapaxes(self.npimages, 0, 2)[cs]
-
-            np_slice = apply_contrast(np_slice, global_contrast)
-            np_slice = apply_brightness(np_slice, global_brightness)
-            
-            self.c[p].change_bg(np_slice)
+            self.c[p].change_bg(self.filtered_slice(p, current_slide[p]))
+            self.shown_bg[p] = key
 
 
     def clear(self):
@@ -777,6 +1122,45 @@ class MainWindow(QMainWindow):
             self.c[p].change_annot(annot3D.get_slice(p, current_slide[p]))
 
 
+    def redo(self):
+        global annot3D, current_slide
+        annot3D.redo_history()
+        for p in ['xy', 'xz', 'yz']:
+            self.c[p].change_annot(annot3D.get_slice(p, current_slide[p]))
+
+
+    def offer_recovery(self, autosave_dir):
+        global annot3D, current_slide
+        restore = newest_restore_point(autosave_dir, self.npimages.shape)
+        if restore is None:
+            return
+        path, attrs = restore
+        when = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(attrs['time']))
+        answer = QMessageBox.question(self, 'Recover annotations', 'Annotations of this volume were autosaved at ' + when + ' but not saved. Recover them?')
+        if answer != QMessageBox.Yes:
+            return
+        annot3D.load(path)
+        annot3D.store_path = None # the restore point is not where the user saves
+        annot3D.mark_all_dirty()
+        for p in ['xy', 'xz', 'yz']:
+            self.c[p].change_annot(annot3D.get_slice(p, current_slide[p]))
+        self.statusBar().showMessage('Recovered annotations autosaved at ' + when)
+
+
+    def paintEvent(self, e):
+        super().paintEvent(e)
+        if self.first_paint is None:
+            self.first_paint = time.perf_counter()
+            QTimer.singleShot(0, report_startup)
+
+
+    def closeEvent(self, e):
+        self.prefetcher.shutdown()
+        self.predictions.shutdown()
+        self.autosaver.shutdown(clean=len(annot3D.dirty_chunks) == 0) # unsaved changes are offered again on the next start
+        super().closeEvent(e)
+
+
     def set_canvas_pen_color(self, c):
         self.c['xy'].set_pen_color(c)
         self.c['xz'].set_pen_color(c)
@@ -786,6 +1170,13 @@ class MainWindow(QMainWindow):
         
 
 
+def report_startup():
+    print("Startup: imports %.2fs, window %.2fs, first paint after %.2fs" % (IMPORTED - STARTED,
+          WINDOW_BUILT - IMPORTED, window.first_paint - STARTED))
+    if os.environ.get('ANNOT3D_QUIT_AFTER_STARTUP'): # benchmarks/bench_startup.py
+        QApplication.quit()
+
+
 if __name__ == "__main__":
     if not QApplication.instance():
         app = QApplication(sys.argv)
@@ -811,5 +1202,6 @@ if __name__ == "__main__":
     app.setPalette(palette)
 
     window = MainWindow()
+    WINDOW_BUILT = time.perf_counter()
     window.show()
     sys.exit(app.exec_())
@@ -0,0 +1,88 @@
+''' Chunk-by-chunk merging of several annotators' label stores. '''
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import product
+
+import numpy as np
+
+from chunkstore import chunk_grid, chunk_slices, chunks_in_region
+
+MODES = ('union', 'intersection', 'majority', 'k-of-n')
+START_METHOD = 'spawn' # never fork the threaded GUI process, workers only need the store paths anyway
+
+
+def required_votes(mode, n, k=None):
+    ''' annotators that must agree on a voxel's label for it to be kept, None for union '''
+    if mode == 'union':
+        return None
+    if mode == 'intersection':
+        return n
+    if mode == 'majority':
+        return n // 2 + 1
+    if mode == 'k-of-n':
+        if k is None or not 1 <= k <= n:
+            raise ValueError("k-of-n merging needs 1 <= k <= %d, got %s" % (n, k))
+        return k
+    raise ValueError("Unknown merge mode: " + str(mode))
+
+
+def vote(chunks, votes=None):
+    ''' merge label chunks of the same region.
+
+    Without votes later chunks win wherever they are labeled (union). Otherwise every voxel
+    takes the label most annotators gave it if at least votes of them did, else 0. Votes
+    are counted per label in uint16, so any number of annotators is counted exactly.
+    '''
+    out = np.zeros(chunks[0].shape, np.uint8)
+    if votes is None:
+        for chunk in chunks:
+            np.copyto(out, chunk, where=chunk > 0)
+        return out
+
+    best = np.zeros(out.shape, np.uint16)
+    for label in np.unique(np.concatenate([np.unique(c) for c in chunks])):
+        if label == 0:
+            continue
+        count = np.zeros(out.shape, np.uint16)
+        for chunk in chunks:
+            count += chunk == label
+        wins = count > best # ties keep the lower label
+        best[wins] = count[wins]
+        out[wins] = label
+    out[best < votes] = 0
+    return out
+
+
+def stored(store, region): # does store hold any chunk overlapping region
+    box = [b for s in region for b in (s.start, s.stop)]
+    return any(idx in store.chunks for idx in chunks_in_region(box, store.shape, store.chunk_shape))
+
+
+def merge_region(inputs, region, votes):
+    ''' merged labels of region, inputs are (store, lut) pairs mapping each store's labels onto the merged palette '''
+    return vote([lut[store.read_region(region)] for store, lut in inputs], votes)
+
+
+def merge_stores(inputs, shape, chunk_shape, mode='union', k=None, out=None, workers=None, progress=None):
+    ''' merge (store, lut) inputs region by region into out (a new uint8 volume by default) on a process pool.
+
+    Workers open the stores themselves, only one region per input is in memory per worker,
+    and at most a few regions per worker are in flight. progress(done, total) counts regions.
+    '''
+    votes = required_votes(mode, len(inputs), k)
+    if out is None:
+        out = np.zeros(shape, np.uint8)
+    regions = [chunk_slices(idx, shape, chunk_shape) for idx in product(*(range(n) for n in chunk_grid(shape, chunk_shape)))]
+    regions = [r for r in regions if any(stored(store, r) for store, lut in inputs)] # nobody annotated the rest, it stays 0
+
+    workers = workers or os.cpu_count() or 1
+    window = 4 * workers # bounds the merged regions waiting to be copied into out
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(START_METHOD)) as pool:
+        for b in range(0, len(regions), window):
+            batch = regions[b:b+window]
+            for region, merged in zip(batch, pool.map(merge_region, [inputs] * len(batch), batch, [votes] * len(batch))):
+                out[region] = merged
+            if progress is not None:
+                progress(b + len(batch), len(regions))
+    return out
@@ -0,0 +1,134 @@
+''' Surface meshes of the annotation volume, extracted and cached per chunk.
+
+Marching cubes comes from PyMCubes (mcubes) if installed, else from scikit-image.
+'''
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import product
+
+import numpy as np
+
+from chunkstore import chunk_grid, chunk_slices, chunks_in_region
+
+DEFAULT_MESH_CHUNK = (64, 64, 64) # marching cubes cells per chunk
+ISO_LEVEL = 0.5
+START_METHOD = 'spawn' # never fork the threaded GUI process, chunk samples are sent to the workers anyway
+
+
+def marching_cubes(mask, level=ISO_LEVEL):
+    ''' (vertices, faces) of the level iso-surface of a float (z, y, x) array '''
+    try:
+        import mcubes
+        verts, faces = mcubes.marching_cubes(mask, level)
+    except ImportError:
+        from skimage.measure import marching_cubes as skimage_marching_cubes
+        verts, faces = skimage_marching_cubes(mask, level)[:2]
+    return np.asarray(verts, np.float32), np.asarray(faces, np.int64)
+
+
+def mesh_chunk(samples, origin, level=ISO_LEVEL):
+    ''' mesh one chunk's samples, vertices shifted to volume coordinates by origin '''
+    if samples.min() >= level or samples.max() < level: # no surface crosses this chunk
+        return np.zeros((0, 3), np.float32), np.zeros((0, 3), np.int64)
+    verts, faces = marching_cubes(samples.astype(np.float32), level)
+    return verts + np.asarray(origin, np.float32), faces
+
+
+class SurfaceMesher():
+    ''' Surface of the annotated voxels (or of one label), meshed chunk by chunk.
+
+    The volume is treated as surrounded by one layer of empty voxels, so surfaces touching
+    its border are closed. Chunks split the marching cubes cells, each chunk reading one
+    extra layer of samples on its far sides, so neighbouring chunk meshes meet without gaps
+    or overlaps. Chunk meshes are cached and only chunks invalidated by edits are meshed
+    again, in parallel worker processes.
+    '''
+
+    def __init__(self, volume, chunk_shape=DEFAULT_MESH_CHUNK, label=None, workers=None):
+        self.volume = volume
+        self.chunk_shape = tuple(chunk_shape)
+        self.label = label
+        self.workers = workers
+        self.cells = tuple(s + 1 for s in volume.shape[:3]) # cells of the zero padded volume
+        self.meshes = {} # chunk idx -> (vertices, faces)
+        self.dirty = set(product(*(range(n) for n in chunk_grid(self.cells, self.chunk_shape))))
+
+    def invalidate(self, region):
+        ''' mark chunks whose cells touch the voxels of region (z0, z1, y0, y1, x0, x1) '''
+        cells = [b + (i % 2) for i, b in enumerate(region)] # voxel v is sampled by padded cells v and v+1
+        self.dirty.update(chunks_in_region(cells, self.cells, self.chunk_shape))
+
+    def samples(self, idx):
+        ''' samples of chunk idx: padded cells c0:c1 read padded samples c0:c1+1, i.e. voxels c0-1:c1 '''
+        cells = chunk_slices(idx, self.cells, self.chunk_shape)
+        out = np.zeros(tuple(c.stop - c.start + 1 for c in cells), np.uint8)
+        src = tuple(slice(max(c.start - 1, 0), min(c.stop, s)) for c, s in zip(cells, self.volume.shape))
+        dst = tuple(slice(s.start - (c.start - 1), s.stop - (c.start - 1)) for s, c in zip(src, cells))
+        block = np.asarray(self.volume[src])
+        out[dst] = block > 0 if self.label is None else block == self.label
+        return out, tuple(c.start - 1 for c in cells)
+
+    def update(self, progress=None):
+        ''' re-mesh dirty chunks, progress(done, total) counts chunks '''
+        dirty = sorted(self.dirty)
+        self.dirty = set()
+        tasks = [(idx,) + self.samples(idx) for idx in dirty] # copied now, edits during meshing land in the next update
+        if len(tasks) == 0:
+            return
+        with ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context(START_METHOD)) as pool:
+            results = pool.map(mesh_chunk, [t[1] for t in tasks], [t[2] for t in tasks], chunksize=8)
+            for done, (task, mesh) in enumerate(zip(tasks, results), 1):
+                if len(mesh[1]) > 0:
+                    self.meshes[task[0]] = mesh
+                else:
+                    self.meshes.pop(task[0], None)
+                if progress is not None:
+                    progress(done, len(tasks))
+
+    def mesh(self):
+        ''' (vertices, faces) of the whole surface, vertices shared by neighbouring chunks merged '''
+        if len(self.meshes) == 0:
+            return np.zeros((0, 3), np.float32), np.zeros((0, 3), np.int64)
+        verts, faces, offset = [], [], 0
+        for idx in sorted(self.meshes):
+            v, f = self.meshes[idx]
+            verts.append(v)
+            faces.append(f + offset)
+            offset += len(v)
+        verts, inverse = np.unique(np.concatenate(verts), axis=0, return_inverse=True)
+        return verts, inverse.reshape(-1)[np.concatenate(faces)]
+
+    def export(self, path):
+        ''' write the surface as .obj or .ply (by extension), x/y/z ordered like image columns/rows/slides '''
+        verts, faces = self.mesh()
+        verts = verts[:, ::-1] # (z, y, x) -> (x, y, z)
+        faces = faces[:, ::-1] # swapping axes mirrors the surface, keep the faces' outward winding
+        ext = os.path.splitext(path)[1].lower()
+        if ext == '.obj':
+            write_obj(path, verts, faces)
+        elif ext == '.ply':
+            write_ply(path, verts, faces)
+        else:
+            raise ValueError("Unknown mesh format " + ext + ", use .obj or .ply")
+        return len(verts), len(faces)
+
+
+def write_obj(path, verts, faces):
+    with open(path, 'w') as f:
+        f.write('# annot3d surface, %d vertices, %d faces\n' % (len(verts), len(faces)))
+        np.savetxt(f, verts, fmt='v %.6g %.6g %.6g')
+        np.savetxt(f, faces + 1, fmt='f %d %d %d')
+
+
+def write_ply(path, verts, faces): # binary little endian
+    header = '\n'.join(['ply', 'format binary_little_endian 1.0',
+                        'element vertex %d' % len(verts), 'property float x', 'property float y', 'property float z',
+                        'element face %d' % len(faces), 'property list uchar int vertex_indices', 'end_header']) + '\n'
+    face_data = np.empty(len(faces), dtype=[('n', 'u1'), ('idx', '<i4', 3)])
+    face_data['n'] = 3
+    face_data['idx'] = faces
+    with open(path, 'wb') as f:
+        f.write(header.encode('ascii'))
+        f.write(np.ascontiguousarray(verts, '<f4').tobytes())
+        f.write(face_data.tobytes())
@@ -1,6 +1,8 @@
 input_size_init = (32, 640, 1)
+DOWNSAMPLING_FACTOR = 16 # 4 max poolings, spatial input sizes must be multiples of this
 
-def unet(pretrained_weights = None, input_size=(32, 640, 1)):
+
+def unet(pretrained_weights = None, input_size=(32, 640, 1)): # (None, None, 1) accepts any multiple of DOWNSAMPLING_FACTOR
     from keras.models import Model
     from keras.layers import Input, Conv2D, MaxPooling2D, Dropout, UpSampling2D, concatenate
     from keras.optimizers import Adam
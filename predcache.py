@@ -0,0 +1,105 @@
+import hashlib
+import json
+import os
+import threading
+
+import numpy as np
+
+from helpers import SliceCache
+
+DEFAULT_MEMORY_BYTES = 256 * 1024 * 1024
+DEFAULT_DISK_BYTES = 2 * 1024 * 1024 * 1024
+
+
+def file_digest(path, block_size=1 << 20):
+    ''' sha1 of a file's content, read in blocks '''
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def slice_digest(img):
+    ''' sha1 of a slice's shape, dtype and values, independent of its memory layout '''
+    img = np.ascontiguousarray(img)
+    h = hashlib.sha1(('%s%s' % (img.dtype.str, img.shape)).encode())
+    h.update(img.data)
+    return h.hexdigest()
+
+
+class PredictionCache():
+    ''' Content-addressed model outputs: an in-memory LRU backed by an optional directory of .npy files.
+
+    Keys combine the source slice's hash with the model's weights hash, the plane and the
+    tiling parameters, so the same slide predicted with the same model is served again
+    after an undo, a repeated P or a restart with the same TIFF, but never across models.
+    '''
+
+    def __init__(self, max_bytes=DEFAULT_MEMORY_BYTES, directory=None, max_disk_bytes=DEFAULT_DISK_BYTES):
+        self.memory = SliceCache(max_bytes)
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+        self.disk_bytes = 0
+        self._lock = threading.Lock()
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            self.disk_bytes = sum(os.path.getsize(f) for f in self._disk_files())
+
+    @staticmethod
+    def key(img, model_id, plane, params):
+        h = hashlib.sha1(json.dumps([model_id, plane, params], sort_keys=True).encode())
+        h.update(slice_digest(img).encode())
+        return h.hexdigest()
+
+    def get(self, key):
+        probs = self.memory.get(key)
+        if probs is not None or self.directory is None:
+            return probs
+        try:
+            probs = np.load(self._file(key))
+        except (OSError, ValueError):
+            return None
+        try:
+            os.utime(self._file(key)) # pruning drops the least recently used files first
+        except OSError: # pruned in the meantime, the loaded output is still good
+            pass
+        self.memory.put(key, probs)
+        return probs
+
+    def put(self, key, probs):
+        probs = np.array(probs, np.float32) # own copy, the caller's array may be a view of a larger batch
+        probs.setflags(write=False)
+        self.memory.put(key, probs)
+        if self.directory is None or os.path.exists(self._file(key)):
+            return
+        tmp = self._file(key) + '.tmp'
+        with open(tmp, 'wb') as f:
+            np.save(f, probs)
+        os.replace(tmp, self._file(key))
+        with self._lock:
+            self.disk_bytes += os.path.getsize(self._file(key))
+            if self.disk_bytes > self.max_disk_bytes:
+                self._prune()
+
+    def clear(self):
+        self.memory.clear()
+        if self.directory is not None:
+            with self._lock:
+                for f in self._disk_files():
+                    os.remove(f)
+                self.disk_bytes = 0
+
+    def _file(self, key):
+        return os.path.join(self.directory, key + '.npy')
+
+    def _disk_files(self):
+        return [os.path.join(self.directory, f) for f in os.listdir(self.directory) if f.endswith('.npy')]
+
+    def _prune(self): # drop the oldest files until a quarter of the disk budget is free again
+        files = sorted(self._disk_files(), key=os.path.getmtime)
+        for f in files:
+            if self.disk_bytes <= self.max_disk_bytes * 3 // 4:
+                break
+            self.disk_bytes -= os.path.getsize(f)
+            os.remove(f)
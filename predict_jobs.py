@@ -0,0 +1,125 @@
+import itertools
+import queue
+import threading
+
+
+class PredictionJob():
+    ''' slides of one plane queued for prediction '''
+
+    def __init__(self, job_id, plane, indices):
+        self.id = job_id
+        self.plane = plane
+        self.indices = indices
+        self.done = 0
+        self.cancelled = threading.Event()
+
+    def runs(self, size, indices=None):
+        ''' (start, stop) ranges of consecutive indices (all of the job's by default), at most size slides each '''
+        start = prev = None
+        for i in self.indices if indices is None else indices:
+            if start is not None and (i != prev + 1 or i - start == size):
+                yield start, prev + 1
+                start = None
+            if start is None:
+                start = i
+            prev = i
+        if start is not None:
+            yield start, prev + 1
+
+
+class PredictionScheduler():
+    ''' Runs predictions on a worker thread so the GUI stays responsive.
+
+    predict(plane, start, stop) computes the model output for a run of slides. After each
+    run, on_ready(job, plane, start, output) is called from the worker thread, followed by
+    on_progress(job). on_finished(job) is called when a job ends or is cancelled. A newer
+    request for slides still queued in an older job takes them over, so each slide is
+    predicted once and reported to the latest job. Slides being predicted are not queued
+    again, and a job with nothing left to do is not created at all.
+    '''
+
+    def __init__(self, predict, on_ready, on_progress=None, on_finished=None, run_size=8):
+        self.predict = predict
+        self.on_ready = on_ready
+        self.on_progress = on_progress
+        self.on_finished = on_finished
+        self.run_size = run_size
+        self.jobs = {} # id -> job still queued or running
+        self.pending = {} # (plane, slide) -> id of the job that will predict it
+        self.running = set() # (plane, slide) of the run being predicted
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._worker = threading.Thread(target=self._run, name='prediction', daemon=True)
+        self._worker.start()
+
+    def submit(self, plane, start, stop):
+        ''' queue slides start:stop of plane, returns the job or None if all of them are being predicted already '''
+        with self._lock:
+            indices = [i for i in range(start, stop) if (plane, i) not in self.running]
+            if len(indices) == 0:
+                return None
+            job = PredictionJob(next(self._ids), plane, indices)
+            self.jobs[job.id] = job
+            self.pending.update(((plane, i), job.id) for i in indices)
+        self._queue.put(job)
+        return job
+
+    def cancel(self, job_id): # slides not yet predicted are dropped, a run in progress still completes
+        with self._lock:
+            job = self.jobs.get(job_id)
+        if job is not None:
+            job.cancelled.set()
+
+    def cancel_all(self):
+        with self._lock:
+            jobs = list(self.jobs.values())
+        for job in jobs:
+            job.cancelled.set()
+
+    def shutdown(self):
+        self.cancel_all()
+        self._queue.put(None)
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            try:
+                while not job.cancelled.is_set():
+                    run = self._claim(job)
+                    if run is None:
+                        break
+                    start, stop = run
+                    output = self.predict(job.plane, start, stop)
+                    self._release(job, range(start, stop))
+                    if output is None: # prediction failed, e.g. no model loaded
+                        break
+                    job.done += stop - start
+                    self.on_ready(job, job.plane, start, output)
+                    if self.on_progress is not None:
+                        self.on_progress(job)
+            except Exception as e:
+                print("Prediction job", job.id, "failed:", e)
+            finally:
+                with self._lock:
+                    self.jobs.pop(job.id, None)
+                self._release(job, job.indices)
+                if self.on_finished is not None:
+                    self.on_finished(job)
+
+    def _claim(self, job): # next run of slides the job still owns, marked as running
+        with self._lock:
+            owned = [i for i in job.indices if self.pending.get((job.plane, i)) == job.id]
+            for start, stop in job.runs(self.run_size, owned):
+                self.running.update((job.plane, i) for i in range(start, stop))
+                return start, stop
+        return None
+
+    def _release(self, job, indices): # keys taken over by a newer job stay with that job
+        with self._lock:
+            for i in indices:
+                self.running.discard((job.plane, i))
+                if self.pending.get((job.plane, i)) == job.id:
+                    del self.pending[(job.plane, i)]
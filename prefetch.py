@@ -0,0 +1,51 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Prefetcher():
+    ''' Prepares slices ahead of navigation on a small thread pool.
+
+    The direction is guessed from the last few slide steps on each plane. When it is
+    unclear (e.g. right after a jump) both neighbours are prepared alternately. Each new
+    schedule cancels the queued work of the previous one, so holding an arrow key never
+    builds up a backlog and a jump drops all stale requests.
+    '''
+
+    def __init__(self, ahead=4, workers=2, history=4):
+        self.ahead = ahead
+        self.steps = {} # plane -> recent slide steps
+        self.history = history
+        self.futures = []
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='prefetch')
+
+    def direction(self, plane): # +1, -1 or 0 when unknown
+        total = sum(self.steps.get(plane, ()))
+        return (total > 0) - (total < 0)
+
+    def targets(self, plane, cs, step, depth):
+        ''' slide indices worth preparing after moving by step (0 for a jump) to slide cs of a plane with depth slides '''
+        if step == 0:
+            self.steps[plane] = deque(maxlen=self.history)
+        else:
+            self.steps.setdefault(plane, deque(maxlen=self.history)).append(step)
+
+        d = self.direction(plane)
+        if d == 0:
+            candidates = [cs + sign * k for k in range(1, self.ahead // 2 + 1) for sign in (1, -1)]
+        else:
+            candidates = [cs + d * k for k in range(1, self.ahead + 1)]
+        return [i for i in candidates if 0 <= i < depth]
+
+    def schedule(self, tasks):
+        ''' replace queued work with tasks, a list of (function, args) '''
+        self.cancel()
+        self.futures = [self.executor.submit(fn, *args) for fn, args in tasks]
+
+    def cancel(self): # tasks already running finish, queued ones are dropped
+        for future in self.futures:
+            future.cancel()
+        self.futures = []
+
+    def shutdown(self):
+        self.cancel()
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,119 @@
+import os
+import tempfile
+
+import numpy as np
+
+from chunkstore import ChunkStore
+from helpers import plane_block, plane_slice
+
+LEVELS = 254 # probabilities are quantized to 1..255, 0 marks voxels without a (still valid) prediction
+MEMMAP_BYTES = 512 * 1024 * 1024 # larger maps live in temporary files instead of memory
+VALUES_DIR = 'probabilities' # sub-stores inside an annotation chunk store
+LABELS_DIR = 'prediction_labels'
+
+
+def quantize(probs):
+    return (np.clip(probs, 0.0, 1.0) * LEVELS + 1.5).astype(np.uint8)
+
+
+def threshold_level(t):
+    ''' smallest quantized value at or above threshold t, values below it are annotations '''
+    return int(np.clip(np.ceil(t * LEVELS + 1), 1, 256))
+
+
+class ProbabilityMap():
+    ''' Model outputs of predicted voxels, kept so the threshold can change without running the model again.
+
+    Every predicted voxel stores its uint8-quantized probability and the label the
+    prediction painted with. Both volumes are allocated on the first prediction and
+    memory-mapped to temporary files for large stacks. Manual edits invalidate the
+    voxels they touch, so re-thresholding never overwrites hand-made annotations.
+    '''
+
+    def __init__(self, shape, memmap_bytes=MEMMAP_BYTES):
+        self.shape = tuple(shape)
+        self.memmap_bytes = memmap_bytes
+        self.values = None
+        self.labels = None
+
+    @property
+    def allocated(self):
+        return self.values is not None
+
+    def _volume(self):
+        if 2 * np.prod(self.shape) > self.memmap_bytes:
+            return np.memmap(tempfile.TemporaryFile(), dtype=np.uint8, mode='w+', shape=self.shape) # zero filled, removed on close
+        return np.zeros(self.shape, np.uint8)
+
+    def _allocate(self):
+        if not self.allocated:
+            self.values = self._volume()
+            self.labels = self._volume()
+
+    def clear(self):
+        self.values = None
+        self.labels = None
+
+    def store(self, p, start, probs, label):
+        ''' keep the (n, rows, cols) output of slides start:start+n of plane p, predicted with label '''
+        self._allocate()
+        stop = start + len(probs)
+        plane_block(self.values, p, start, stop)[...] = quantize(probs)
+        plane_block(self.labels, p, start, stop)[...] = label
+
+    def invalidate(self, p, cs, r0, r1, c0, c1, mask=None):
+        ''' forget predictions under rows r0:r1, columns c0:c1 (where mask is set) of slide cs on plane p '''
+        if not self.allocated:
+            return
+        view = plane_slice(self.values, p, cs)[r0:r1, c0:c1]
+        if mask is None:
+            view[...] = 0
+        else:
+            view[mask] = 0
+
+    def snapshot(self, p, start, stop):
+        ''' copy of (values, labels) of slides start:stop of plane p, None if nothing was predicted '''
+        if not self.allocated:
+            return None
+        return np.array(plane_block(self.values, p, start, stop)), np.array(plane_block(self.labels, p, start, stop))
+
+    def restore(self, p, start, stop, snapshot):
+        ''' put back a snapshot of slides start:stop, None forgets their predictions '''
+        if snapshot is None:
+            if self.allocated:
+                plane_block(self.values, p, start, stop)[...] = 0
+            return
+        self._allocate()
+        plane_block(self.values, p, start, stop)[...] = snapshot[0]
+        plane_block(self.labels, p, start, stop)[...] = snapshot[1]
+
+    def binarize(self, t, region):
+        ''' (predicted, labels) for the voxels of region (a tuple of slices), labels are 0 where the probability reaches t '''
+        values = np.asarray(self.values[region])
+        predicted = values > 0
+        labels = np.where(values < threshold_level(t), self.labels[region], 0).astype(np.uint8)
+        return predicted, labels
+
+    def save(self, path, indices=None):
+        ''' write the map as two chunk stores below annotation store path, only the given chunk indices if the stores exist '''
+        for name, volume in ((VALUES_DIR, self.values), (LABELS_DIR, self.labels)):
+            sub = os.path.join(path, name)
+            if volume is None: # nothing predicted, only empty a map left there by an earlier save
+                if ChunkStore.is_store(sub):
+                    ChunkStore.create(sub, self.shape, np.uint8)
+            elif indices is not None and ChunkStore.is_store(sub):
+                ChunkStore.open(sub).write_volume(volume, indices)
+            else:
+                ChunkStore.create(sub, self.shape, np.uint8).write_volume(volume)
+
+    def load(self, path):
+        ''' read a map saved with an annotation store, returns False if it has none '''
+        self.clear()
+        subs = [os.path.join(path, name) for name in (VALUES_DIR, LABELS_DIR)]
+        if not all(ChunkStore.is_store(sub) for sub in subs):
+            return False
+        self._allocate()
+        for sub, volume in zip(subs, (self.values, self.labels)):
+            for idx, sl, chunk in ChunkStore.open(sub).iter_chunks():
+                volume[sl] = chunk
+        return True
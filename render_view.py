@@ -0,0 +1,127 @@
+''' Mayavi render view of the annotations, imported by the main window on first use.
+
+traits, traitsui and mayavi take seconds to import and the scene takes more to build,
+so none of it is loaded until the render dock is first shown.
+'''
+import numpy as np
+from PySide2.QtCore import QTimer
+from PySide2.QtWidgets import QVBoxLayout, QWidget
+
+from traits.api import HasTraits, Instance, on_trait_change
+from traitsui.api import View, Item
+from mayavi.core.ui.api import MayaviScene, MlabSceneModel, SceneEditor
+from mayavi import mlab
+
+from lod import LODPyramid
+
+INTERACTIVE_RENDER_VOXELS = 2 * 1024 * 1024 # render view budget while the camera moves or annotations change
+IDLE_RENDER_VOXELS = 64 * 1024 * 1024 # budget once idle, smaller stacks render at full resolution
+RENDER_IDLE_MS = 400
+
+
+def scalar_view(source):
+    ''' writable (z, y, x) numpy view on the VTK scalars of an ArraySource built from a (z, y, x) array '''
+    scalars = source.image_data.point_data.scalars.to_array() # VTK keeps the first array axis fastest
+    return scalars.reshape(tuple(source.image_data.dimensions)[::-1]).transpose(2, 1, 0)
+
+
+class Visualization(HasTraits):
+    ''' Render view drawing from LOD pyramids: coarse levels while the camera moves or
+    annotations change, the finest level within the idle budget once things settle. '''
+    scene = Instance(MlabSceneModel, ())
+
+    def __init__(self, get_annot, **traits):
+        HasTraits.__init__(self, **traits)
+        self.get_annot = get_annot # the window replaces its AnnotationSpace3D when a new source is loaded
+
+    @on_trait_change('scene.activated')
+    def update_plot(self):
+        annot3D = self.get_annot()
+        annot3D.track_dirty('render')
+        annot3D.take_dirty('render') # the pyramids below start from the current labels
+        self.images = LODPyramid(annot3D.get_npimages(), 'mean')
+        self.labels = LODPyramid(annot3D.get_npspace(), 'max')
+        self.shown = None # (image level, label level) on screen
+        self.idle_timer = QTimer()
+        self.idle_timer.setSingleShot(True)
+        self.idle_timer.timeout.connect(lambda: self.show_levels(IDLE_RENDER_VOXELS))
+
+        self.bg_sf = mlab.pipeline.scalar_field(self.images.level(self.images.level_for(INTERACTIVE_RENDER_VOXELS)))
+        self.npspace_sf = mlab.pipeline.scalar_field(self.labels.level(self.labels.level_for(INTERACTIVE_RENDER_VOXELS))) # scalar field to update later
+        bg_original = mlab.pipeline.volume(self.bg_sf)
+        segmask = mlab.pipeline.iso_surface(self.npspace_sf, color=(1.0, 0.0, 0.0))
+        self.show_levels(INTERACTIVE_RENDER_VOXELS)
+        self.idle_timer.start(RENDER_IDLE_MS)
+
+        interactor = self.scene.interactor # coarse while the camera moves
+        interactor.add_observer('StartInteractionEvent', lambda *args: self.interacting())
+        interactor.add_observer('EndInteractionEvent', lambda *args: self.idle_timer.start(RENDER_IDLE_MS))
+        # self.scene.scene.disable_render = False
+
+
+    def interacting(self):
+        self.idle_timer.stop()
+        self.show_levels(INTERACTIVE_RENDER_VOXELS)
+
+
+    def show_levels(self, max_voxels):
+        levels = (self.images.level_for(max_voxels), self.labels.level_for(max_voxels))
+        if levels == self.shown:
+            return
+        self.scene.disable_render = True
+        for sf, pyramid, k in ((self.bg_sf, self.images, levels[0]), (self.npspace_sf, self.labels, levels[1])):
+            sf.scalar_data = np.asarray(pyramid.level(k))
+            sf.spacing = (2 ** k,) * 3
+        self.scene.disable_render = False
+        self.shown = levels
+
+
+    def update_annot(self): # push changed chunks only, render coarse until edits settle
+        if getattr(self, 'npspace_sf', None) is None: # scene not shown yet
+            return
+        annot3D = self.get_annot()
+        if annot3D.get_npspace() is not self.labels.volume: # labels were loaded or merged as a whole
+            annot3D.take_dirty('render')
+            self.labels = LODPyramid(annot3D.get_npspace(), 'max')
+            self.shown = None
+            self.interacting()
+            self.idle_timer.start(RENDER_IDLE_MS)
+            return
+
+        regions = annot3D.take_dirty('render')
+        if len(regions) == 0:
+            return
+        for region in regions:
+            self.labels.update(region)
+        k = self.shown[1]
+        f = 2 ** k
+        view = scalar_view(self.npspace_sf)
+        level = self.labels.level(k)
+        for region in regions:
+            sl = tuple(slice(region[2*a] // f, -(-region[2*a+1] // f)) for a in range(3))
+            view[sl] = level[sl]
+        self.npspace_sf.image_data.point_data.scalars.modified()
+        self.npspace_sf.data_changed = True
+        if k != self.labels.level_for(INTERACTIVE_RENDER_VOXELS): # iso-surfaces of full detail are slow to redo, go coarse meanwhile
+            self.interacting()
+        self.idle_timer.start(RENDER_IDLE_MS)
+
+
+    view = View(Item('scene', editor=SceneEditor(scene_class=MayaviScene), height=250, width=300, show_label=False), resizable=True )
+
+
+
+class MayaviQWidget(QWidget):
+    def __init__(self, get_annot, parent=None):
+        QWidget.__init__(self, parent)
+        layout = QVBoxLayout(self)
+        layout.setContentsMargins(0,0,0,0)
+        layout.setSpacing(0)
+        self.visualization = Visualization(get_annot)
+
+        self.ui = self.visualization.edit_traits(parent=self, kind='subpanel').control
+        layout.addWidget(self.ui)
+        self.ui.setParent(self)
+    
+    def update_annot(self):
+        self.visualization.update_annot()
@@ -0,0 +1,236 @@
+''' Prediction server speaking both the binary batch API and the old JSON API.
+
+Slides from all connected annotators are queued and grouped into dynamic batches, bounded
+by a batch size and a latency deadline, so one model process serves everybody. Counters
+are served as JSON on GET /stats. Runs on the CPU unless --gpu is given.
+
+    python server.py                       # stub model: normalized intensity as probabilities
+    python server.py --weights unet.hdf5   # the real unet, tiled like local predictions
+
+Point the app at it with: python main.py http://localhost:5000
+'''
+import argparse
+import json
+import os
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+from inference import normalize_batch
+from wire import BATCH_API, CONTENT_TYPE, JSON_API, decode_array, encode_array, is_compressed
+
+DEFAULT_PORT = 5000
+DEFAULT_THRESHOLD = 0.8 # JSON answers are binary, voxels below it are annotations
+DEFAULT_MAX_BATCH = 16 # slides per model call
+DEFAULT_MAX_DELAY = 0.02 # seconds the first queued slide waits for others to join its batch
+LATENCY_WINDOW = 1000 # recent requests the latency percentiles are computed over
+
+
+def stub_predict(imgs):
+    ''' stands in for a model: slide intensity scaled to 0..1, so dark voxels come out as annotations '''
+    return (normalize_batch(imgs) + 1.0) / 2.0
+
+
+def unet_predict(weights, batch_size=DEFAULT_MAX_BATCH, gpu=False, threads=None):
+    if not gpu:
+        os.environ['CUDA_VISIBLE_DEVICES'] = '-1' # must be set before tensorflow is imported
+    if threads:
+        os.environ['TF_NUM_INTRAOP_THREADS'] = str(threads)
+        os.environ['TF_NUM_INTEROP_THREADS'] = '1'
+    import models
+    from inference import TiledPredictor
+    predictor = TiledPredictor(models.unet(pretrained_weights=weights, input_size=(None, None, 1)), batch_size=batch_size)
+    return lambda imgs: predictor.predict(normalize_batch(imgs))
+
+
+class PredictionRequest():
+    ''' slides of one client request, resolved once every slide went through a batch '''
+
+    def __init__(self, imgs):
+        self.imgs = imgs
+        self.out = np.empty(imgs.shape, np.float32)
+        self.remaining = len(imgs)
+        self.future = Future()
+        self.created = time.perf_counter()
+
+
+class DynamicBatcher():
+    ''' Groups queued slides into batches for predict_fn on a single worker thread.
+
+    The first waiting slide opens a batch, which closes when max_batch slides joined or
+    max_delay seconds passed. Slides of different sizes in one batch are predicted in one
+    call per size. Requests from many clients therefore share model calls, while a lone
+    request waits at most max_delay longer than the model itself takes.
+    '''
+
+    def __init__(self, predict_fn, max_batch=DEFAULT_MAX_BATCH, max_delay=DEFAULT_MAX_DELAY):
+        self.predict_fn = predict_fn
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.queue = queue.Queue() # (request, slide index)
+        self.lock = threading.Lock()
+        self.started = time.perf_counter()
+        self.counters = {'requests': 0, 'slides': 0, 'batches': 0, 'model_calls': 0, 'errors': 0, 'busy_seconds': 0.0}
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.worker = threading.Thread(target=self._run, name='batcher', daemon=True)
+        self.worker.start()
+
+    def submit(self, imgs):
+        ''' queue (n, rows, cols) slides, returns a Future of their (n, rows, cols) float32 output '''
+        request = PredictionRequest(imgs)
+        if len(imgs) == 0:
+            request.future.set_result(request.out)
+            return request.future
+        with self.lock:
+            self.counters['requests'] += 1
+        for i in range(len(imgs)):
+            self.queue.put((request, i))
+        return request.future
+
+    def predict(self, imgs):
+        return self.submit(imgs).result()
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            latencies = np.array(self.latencies)
+        uptime = time.perf_counter() - self.started
+        stats['uptime_seconds'] = uptime
+        stats['queued_slides'] = self.queue.qsize()
+        stats['slides_per_second'] = stats['slides'] / uptime if uptime > 0 else 0.0
+        stats['mean_batch_size'] = stats['slides'] / stats['batches'] if stats['batches'] else 0.0
+        stats['utilization'] = stats['busy_seconds'] / uptime if uptime > 0 else 0.0
+        for q in (50, 95, 99):
+            stats['latency_p%d_ms' % q] = float(np.percentile(latencies, q)) * 1000 if len(latencies) else 0.0
+        return stats
+
+    def _collect(self):
+        batch = [self.queue.get()]
+        deadline = time.perf_counter() + self.max_delay
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            groups = {} # slide shape -> items, one model call each
+            for request, i in batch:
+                groups.setdefault(request.imgs.shape[1:], []).append((request, i))
+
+            start = time.perf_counter()
+            for items in groups.values():
+                try:
+                    out = np.asarray(self.predict_fn(np.stack([r.imgs[i] for r, i in items])), np.float32)
+                except Exception as e:
+                    print('Prediction failed:', e)
+                    with self.lock:
+                        self.counters['errors'] += 1
+                    for request, i in items:
+                        if not request.future.done():
+                            request.future.set_exception(e)
+                    continue
+                for (request, i), o in zip(items, out):
+                    request.out[i] = o
+                    request.remaining -= 1
+                    if request.remaining == 0 and not request.future.done():
+                        request.future.set_result(request.out)
+                        with self.lock:
+                            self.latencies.append(time.perf_counter() - request.created)
+            with self.lock:
+                self.counters['batches'] += 1
+                self.counters['model_calls'] += len(groups)
+                self.counters['slides'] += len(batch)
+                self.counters['busy_seconds'] += time.perf_counter() - start
+
+
+class PredictionServer(ThreadingHTTPServer):
+    ''' HTTP server around predict_fn, (n, rows, cols) raw slides -> (n, rows, cols) float32 probabilities.
+    Requests are handled on threads and meet in the DynamicBatcher. '''
+
+    daemon_threads = True
+
+    def __init__(self, address, predict_fn, threshold=DEFAULT_THRESHOLD, max_batch=DEFAULT_MAX_BATCH, max_delay=DEFAULT_MAX_DELAY):
+        super().__init__(address, PredictionHandler)
+        self.batcher = DynamicBatcher(predict_fn, max_batch, max_delay)
+        self.threshold = threshold
+
+    def predict(self, imgs):
+        return self.batcher.predict(imgs)
+
+
+class PredictionHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # keep-alive, clients reuse their pooled connections
+
+    def do_GET(self):
+        if self.path == '/stats':
+            self.reply(200, json.dumps(self.server.batcher.stats()).encode(), 'application/json')
+        else:
+            self.reply(404, b'Unknown endpoint', 'text/plain')
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        try:
+            if self.path == BATCH_API:
+                imgs = decode_array(body)
+                if imgs.ndim == 2:
+                    imgs = imgs[None]
+                out = self.server.predict(imgs)
+                self.reply(200, encode_array(out, compress=is_compressed(body)), CONTENT_TYPE)
+            elif self.path == JSON_API:
+                img = np.array(json.loads(body)['slide'])
+                out = self.server.predict(img[None])[0]
+                prediction = (out < self.server.threshold).astype(np.uint8)
+                self.reply(200, json.dumps({'prediction': prediction.tolist()}).encode(), 'application/json')
+            else:
+                self.reply(404, b'Unknown endpoint', 'text/plain')
+        except Exception as e:
+            print('Prediction failed:', e)
+            self.reply(400, str(e).encode(), 'text/plain')
+
+    def reply(self, status, payload, content_type):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local prediction server for annot3d')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--weights', help='unet weights (hdf5), the stub model is used without')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD)
+    parser.add_argument('--max-batch', type=int, default=DEFAULT_MAX_BATCH, help='slides per model call')
+    parser.add_argument('--max-delay', type=float, default=DEFAULT_MAX_DELAY * 1000, help='ms a slide waits for its batch to fill')
+    parser.add_argument('--threads', type=int, help='tensorflow CPU threads')
+    parser.add_argument('--gpu', action='store_true', help='allow tensorflow to use a GPU')
+    args = parser.parse_args()
+
+    if args.weights:
+        predict_fn = unet_predict(args.weights, args.max_batch, args.gpu, args.threads)
+    else:
+        predict_fn = stub_predict
+    server = PredictionServer((args.host, args.port), predict_fn, args.threshold, args.max_batch, args.max_delay / 1000)
+    print('Serving predictions on http://%s:%d' % (args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+
+if __name__ == '__main__':
+    main()
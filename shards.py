@@ -0,0 +1,217 @@
+''' Training sets as a few large shards of stacked image/label arrays with a json index.
+
+Only annotated slides (or patches) are written. Uncompressed shards are plain .npy files
+that the reader memory-maps, so training reads batches without decoding any images.
+'''
+import json
+import os
+
+import numpy as np
+
+from helpers import plane_block
+from inference import normalize_batch
+
+INDEX_NAME = 'index.json'
+FORMAT_NAME = 'annot3d-shards'
+FORMAT_VERSION = 1
+DEFAULT_SHARD_BYTES = 256 * 1024 * 1024
+PLANE_AXIS = {'xy': 0, 'xz': 1, 'yz': 2}
+SCAN_SLIDES = 32 # slides read at once when looking for annotations
+
+
+def annotated_slides(labels, plane):
+    ''' indices of the slides of plane holding any label, scanned block by block '''
+    n = labels.shape[PLANE_AXIS[plane]]
+    found = []
+    for start in range(0, n, SCAN_SLIDES):
+        block = plane_block(labels, plane, start, min(start + SCAN_SLIDES, n))
+        found.extend(start + np.nonzero(block.reshape(len(block), -1).any(axis=1))[0])
+    return [int(i) for i in found]
+
+
+def patch_origins(shape, patch, stride):
+    ''' (row, col) of patches covering a slide of shape, the last row/column of patches aligned to the edge '''
+    starts = []
+    for size, p, s in zip(shape, patch, stride):
+        axis = list(range(0, max(size - p, 0) + 1, s))
+        if axis[-1] != max(size - p, 0):
+            axis.append(max(size - p, 0))
+        starts.append(axis)
+    return [(r, c) for r in starts[0] for c in starts[1]]
+
+
+class ShardWriter():
+    ''' collects same-shaped image/label pairs and writes them as shards of about shard_bytes '''
+
+    def __init__(self, path, shard_bytes=DEFAULT_SHARD_BYTES, compress=False):
+        self.path = path
+        self.shard_bytes = shard_bytes
+        self.compress = compress
+        self.shards = []
+        self._reset(None)
+        os.makedirs(path, exist_ok=True)
+
+    def _reset(self, plane):
+        self.plane = plane
+        self.images, self.labels, self.items = [], [], []
+        self.nbytes = 0
+
+    def add(self, plane, slide, origin, image, label):
+        if self.plane is not None and (plane != self.plane or image.shape != self.images[0].shape):
+            self.flush()
+        self.plane = plane
+        self.images.append(np.array(image))
+        self.labels.append(np.array(label, np.uint8))
+        self.items.append([slide, origin[0], origin[1]])
+        self.nbytes += image.nbytes + label.nbytes
+        if self.nbytes >= self.shard_bytes:
+            self.flush()
+
+    def flush(self):
+        if len(self.items) == 0:
+            return
+        name = 'shard-%05d' % len(self.shards)
+        images, labels = np.stack(self.images), np.stack(self.labels)
+        if self.compress:
+            files = {'file': name + '.npz'}
+            self._save(files['file'], lambda f: np.savez_compressed(f, images=images, labels=labels))
+        else:
+            files = {'images': name + '.images.npy', 'labels': name + '.labels.npy'}
+            self._save(files['images'], lambda f: np.save(f, images))
+            self._save(files['labels'], lambda f: np.save(f, labels))
+        self.shards.append(dict(files, plane=self.plane, count=len(self.items),
+                                shape=list(images.shape[1:]), dtype=images.dtype.str, items=self.items))
+        self._reset(None)
+
+    def _save(self, fname, save):
+        tmp = os.path.join(self.path, fname + '.tmp')
+        with open(tmp, 'wb') as f:
+            save(f)
+        os.replace(tmp, os.path.join(self.path, fname))
+
+    def close(self, attrs=None):
+        self.flush()
+        index = {'format': FORMAT_NAME, 'version': FORMAT_VERSION, 'compressed': self.compress,
+                 'shards': self.shards, 'attrs': attrs or {}}
+        with open(os.path.join(self.path, INDEX_NAME), 'w') as f:
+            json.dump(index, f)
+
+
+def write_shards(images, labels, path, planes=('xz',), patch=None, stride=None, shard_bytes=DEFAULT_SHARD_BYTES,
+                 compress=False, progress=None):
+    ''' write annotated slides of the given planes (or their annotated patch x patch windows) as shards below path.
+
+    Labels are stored as they are, 0 unannotated and 1..255 the palette labels. Returns the
+    number of pairs written. progress(done, total) counts annotated slides.
+    '''
+    writer = ShardWriter(path, shard_bytes, compress)
+    slides = {p: annotated_slides(labels, p) for p in planes}
+    total = sum(len(s) for s in slides.values())
+    done = count = 0
+    for plane in planes:
+        for i in slides[plane]:
+            image = np.asarray(plane_block(images, plane, i, i + 1)[0])
+            label = plane_block(labels, plane, i, i + 1)[0]
+            if patch is None:
+                writer.add(plane, i, (0, 0), image, label)
+                count += 1
+            else:
+                for r, c in patch_origins(label.shape, patch, stride or patch):
+                    window = (slice(r, r + patch[0]), slice(c, c + patch[1]))
+                    if label[window].shape == tuple(patch) and label[window].any():
+                        writer.add(plane, i, (r, c), image[window], label[window])
+                        count += 1
+            done += 1
+            if progress is not None:
+                progress(done, total)
+    writer.close({'planes': list(planes), 'patch': list(patch) if patch else None, 'volume_shape': list(labels.shape)})
+    return count
+
+
+class ShardReader():
+    ''' Streams (x, y) training batches from a shard directory.
+
+    x are slides normalized like for prediction with a trailing channel axis, y are 0 on
+    annotations and 1 elsewhere, matching the unet's thresholding. Batches never mix
+    shards, so every batch has one shape.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, INDEX_NAME), 'r') as f:
+            self.index = json.load(f)
+        if self.index.get('format') != FORMAT_NAME:
+            raise ValueError('Not an annotation shard directory: ' + str(path))
+        self.shards = self.index['shards']
+
+    def __len__(self): # image/label pairs
+        return sum(s['count'] for s in self.shards)
+
+    def arrays(self, k):
+        ''' raw (images, labels) of shard k, memory-mapped unless the shards are compressed '''
+        shard = self.shards[k]
+        if 'file' in shard:
+            with np.load(os.path.join(self.path, shard['file'])) as data:
+                return data['images'], data['labels']
+        return (np.load(os.path.join(self.path, shard['images']), mmap_mode='r'),
+                np.load(os.path.join(self.path, shard['labels']), mmap_mode='r'))
+
+    def batch_positions(self, batch_size, shuffle=False, seed=None):
+        ''' (shard, item indices) of every batch of one epoch.
+
+        Shuffling shuffles the shard order and the items within each shard, but a shard's
+        batches stay consecutive, so each shard is opened (and decoded if compressed) once per epoch.
+        '''
+        rng = np.random.default_rng(seed)
+        batches = []
+        shard_order = rng.permutation(len(self.shards)) if shuffle else range(len(self.shards))
+        for k in shard_order:
+            count = self.shards[k]['count']
+            order = rng.permutation(count) if shuffle else np.arange(count)
+            batches.extend((int(k), np.sort(order[b:b+batch_size])) for b in range(0, len(order), batch_size))
+        return batches
+
+    @staticmethod
+    def to_training(images, labels):
+        x = normalize_batch(images)[..., np.newaxis]
+        y = (np.asarray(labels) == 0).astype(np.float32)[..., np.newaxis]
+        return x, y
+
+    def batches(self, batch_size=8, shuffle=True, seed=None):
+        ''' one epoch of (x, y) batches, a shard is opened when its first batch is due '''
+        opened = (None, None)
+        for k, items in self.batch_positions(batch_size, shuffle, seed):
+            if opened[0] != k:
+                opened = (k, self.arrays(k))
+            images, labels = opened[1]
+            yield self.to_training(images[items], labels[items])
+
+
+def keras_sequence(path, batch_size=8, shuffle=True):
+    ''' keras Sequence over a shard directory for model.fit, reshuffled every epoch '''
+    from keras.utils import Sequence
+
+    class ShardSequence(Sequence):
+        def __init__(self):
+            super().__init__()
+            self.reader = ShardReader(path)
+            self.epoch = 0
+            self.positions = self.reader.batch_positions(batch_size, shuffle, self.epoch)
+            self.cache = (None, None)
+
+        def __len__(self):
+            return len(self.positions)
+
+        def __getitem__(self, i):
+            k, items = self.positions[i]
+            if self.cache[0] != k:
+                self.cache = (k, self.reader.arrays(k))
+            images, labels = self.cache[1]
+            return self.reader.to_training(images[items], labels[items])
+
+        def on_epoch_end(self):
+            self.epoch += 1
+            if shuffle:
+                self.positions = self.reader.batch_positions(batch_size, True, self.epoch)
+
+    return ShardSequence()
@@ -0,0 +1,102 @@
+import numpy as np
+
+from AnnotationSpace3D import AnnotationSpace3D
+from autosave import Autosaver, newest_restore_point, session_dir
+from chunkstore import ChunkStore
+
+SHAPE = (8, 40, 40)
+COLOR = [255, 0, 0, 255]
+
+
+def annotation_space():
+    annot = AnnotationSpace3D(np.zeros(SHAPE, np.uint8), SHAPE, COLOR)
+    annot.chunk_shape = (4, 16, 16)
+    annot.dirty_trackers['save'].clear()
+    return annot
+
+
+def paint(annot, region, label=1):
+    z0, z1, y0, y1, x0, x1 = region
+    annot.npspace[z0:z1, y0:y1, x0:x1] = label
+    annot.mark_dirty(region)
+
+
+def restored(path):
+    store = ChunkStore.open(path)
+    return store.read_region(tuple(slice(0, s) for s in SHAPE)), store
+
+
+def test_session_dir_depends_on_source_and_shape(tmp_path):
+    a = session_dir('a.tiff', SHAPE, str(tmp_path))
+    assert a == session_dir('a.tiff', SHAPE, str(tmp_path))
+    assert a != session_dir('b.tiff', SHAPE, str(tmp_path))
+    assert a != session_dir('a.tiff', (8, 40, 41), str(tmp_path))
+
+
+def test_restore_round_trip(tmp_path):
+    annot = annotation_space()
+    saver = Autosaver(annot, str(tmp_path), 'src.tiff', slots=2)
+    assert saver.snapshot() is None # nothing changed yet
+    paint(annot, (1, 3, 5, 9, 20, 30))
+    assert saver.snapshot() == 0
+    paint(annot, (6, 7, 30, 40, 0, 4), 2)
+    assert saver.snapshot() == 1
+    saver.wait()
+    path, attrs = newest_restore_point(str(tmp_path), SHAPE)
+    assert path == saver.slot_path(1) and attrs['complete']
+    assert np.array_equal(restored(path)[0], annot.npspace)
+    saver.shutdown(clean=True)
+    assert newest_restore_point(str(tmp_path), SHAPE) is None # nothing to recover after a clean exit
+
+
+def test_empty_chunks_are_skipped_and_erased_chunks_dropped(tmp_path):
+    annot = annotation_space()
+    saver = Autosaver(annot, str(tmp_path), 'src.tiff', slots=1)
+    paint(annot, (0, 1, 0, 1, 0, 1))
+    saver.snapshot()
+    saver.wait()
+    volume, store = restored(saver.slot_path(0))
+    assert store.chunks == {(0, 0, 0)}
+    assert saver.stored[0] == {(0, 0, 0)}
+
+    paint(annot, (0, 1, 0, 1, 0, 1), 0)
+    paint(annot, (5, 6, 20, 21, 20, 21))
+    saver.snapshot()
+    saver.wait()
+    volume, store = restored(saver.slot_path(0))
+    assert store.chunks == {(1, 1, 1)}
+    assert np.array_equal(volume, annot.npspace)
+    saver.shutdown()
+
+
+def test_failed_chunks_are_written_again(tmp_path):
+    annot = annotation_space()
+    saver = Autosaver(annot, str(tmp_path), 'src.tiff', slots=1)
+    write = saver._write
+    def fail_once(*args):
+        saver._write = write
+        raise OSError('disk full')
+    saver._write = fail_once
+    paint(annot, (0, 2, 0, 2, 0, 2))
+    saver.snapshot()
+    saver.wait()
+    assert not ChunkStore.is_store(saver.slot_path(0))
+    assert saver.snapshot() == 0 # failed chunks come back although nothing changed
+    saver.wait()
+    assert np.array_equal(restored(saver.slot_path(0))[0], annot.npspace)
+    saver.shutdown()
+
+
+def test_existing_slot_chunks_are_overwritten(tmp_path):
+    annot = annotation_space()
+    saver = Autosaver(annot, str(tmp_path), 'src.tiff', slots=1)
+    paint(annot, (0, 1, 0, 1, 0, 1))
+    saver.shutdown()
+
+    annot = annotation_space() # a new session of the same source, starting from empty labels
+    saver = Autosaver(annot, str(tmp_path), 'src.tiff', slots=1)
+    paint(annot, (5, 6, 20, 21, 20, 21))
+    saver.snapshot()
+    saver.wait()
+    assert np.array_equal(restored(saver.slot_path(0))[0], annot.npspace)
+    saver.shutdown()
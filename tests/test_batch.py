@@ -0,0 +1,82 @@
+import os
+import subprocess
+import sys
+
+import numpy as np
+from PIL import Image
+
+from batch import expand_inputs
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+
+def touch(path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    open(path, 'wb').close()
+    return path
+
+
+def write_stack(path, shape=(3, 4, 5)):
+    pages = [Image.fromarray(page) for page in np.arange(np.prod(shape), dtype=np.uint8).reshape(shape)]
+    pages[0].save(path, save_all=True, append_images=pages[1:])
+
+
+def run_batch(*args):
+    return subprocess.run([sys.executable, os.path.join(ROOT, 'batch.py')] + [str(a) for a in args],
+                          cwd=ROOT, capture_output=True, text=True, timeout=120)
+
+
+def test_globs_are_sorted_and_deduplicated(tmp_path):
+    b, a = touch(str(tmp_path / 'b.tiff')), touch(str(tmp_path / 'a.tiff'))
+    touch(str(tmp_path / 'notes.txt'))
+    assert expand_inputs([str(tmp_path / '*.tiff')]) == [a, b]
+    assert expand_inputs([b, str(tmp_path / '*.tiff')]) == [b, a] # first mention wins
+
+
+def test_directories_expand_to_their_tiff_files(tmp_path):
+    stacks = str(tmp_path / 'stacks')
+    expected = [touch(os.path.join(stacks, name)) for name in ('a.TIF', 'b.tif', 'c.tiff')]
+    touch(os.path.join(stacks, 'readme.txt'))
+    touch(os.path.join(stacks, 'nested', 'd.tiff')) # not recursive
+    assert expand_inputs([stacks]) == expected
+    assert expand_inputs([stacks + os.sep]) == [os.path.join(stacks + os.sep, os.path.basename(p)) for p in expected]
+
+
+def test_list_files_mix_paths_globs_and_directories(tmp_path):
+    one = touch(str(tmp_path / 'one.tiff'))
+    two = touch(str(tmp_path / 'dir' / 'two.tiff'))
+    listing = tmp_path / 'volumes.txt'
+    listing.write_text('%s\n\n%s\n%s\n' % (str(tmp_path / 'dir'), str(tmp_path / '*.tiff'), one))
+    assert expand_inputs(['@' + str(listing)]) == [two, one]
+
+
+def test_empty_matches_are_reported_and_skipped(tmp_path, capsys):
+    one = touch(str(tmp_path / 'one.tiff'))
+    os.makedirs(str(tmp_path / 'empty'))
+    assert expand_inputs([str(tmp_path / 'missing*.tiff'), str(tmp_path / 'empty'), one]) == [one]
+    out = capsys.readouterr().out
+    assert out.count('No files match') == 2 and 'missing*.tiff' in out
+
+
+def test_cli_fails_when_nothing_matches(tmp_path):
+    r = run_batch(str(tmp_path / '*.tiff'), '--export', tmp_path / 'out')
+    assert r.returncode == 2
+    assert 'no tiff volumes found' in r.stderr
+    assert not os.path.exists(str(tmp_path / 'out'))
+
+
+def test_cli_needs_something_to_do(tmp_path):
+    r = run_batch(str(tmp_path / '*.tiff'))
+    assert r.returncode == 2 and 'nothing to do' in r.stderr
+
+
+def test_cli_exports_every_volume_of_a_directory(tmp_path):
+    stacks = tmp_path / 'stacks'
+    os.makedirs(str(stacks))
+    for name in ('first', 'second'):
+        write_stack(str(stacks / (name + '.tiff')))
+    r = run_batch(stacks, '--export', tmp_path / 'out', '--planes', 'xz', '--workers', 2)
+    assert r.returncode == 0, r.stderr
+    assert 'Done: 2 volumes (0 failed)' in r.stdout
+    for name in ('first', 'second'):
+        assert sorted(os.listdir(str(tmp_path / 'out' / name / 'image'))) == ['0.png', '1.png', '2.png', '3.png']
@@ -0,0 +1,84 @@
+import os
+import pickle
+
+import numpy as np
+
+from AnnotationSpace3D import AnnotationSpace3D
+from chunkstore import ChunkStore, chunk_grid, chunks_in_region
+
+SHAPE = (10, 40, 50)
+RED, GREEN = [255, 0, 0, 255], [0, 255, 0, 255]
+
+
+def test_chunks_in_region_edges():
+    assert chunk_grid(SHAPE, (4, 16, 16)) == (3, 3, 4)
+    assert chunks_in_region((0, 1, 15, 17, 0, 1), SHAPE, (4, 16, 16)) == [(0, 0, 0), (0, 1, 0)]
+    assert chunks_in_region((9, 20, 39, 99, 49, 60), SHAPE, (4, 16, 16)) == [(2, 2, 3)] # clipped to the volume
+    assert chunks_in_region((3, 3, 0, 40, 0, 50), SHAPE, (4, 16, 16)) == [] # empty box
+
+
+def test_store_round_trip_keeps_only_non_empty_chunks(tmp_path):
+    volume = np.zeros(SHAPE, np.uint8)
+    volume[9, 39, 49] = 7 # partial chunk in the far corner
+    volume[0:2, 0:3, 0:3] = 1
+    store = ChunkStore.create(str(tmp_path / 's'), SHAPE, np.uint8, (4, 16, 16), attrs={'note': 'x'})
+    store.write_volume(volume)
+    store = ChunkStore.open(str(tmp_path / 's' / 'manifest.json')) # the manifest file is accepted too
+    assert store.chunks == {(0, 0, 0), (2, 2, 3)}
+    assert store.attrs == {'note': 'x'}
+    assert np.array_equal(store.read_region(tuple(slice(0, s) for s in SHAPE)), volume)
+    assert np.array_equal(store.read_region((slice(8, 10), slice(30, 40), slice(45, 50))), volume[8:10, 30:40, 45:50])
+    assert not store.read_chunk((1, 1, 1)).any()
+
+
+def annotation_space():
+    annot = AnnotationSpace3D(np.zeros(SHAPE, np.uint8), SHAPE, RED)
+    annot.chunk_shape = (4, 16, 16)
+    return annot
+
+
+def test_save_load_round_trip_with_palette(tmp_path):
+    annot = annotation_space()
+    annot.draw_stroke('xy', 2, [(5, 5), (20, 30)], 3, 1, RED)
+    annot.draw_stroke('xz', 7, [(1, 1), (8, 40)], 2, 1, GREEN)
+    path = str(tmp_path / 'annotations')
+    annot.save(path)
+    assert annot.dirty_chunks == set()
+
+    loaded = annotation_space()
+    loaded.load(path)
+    assert np.array_equal(loaded.npspace, annot.npspace)
+    assert np.array_equal(loaded.get_palette(), annot.get_palette())
+    assert loaded.dirty_chunks == set() and loaded.store_path == os.path.abspath(path)
+
+
+def test_saving_again_rewrites_only_dirty_chunks(tmp_path):
+    annot = annotation_space()
+    annot.draw_stroke('xy', 0, [(2, 2)], 2, 1, RED)
+    annot.draw_stroke('xy', 9, [(45, 35)], 2, 1, RED)
+    path = str(tmp_path / 'annotations')
+    annot.save(path)
+    store = ChunkStore.open(path)
+    untouched = store.chunk_file((0, 0, 0))
+    os.utime(untouched, (0, 0))
+    annot.draw_stroke('xy', 9, [(40, 37)], 2, 1, GREEN)
+    assert annot.dirty_chunks == {(2, 2, 2)}
+    annot.save(path)
+    assert os.path.getmtime(untouched) == 0
+    loaded = annotation_space()
+    loaded.load(path)
+    assert np.array_equal(loaded.npspace, annot.npspace)
+
+
+def test_legacy_rgba_pickle_is_converted(tmp_path):
+    rgba = np.zeros(SHAPE + (4,), np.uint8)
+    rgba[1, 2, 3] = RED
+    rgba[4, 5, 6] = GREEN
+    path = str(tmp_path / 'old.pkl')
+    with open(path, 'wb') as f:
+        pickle.dump(rgba, f)
+    annot = annotation_space()
+    annot.load(path)
+    assert annot.npspace[1, 2, 3] != annot.npspace[4, 5, 6]
+    assert np.array_equal(annot.get_palette()[annot.npspace[1, 2, 3]], RED)
+    assert np.count_nonzero(annot.npspace) == 2
@@ -0,0 +1,44 @@
+import threading
+
+import numpy as np
+
+from AnnotationSpace3D import AnnotationSpace3D
+
+SHAPE = (8, 64, 64)
+
+
+def annotation_space():
+    annot = AnnotationSpace3D(np.zeros(SHAPE, np.uint8), SHAPE, [255, 0, 0, 255])
+    annot.chunk_shape = (2, 8, 8)
+    return annot
+
+
+def test_take_dirty_returns_chunk_boxes_once():
+    annot = annotation_space()
+    annot.track_dirty('view')
+    annot.mark_dirty((0, 1, 0, 9, 0, 1))
+    assert annot.take_dirty('view') == [(0, 2, 0, 8, 0, 8), (0, 2, 8, 16, 0, 8)]
+    assert annot.take_dirty('view') == []
+    assert len(annot.dirty_chunks) == 2 # other trackers keep theirs
+
+
+def test_no_marks_lost_while_another_thread_takes():
+    annot = annotation_space()
+    annot.track_dirty('mesh')
+    marked = [(z, y, x) for z in range(4) for y in range(8) for x in range(8)]
+    taken = set()
+    done = threading.Event()
+
+    def take():
+        while not done.is_set():
+            taken.update(annot.take_dirty_chunks('mesh'))
+            annot.track_dirty('other') # registering trackers while marking must not break iteration
+
+    taker = threading.Thread(target=take)
+    taker.start()
+    for z, y, x in marked:
+        annot.mark_dirty((2*z, 2*z+1, 8*y, 8*y+1, 8*x, 8*x+1))
+    done.set()
+    taker.join()
+    taken.update(annot.take_dirty_chunks('mesh'))
+    assert taken == set(marked)
@@ -0,0 +1,43 @@
+import os
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from exporter import export_dataset
+
+SHAPE = (4, 5, 6) # z, y, x
+BASELINE = {'xy': lambda v, i: v[i], 'xz': lambda v, i: v[:, i, :], 'yz': lambda v, i: v[:, :, i]} # old exportProcess
+
+
+def volumes():
+    images = np.arange(np.prod(SHAPE), dtype=np.uint8).reshape(SHAPE)
+    labels = np.zeros(SHAPE, np.uint8)
+    labels[1, 2, 3] = 1
+    labels[2, 0:3, 4] = 2
+    return images, labels
+
+
+@pytest.mark.parametrize('workers', [0, 1])
+def test_png_layout_matches_the_old_export(tmp_path, workers):
+    images, labels = volumes()
+    planes = ('xy', 'xz', 'yz')
+    written = export_dataset(images, labels, str(tmp_path), planes=planes, workers=workers)
+    assert written == sum(SHAPE)
+    for axis, plane in enumerate(planes):
+        for i in range(SHAPE[axis]):
+            image = np.array(Image.open(os.path.join(tmp_path, plane, 'image', str(i) + '.png')))
+            label = np.array(Image.open(os.path.join(tmp_path, plane, 'label', str(i) + '.png')))
+            expected = BASELINE[plane](labels, i)
+            assert image.shape == label.shape == expected.shape
+            assert np.array_equal(image, BASELINE[plane](images, i))
+            assert np.array_equal(label, np.where(expected == 0, 255, expected - 1))
+
+
+def test_single_plane_keeps_the_old_directories(tmp_path):
+    images, labels = volumes()
+    export_dataset(images, labels, str(tmp_path), planes=('yz',), workers=0)
+    assert sorted(os.listdir(tmp_path)) == ['image', 'label']
+    image = np.array(Image.open(os.path.join(tmp_path, 'image', '0.png')))
+    assert image.shape == (SHAPE[0], SHAPE[1])
+    assert export_dataset(images, labels, str(tmp_path), planes=('yz',), workers=0) == 0 # resumed, nothing left
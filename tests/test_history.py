@@ -0,0 +1,55 @@
+import numpy as np
+
+from history import History
+
+
+def test_operation_is_one_sparse_undo_step():
+    volume = np.zeros((3, 100, 100), np.uint8)
+    history = History(tile_size=16)
+    history.begin()
+    for cs in (0, 2):
+        history.record(volume, 'xy', cs, 10, 20, 30, 90)
+        volume[cs, 10:20, 30:90] = 1
+    history.begin() # nested operations join the outer one
+    history.record(volume, 'xz', 50, 0, 3, 0, 5)
+    volume[0:3, 50, 0:5] = 2
+    history.end(volume)
+    assert not history.can_undo()
+    history.end(volume)
+
+    after = volume.copy()
+    deltas = history.undo(volume)
+    assert not volume.any()
+    assert sum(d.nbytes for d in deltas) < after.nbytes // 10 # only changed voxels are kept
+    history.redo(volume)
+    assert np.array_equal(volume, after)
+
+
+def test_budget_drops_oldest_steps_but_keeps_the_newest():
+    volume = np.zeros((1, 64, 64), np.uint8)
+    history = History(budget_bytes=1, tile_size=16)
+    for value in (1, 2):
+        history.begin()
+        history.record(volume, 'xy', 0, 0, 64, 0, 64)
+        volume[0] = value
+        history.end(volume)
+    assert len(history.undo_stack) == 1
+    history.undo(volume)
+    assert (volume == 1).all() and not history.can_undo()
+
+
+def test_new_edit_drops_redo():
+    volume = np.zeros((1, 8, 8), np.uint8)
+    history = History()
+    for value in (1, 2):
+        history.begin()
+        history.record(volume, 'xy', 0, 0, 8, 0, 8)
+        volume[0] = value
+        history.end(volume)
+    history.undo(volume)
+    history.begin()
+    history.record(volume, 'xy', 0, 0, 1, 0, 1)
+    volume[0, 0, 0] = 9
+    history.end(volume)
+    assert not history.can_redo()
+    assert history.nbytes == sum(e.nbytes for e in history.undo_stack)
@@ -0,0 +1,31 @@
+import numpy as np
+
+from inference import TiledPredictor, normalize_batch, tile_starts
+
+
+class FakeModel(): # position dependent output, so misplaced or misblended tiles show
+    input_shape = (None, None, None, 1)
+
+    def predict(self, batch, batch_size=None, verbose=0):
+        rows = np.arange(batch.shape[1], dtype=np.float32)[:, None, None]
+        cols = np.arange(batch.shape[2], dtype=np.float32)[None, :, None]
+        return np.tanh(batch * 0.7 + rows * 0.01 - cols * 0.002)
+
+
+def test_small_slides_match_the_old_single_padded_prediction():
+    rng = np.random.default_rng(0)
+    slides = normalize_batch(rng.integers(0, 255, (3, 25, 500)))
+    model = FakeModel()
+    padded = np.zeros((3, 32, 640, 1), np.float32) # old path: pad to the trained 32x640 input, crop [:25, :500]
+    padded[:, :25, :500, 0] = slides
+    expected = model.predict(padded)[:, :25, :500, 0]
+    assert np.array_equal(TiledPredictor(model).predict(slides), expected)
+
+
+def test_tiles_cover_large_slides():
+    assert tile_starts(100, 32, 8) == [0, 24, 48, 68]
+    assert tile_starts(20, 32, 8) == [0]
+    rng = np.random.default_rng(1)
+    slides = normalize_batch(rng.integers(0, 255, (2, 70, 1500)))
+    out = TiledPredictor(FakeModel(), batch_size=5).predict(slides)
+    assert out.shape == slides.shape and np.isfinite(out).all()
@@ -0,0 +1,62 @@
+import threading
+
+import numpy as np
+
+from helpers import IntensityLUT, apply_brightness, apply_contrast
+
+
+def test_per_slice_tables_match_apply_contrast():
+    rng = np.random.default_rng(0)
+    volume = rng.integers(0, 4000, (3, 20, 30), dtype=np.uint16)
+    lut = IntensityLUT(volume, per_slice=True, max_slice_hists=2)
+    for z in (0, 1, 2, 0):
+        expected = apply_brightness(apply_contrast(volume[z], 2), 15)
+        assert np.array_equal(lut.apply(volume[z], 2, 15, key=('xy', z)), expected)
+    assert list(lut.slice_hists) == [('xy', 2), ('xy', 0)] # capped, least recently used evicted
+
+
+def test_concurrent_filtering_with_eviction():
+    rng = np.random.default_rng(1)
+    volume = rng.integers(0, 255, (16, 20, 20), dtype=np.uint8)
+    lut = IntensityLUT(volume, per_slice=True, max_luts=2, max_slice_hists=3)
+    errors = []
+
+    def work(seed):
+        r = np.random.default_rng(seed)
+        try:
+            for _ in range(300):
+                z, contrast = int(r.integers(16)), int(r.integers(1, 4))
+                lut.apply(volume[z], contrast, 10, key=('xy', z))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=work, args=(i,)) for i in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert errors == []
+    assert len(lut.luts) <= 2 and len(lut.slice_hists) <= 3
+
+
+def test_background_histogram_falls_back_until_ready():
+    rng = np.random.default_rng(2)
+    volume = rng.integers(0, 4000, (4, 20, 30), dtype=np.uint16)
+    counted = threading.Event()
+    release = threading.Event()
+    original = IntensityLUT._count
+    def slow_count(self, npimages): # hold the count back until the fallback was checked
+        release.wait()
+        original(self, npimages)
+    IntensityLUT._count = slow_count
+    try:
+        lut = IntensityLUT(volume, background=True, on_ready=counted.set)
+        assert not lut.ready
+        expected = apply_brightness(apply_contrast(volume[1], 2), 15)
+        assert np.array_equal(lut.apply(volume[1], 2, 15), expected)
+        release.set()
+        assert counted.wait(5) and lut.ready
+    finally:
+        IntensityLUT._count = original
+    eager = IntensityLUT(volume)
+    assert np.array_equal(lut.apply(volume[1], 2, 15), eager.apply(volume[1], 2, 15))
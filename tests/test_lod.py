@@ -0,0 +1,30 @@
+import numpy as np
+
+from lod import LODPyramid, downsample, reduce_blocks
+
+
+def brute(arr, f, reduce):
+    out = np.zeros(tuple(-(-s // f) for s in arr.shape), np.float32)
+    for idx in np.ndindex(out.shape):
+        block = arr[tuple(slice(i * f, (i + 1) * f) for i in idx)]
+        out[idx] = block.max() if reduce == 'max' else block.mean()
+    return out
+
+
+def test_reduce_blocks_with_partial_edges():
+    arr = np.random.default_rng(0).integers(0, 255, (5, 7, 9), dtype=np.uint8)
+    assert np.array_equal(reduce_blocks(arr, 2, 'max'), brute(arr, 2, 'max'))
+    assert np.allclose(reduce_blocks(arr, 4, 'mean'), brute(arr, 4, 'mean'))
+    assert np.allclose(downsample(arr, 2, 'mean'), brute(arr, 2, 'mean'))
+
+
+def test_pyramid_update_matches_a_rebuild():
+    volume = np.zeros((16, 20, 24), np.uint8)
+    pyramid = LODPyramid(volume, 'max')
+    assert pyramid.level(0) is volume
+    assert pyramid.level_for(volume.size // 8) == 1
+    coarse = [pyramid.level(k) for k in (1, 2)]
+    volume[9:11, 3:4, 17:23] = 5
+    pyramid.update((9, 11, 3, 4, 17, 23))
+    for k, arr in zip((1, 2), coarse):
+        assert np.array_equal(arr, LODPyramid(volume, 'max').level(k))
@@ -0,0 +1,29 @@
+import numpy as np
+import pytest
+
+from merge import required_votes, vote
+
+
+def test_required_votes():
+    assert required_votes('union', 3) is None
+    assert required_votes('intersection', 3) == 3
+    assert required_votes('majority', 4) == 3
+    assert required_votes('k-of-n', 4, 2) == 2
+    for mode, k in (('k-of-n', 0), ('k-of-n', 5), ('k-of-n', None), ('unknown', None)):
+        with pytest.raises(ValueError):
+            required_votes(mode, 4, k)
+
+
+def test_vote_modes():
+    a = np.array([1, 1, 0, 2, 0], np.uint8)
+    b = np.array([1, 2, 0, 2, 3], np.uint8)
+    c = np.array([0, 2, 1, 2, 0], np.uint8)
+    assert vote([a, b, c]).tolist() == [1, 2, 1, 2, 3] # union, later inputs win
+    assert vote([a, b, c], 3).tolist() == [0, 0, 0, 2, 0] # intersection
+    assert vote([a, b, c], 2).tolist() == [1, 2, 0, 2, 0] # majority
+    assert vote([a, b], 1).tolist() == [1, 1, 0, 2, 3] # ties keep the lower label
+
+
+def test_votes_are_counted_past_uint8():
+    chunks = [np.ones(4, np.uint8)] * 300
+    assert vote(chunks, 300).tolist() == [1, 1, 1, 1]
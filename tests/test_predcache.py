@@ -0,0 +1,26 @@
+import os
+
+import numpy as np
+
+from predcache import PredictionCache
+
+
+def test_disk_level_survives_a_new_cache(tmp_path):
+    img = np.arange(12, dtype=np.uint8).reshape(3, 4)
+    key = PredictionCache.key(img, 'unet:abc', 'xz', {'tile_shape': [32, 640]})
+    assert key != PredictionCache.key(img, 'unet:abd', 'xz', {'tile_shape': [32, 640]})
+    PredictionCache(directory=str(tmp_path)).put(key, np.full((3, 4), 0.5, np.float32))
+    assert np.array_equal(PredictionCache(directory=str(tmp_path)).get(key), np.full((3, 4), 0.5, np.float32))
+
+
+def test_file_pruned_between_read_and_touch(tmp_path, monkeypatch):
+    cache = PredictionCache(directory=str(tmp_path))
+    cache.put('k', np.zeros((2, 2), np.float32))
+    cache = PredictionCache(directory=str(tmp_path)) # empty memory level, reads from disk
+    load = np.load
+    def load_then_prune(path, *args, **kwargs):
+        data = load(path, *args, **kwargs)
+        os.remove(path)
+        return data
+    monkeypatch.setattr(np, 'load', load_then_prune)
+    assert cache.get('k').shape == (2, 2)
@@ -0,0 +1,107 @@
+import queue
+import threading
+
+import numpy as np
+import pytest
+
+from predict_jobs import PredictionJob, PredictionScheduler
+
+TIMEOUT = 5
+
+
+class Recorder():
+    ''' scheduler whose model fills every slide with its index, the first run can be held at a gate '''
+
+    def __init__(self, run_size=8, hold=False):
+        self.gate = threading.Event()
+        if not hold:
+            self.gate.set()
+        self.started = threading.Event()
+        self.predicted = [] # (plane, start, stop) in order
+        self.ready = [] # (job id, plane, slide, value)
+        self.finished = queue.Queue()
+        self.scheduler = PredictionScheduler(self.predict, self.on_ready, on_finished=self.finished.put, run_size=run_size)
+
+    def predict(self, plane, start, stop):
+        self.started.set()
+        assert self.gate.wait(TIMEOUT)
+        self.predicted.append((plane, start, stop))
+        return np.arange(start, stop, dtype=np.float32)[:, None, None] * np.ones((1, 2, 3), np.float32)
+
+    def on_ready(self, job, plane, start, output):
+        for k, slide in enumerate(output):
+            assert (slide == slide.flat[0]).all()
+            self.ready.append((job.id, plane, start + k, int(slide.flat[0])))
+
+    def wait(self, jobs):
+        ids = {job.id for job in jobs}
+        while ids:
+            ids.discard(self.finished.get(timeout=TIMEOUT).id)
+
+
+@pytest.fixture
+def recorder():
+    r = Recorder(run_size=2)
+    yield r
+    r.scheduler.shutdown()
+
+
+@pytest.fixture
+def held():
+    r = Recorder(run_size=2, hold=True)
+    yield r
+    r.gate.set()
+    r.scheduler.shutdown()
+
+
+def test_runs_split_at_gaps_and_size():
+    assert list(PredictionJob(1, 'xz', [0, 1, 2, 4, 5, 9]).runs(2)) == [(0, 2), (2, 3), (4, 6), (9, 10)]
+    assert list(PredictionJob(1, 'xz', [0, 1, 2]).runs(8, [1, 2])) == [(1, 3)]
+
+
+def test_results_come_back_for_the_right_slides(recorder):
+    xz = recorder.scheduler.submit('xz', 3, 8)
+    xy = recorder.scheduler.submit('xy', 3, 5) # same slide numbers, other plane
+    recorder.wait([xz, xy])
+    assert recorder.predicted == [('xz', 3, 5), ('xz', 5, 7), ('xz', 7, 8), ('xy', 3, 5)]
+    assert recorder.ready == [(xz.id, 'xz', i, i) for i in range(3, 8)] + [(xy.id, 'xy', i, i) for i in (3, 4)]
+    assert xz.done == 5 and xy.done == 2
+    assert recorder.scheduler.pending == {} and recorder.scheduler.running == set()
+
+
+def test_newer_request_replaces_a_queued_one(held):
+    blocker = held.scheduler.submit('xz', 0, 1)
+    assert held.started.wait(TIMEOUT) # the worker is busy with slide 0
+    older = held.scheduler.submit('xz', 1, 5)
+    newer = held.scheduler.submit('xz', 2, 4)
+    assert [held.scheduler.pending[('xz', i)] for i in range(1, 5)] == [older.id, newer.id, newer.id, older.id]
+
+    held.gate.set()
+    held.wait([blocker, older, newer])
+    assert held.predicted == [('xz', 0, 1), ('xz', 1, 2), ('xz', 4, 5), ('xz', 2, 4)] # every slide once
+    assert sorted(r for r in held.ready if r[0] == newer.id) == [(newer.id, 'xz', 2, 2), (newer.id, 'xz', 3, 3)]
+    assert sorted(r for r in held.ready if r[0] == older.id) == [(older.id, 'xz', 1, 1), (older.id, 'xz', 4, 4)]
+
+
+def test_slides_being_predicted_are_not_queued_again(held):
+    running = held.scheduler.submit('xz', 0, 2)
+    assert held.started.wait(TIMEOUT)
+    assert held.scheduler.submit('xz', 0, 2) is None
+    later = held.scheduler.submit('xz', 1, 3)
+    assert later.indices == [2]
+    held.gate.set()
+    held.wait([running, later])
+    assert held.predicted == [('xz', 0, 2), ('xz', 2, 3)]
+
+
+def test_request_after_a_cancel_is_predicted(held):
+    blocker = held.scheduler.submit('xz', 0, 1)
+    assert held.started.wait(TIMEOUT)
+    cancelled = held.scheduler.submit('xz', 5, 7)
+    held.scheduler.cancel(cancelled.id)
+    again = held.scheduler.submit('xz', 5, 7) # the cancelled job is still queued
+    assert again is not None
+    held.gate.set()
+    held.wait([blocker, cancelled, again])
+    assert held.predicted == [('xz', 0, 1), ('xz', 5, 7)]
+    assert [r[0] for r in held.ready if r[2] in (5, 6)] == [again.id, again.id]
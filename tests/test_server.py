@@ -0,0 +1,127 @@
+import threading
+import urllib.request
+
+import numpy as np
+import pytest
+
+from server import DynamicBatcher, PredictionServer
+from wire import BATCH_API, CONTENT_TYPE, decode_array, encode_array
+
+CLIENTS = 6
+TIMEOUT = 5
+
+
+class RecordingModel():
+    ''' model stand-in that doubles its input and records the batch of every call '''
+
+    def __init__(self, fail=False):
+        self.calls = []
+        self.fail = fail
+        self.lock = threading.Lock()
+
+    def __call__(self, imgs):
+        with self.lock:
+            self.calls.append(imgs.copy())
+        if self.fail:
+            raise RuntimeError('model failed')
+        return imgs.astype(np.float32) * 2
+
+
+def client_slides(k, n=2, shape=(4, 5)): # distinct values per client and slide
+    return np.arange(n * shape[0] * shape[1], dtype=np.float32).reshape((n,) + shape) + 1000 * k
+
+
+def concurrently(fn, n=CLIENTS):
+    ''' call fn(k) for k < n from n threads released together, returns the results in order of k '''
+    barrier = threading.Barrier(n)
+    results = [None] * n
+    errors = []
+
+    def run(k):
+        barrier.wait()
+        try:
+            results[k] = fn(k)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run, args=(k,)) for k in range(n)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(TIMEOUT)
+    if errors:
+        raise errors[0]
+    return results
+
+
+def test_concurrent_requests_share_one_model_call():
+    model = RecordingModel()
+    # the batch closes once every client's slides joined it, long before the deadline
+    batcher = DynamicBatcher(model, max_batch=CLIENTS * 2, max_delay=TIMEOUT)
+    results = concurrently(lambda k: batcher.submit(client_slides(k)).result(TIMEOUT))
+
+    assert len(model.calls) == 1 and len(model.calls[0]) == CLIENTS * 2
+    for k, out in enumerate(results):
+        assert out.dtype == np.float32
+        assert np.array_equal(out, client_slides(k) * 2) # each caller gets its own slides back, in order
+    stats = batcher.stats()
+    assert stats['requests'] == CLIENTS and stats['slides'] == CLIENTS * 2
+    assert stats['batches'] == 1 and stats['model_calls'] == 1
+
+
+def test_batches_are_bounded_by_size():
+    model = RecordingModel()
+    batcher = DynamicBatcher(model, max_batch=4, max_delay=TIMEOUT)
+    results = concurrently(lambda k: batcher.submit(client_slides(k)).result(TIMEOUT), n=4)
+    assert sorted(len(c) for c in model.calls) == [4, 4]
+    for k, out in enumerate(results):
+        assert np.array_equal(out, client_slides(k) * 2)
+
+
+def test_slides_of_different_sizes_get_one_call_per_size():
+    model = RecordingModel()
+    batcher = DynamicBatcher(model, max_batch=4, max_delay=TIMEOUT)
+    shapes = [(4, 5), (6, 3), (4, 5), (6, 3)]
+    results = concurrently(lambda k: batcher.submit(client_slides(k, 1, shapes[k])).result(TIMEOUT), n=4)
+    assert sorted(c.shape for c in model.calls) == [(2, 4, 5), (2, 6, 3)]
+    assert batcher.stats()['model_calls'] == 2 and batcher.stats()['batches'] == 1
+    for k, out in enumerate(results):
+        assert np.array_equal(out, client_slides(k, 1, shapes[k]) * 2)
+
+
+def test_a_lone_request_waits_at_most_the_deadline():
+    batcher = DynamicBatcher(RecordingModel(), max_batch=16, max_delay=0.01)
+    assert np.array_equal(batcher.predict(client_slides(0)), client_slides(0) * 2)
+    assert np.array_equal(batcher.predict(client_slides(0, 0)), client_slides(0, 0))
+
+
+def test_model_errors_reach_every_caller_of_the_batch():
+    batcher = DynamicBatcher(RecordingModel(fail=True), max_batch=CLIENTS * 2, max_delay=TIMEOUT)
+    futures = concurrently(lambda k: batcher.submit(client_slides(k)))
+    for future in futures:
+        with pytest.raises(RuntimeError):
+            future.result(TIMEOUT)
+    assert batcher.stats()['errors'] == 1
+
+
+def test_concurrent_http_clients_are_batched():
+    model = RecordingModel()
+    server = PredictionServer(('127.0.0.1', 0), model, max_batch=CLIENTS * 2, max_delay=TIMEOUT)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    url = 'http://127.0.0.1:%d%s' % (server.server_address[1], BATCH_API)
+
+    def post(k):
+        request = urllib.request.Request(url, encode_array(client_slides(k), compress=k % 2 == 0),
+                                         {'Content-Type': CONTENT_TYPE})
+        with urllib.request.urlopen(request, timeout=TIMEOUT) as response:
+            return decode_array(response.read())
+
+    try:
+        results = concurrently(post)
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert len(model.calls) == 1
+    for k, out in enumerate(results):
+        assert np.array_equal(out, client_slides(k) * 2)
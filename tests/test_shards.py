@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+
+from shards import ShardReader, patch_origins, write_shards
+
+
+def volume(shape=(6, 20, 24), seed=0):
+    rng = np.random.default_rng(seed)
+    images = rng.integers(0, 255, shape, dtype=np.uint8)
+    labels = np.zeros(shape, np.uint8)
+    labels[:, 3, 2:9] = 1 # every xz slide 3 annotated
+    labels[1:3, 10:12, :] = 2 # xz slides 10 and 11
+    return images, labels
+
+
+@pytest.mark.parametrize('compress', [False, True])
+def test_write_read_round_trip(tmp_path, compress):
+    images, labels = volume()
+    count = write_shards(images, labels, str(tmp_path), planes=('xz', 'xy'), shard_bytes=400, compress=compress)
+    reader = ShardReader(str(tmp_path))
+    assert len(reader) == count == 3 + 6
+    seen = 0
+    for k, shard in enumerate(reader.shards):
+        shard_images, shard_labels = reader.arrays(k)
+        for (slide, r, c), image, label in zip(shard['items'], shard_images, shard_labels):
+            axis = {'xy': 0, 'xz': 1}[shard['plane']]
+            assert np.array_equal(image, np.take(images, slide, axis=axis))
+            assert np.array_equal(label, np.take(labels, slide, axis=axis))
+            seen += 1
+    assert seen == count
+
+
+def test_batches_are_training_pairs(tmp_path):
+    images, labels = volume()
+    write_shards(images, labels, str(tmp_path), planes=('xz',))
+    x, y = next(ShardReader(str(tmp_path)).batches(batch_size=2, shuffle=False))
+    assert x.shape == (2, 6, 24, 1) and y.shape == (2, 6, 24, 1)
+    assert set(np.unique(y)) <= {0.0, 1.0} # 0 on annotations
+
+
+def test_patches_cover_edges_and_skip_empty(tmp_path):
+    assert patch_origins((10, 7), (4, 4), (4, 4)) == [(0, 0), (0, 3), (4, 0), (4, 3), (6, 0), (6, 3)]
+    images, labels = volume()
+    count = write_shards(images, labels, str(tmp_path), planes=('xz',), patch=(4, 8))
+    for k, shard in enumerate(ShardReader(str(tmp_path)).shards):
+        assert shard['shape'] == [4, 8]
+    assert count > 0
+
+
+@pytest.mark.parametrize('shuffle', [False, True])
+def test_each_shard_opened_once_per_epoch(tmp_path, shuffle):
+    images, labels = volume()
+    write_shards(images, labels, str(tmp_path), planes=('xz', 'xy'), shard_bytes=300, compress=True)
+    reader = ShardReader(str(tmp_path))
+    assert len(reader.shards) > 2
+    opened = []
+    arrays = reader.arrays
+    reader.arrays = lambda k: opened.append(k) or arrays(k)
+    batches = list(reader.batches(batch_size=1, shuffle=shuffle, seed=3))
+    assert len(batches) == len(reader)
+    assert sorted(opened) == list(range(len(reader.shards)))
@@ -0,0 +1,89 @@
+import numpy as np
+import pytest
+
+from AnnotationSpace3D import AnnotationSpace3D
+from helpers import disk, plane_slice, stroke_mask
+
+SHAPE = (20, 30)
+STEP = 0.05 # spacing of the dense stamps along each segment
+
+
+def as_full(stroke, shape=SHAPE): # stroke_mask result painted onto a full slice
+    full = np.zeros(shape, bool)
+    if stroke is not None:
+        r0, c0, mask = stroke
+        full[r0:r0 + mask.shape[0], c0:c0 + mask.shape[1]] = mask
+    return full
+
+
+def stamps(points, radius, shape=SHAPE): # the old way: one disk per point
+    full = np.zeros(shape, bool)
+    for p in points:
+        full[disk(p, radius, shape=shape)] = True
+    return full
+
+
+def dense_stamps(points, radius, shape=SHAPE):
+    dense = [points[0]]
+    for a, b in zip(points[:-1], points[1:]):
+        n = max(int(np.ceil(np.hypot(b[0] - a[0], b[1] - a[1]) / STEP)), 1)
+        dense += [tuple(np.add(a, np.subtract(b, a) * k / n)) for k in range(1, n + 1)]
+    return stamps(dense, radius, shape)
+
+
+@pytest.mark.parametrize('point', [(10, 15), (10.4, 15.7), (0, 0), (19, 29), (-2, 5)])
+@pytest.mark.parametrize('radius', [1, 2.5, 4])
+def test_single_point_is_a_disk(point, radius):
+    assert np.array_equal(as_full(stroke_mask([point], radius, SHAPE)), stamps([point], radius))
+
+
+STROKES = {
+    'line': [(5, 5), (14, 22)],
+    'polyline': [(3, 4), (3, 20), (12.5, 20.5), (16, 8)],
+    'repeated point': [(8, 8), (8, 8), (8, 8)],
+    'clipped at the top left': [(-3, 5), (6, -4)],
+    'clipped at the bottom right': [(17, 25), (24, 34)],
+    'crossing the slice': [(-5, 10), (25, 18)],
+}
+
+
+@pytest.mark.parametrize('points', STROKES.values(), ids=STROKES.keys())
+@pytest.mark.parametrize('radius', [1, 3])
+def test_capsules_cover_the_stamps_and_nothing_more(points, radius):
+    capsule = as_full(stroke_mask(points, radius, SHAPE))
+    assert not (stamps(points, radius) & ~capsule).any() # every point, endpoints included
+    assert not (dense_stamps(points, radius) & ~capsule).any()
+    assert not (capsule & ~dense_stamps(points, radius + STEP / 2)).any()
+
+
+@pytest.mark.parametrize('points', STROKES.values(), ids=STROKES.keys())
+def test_clipping_matches_an_unclipped_slice(points):
+    pad = 10
+    shifted = [(r + pad, c + pad) for r, c in points]
+    unclipped = as_full(stroke_mask(shifted, 3, (SHAPE[0] + 2 * pad, SHAPE[1] + 2 * pad)),
+                        (SHAPE[0] + 2 * pad, SHAPE[1] + 2 * pad))
+    assert np.array_equal(as_full(stroke_mask(points, 3, SHAPE)), unclipped[pad:-pad, pad:-pad])
+
+
+def test_stroke_outside_the_slice():
+    assert stroke_mask([(-10, -10), (-10, 40)], 3, SHAPE) is None
+    assert stroke_mask([(30, 5)], 3, SHAPE) is None
+
+
+@pytest.mark.parametrize('plane', ['xy', 'xz', 'yz'])
+def test_draw_stroke_paints_the_capsule_on_every_plane(plane):
+    dim = (12, 16, 20)
+    annot = AnnotationSpace3D(np.zeros(dim, np.uint8), dim, [255, 0, 0, 255])
+    points = [(-2, 3), (9, 7), (14, 11)] # (x, y) as the canvas passes them, the first one off the slice
+    box = annot.draw_stroke(plane, 4, points, 2, 1, [255, 0, 0, 255])
+    view = plane_slice(annot.npspace, plane, 4)
+    expected = as_full(stroke_mask([(y, x) for x, y in points], 2, view.shape), view.shape)
+    assert np.array_equal(view != 0, expected)
+    assert (view[expected] == annot.label_for_color([255, 0, 0, 255])).all()
+    rows, cols = np.nonzero(expected)
+    r0, r1, c0, c1 = box
+    assert r0 <= rows.min() and rows.max() < r1 and c0 <= cols.min() and cols.max() < c1
+    assert np.count_nonzero(annot.npspace) == np.count_nonzero(expected) # nothing outside the slide
+
+    annot.draw_stroke(plane, 4, points, 2, 0, [0, 0, 0, 0]) # erasing the same stroke clears it
+    assert not annot.npspace.any()
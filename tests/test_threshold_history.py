@@ -0,0 +1,62 @@
+import numpy as np
+
+from AnnotationSpace3D import AnnotationSpace3D
+
+SHAPE = (4, 6, 10)
+
+
+def predicted_space():
+    annot = AnnotationSpace3D(np.zeros(SHAPE, np.uint8), SHAPE, [255, 0, 0, 255])
+    probs = np.tile(np.linspace(0.0, 1.0, SHAPE[2], dtype=np.float32), (2, SHAPE[0], 1)) # two xz slides
+    annot.apply_prediction('xz', 1, probs)
+    return annot
+
+
+def test_redone_prediction_follows_the_threshold():
+    annot = predicted_space()
+    annot.set_threshold(0.5)
+    predicted = annot.npspace.copy()
+    annot.undo_history() # threshold change
+    annot.undo_history() # prediction
+    assert not annot.npspace.any()
+    annot.redo_history()
+    annot.redo_history()
+    assert np.array_equal(annot.npspace, predicted)
+    annot.set_threshold(0.3)
+    assert annot.npspace[:, 1, :].sum() < predicted[:, 1, :].sum() # re-thresholded, not frozen
+    assert annot.npspace[:, 1, :].any()
+
+
+def test_undone_prediction_is_not_rethresholded():
+    annot = predicted_space()
+    annot.undo_history()
+    annot.set_threshold(0.95)
+    assert not annot.npspace.any()
+
+
+def test_hand_edits_win_over_predictions():
+    annot = predicted_space()
+    annot.begin_operation()
+    annot.draw_stroke('xz', 1, [(0, 0), (3, 0)], 1, 0, [0, 0, 0, 0]) # erase along the first row
+    annot.end_operation()
+    assert (annot.npspace[0, 1, 0:4] == 0).all()
+    annot.set_threshold(0.95)
+    assert (annot.npspace[0, 1, 0:4] == 0).all()
+    assert annot.npspace[1:, 1, 0:4].all() # the rest of the prediction still follows the threshold
+
+
+def test_undone_threshold_change_keeps_probabilities():
+    annot = predicted_space()
+    initial = annot.npspace.copy()
+    annot.set_threshold(0.3)
+    annot.undo_history()
+    assert np.array_equal(annot.npspace, initial)
+    annot.set_threshold(0.5)
+    assert annot.npspace[:, 1, :].sum() < initial[:, 1, :].sum()
+
+
+def test_attached_info_counts_against_the_budget():
+    annot = predicted_space()
+    entry = annot.history.undo_stack[-1]
+    assert entry.info['probabilities'] == 'stored' and entry.info_bytes > 0
+    assert annot.history.nbytes == entry.nbytes
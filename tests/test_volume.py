@@ -0,0 +1,83 @@
+import pickle
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from volume import TiffVolume
+
+SHAPE = (5, 7, 9) # z, y, x
+
+
+def read_stack(path): # the old read_tiff: decode every page with PIL and stack them
+    img = Image.open(path)
+    xy = []
+    for i in range(img.n_frames):
+        img.seek(i)
+        xy.append(np.array(img))
+    return np.array(xy)
+
+
+def write_stack(path, dtype, compression=None):
+    data = np.arange(np.prod(SHAPE)).reshape(SHAPE).astype(dtype)
+    pages = [Image.fromarray(page) for page in data]
+    options = {} if compression is None else {'compression': compression}
+    pages[0].save(path, save_all=True, append_images=pages[1:], **options)
+    return data
+
+
+@pytest.fixture(params=[(np.uint8, None), (np.uint16, None), (np.uint8, 'packbits')],
+                ids=['uint8', 'uint16', 'packbits'])
+def stack(request, tmp_path):
+    dtype, compression = request.param
+    path = str(tmp_path / 'stack.tiff')
+    write_stack(path, dtype, compression)
+    return path, compression is None
+
+
+def test_matches_the_decoded_stack(stack):
+    path, memmapped = stack
+    expected = read_stack(path)
+    vol = TiffVolume(path)
+    assert vol.is_memmapped == memmapped
+    assert vol.shape == expected.shape and vol.dtype == expected.dtype and len(vol) == SHAPE[0]
+    assert np.array_equal(np.asarray(vol), expected)
+    for cs in range(SHAPE[0]):
+        assert np.array_equal(vol[cs], expected[cs])
+    for cs in range(SHAPE[1]):
+        assert np.array_equal(vol[:, cs, :], expected[:, cs, :])
+    for cs in range(SHAPE[2]):
+        assert np.array_equal(vol[:, :, cs], expected[:, :, cs])
+    assert np.array_equal(vol[1:4, 2:5, 3:8], expected[1:4, 2:5, 3:8])
+    assert np.array_equal(vol[..., 2], expected[..., 2])
+
+
+def test_negative_indices(stack):
+    path, _ = stack
+    expected = read_stack(path)
+    vol = TiffVolume(path)
+    assert np.array_equal(vol[-1], expected[-1])
+    assert np.array_equal(vol.page(-2), expected[-2])
+    assert np.array_equal(vol[:, -1, :], expected[:, -1, :])
+    assert np.array_equal(vol[:, :, -3], expected[:, :, -3])
+    assert np.array_equal(vol[-2:, -3, -4:], expected[-2:, -3, -4:])
+
+
+def test_pickle_reopens_the_file(stack):
+    path, memmapped = stack
+    vol = TiffVolume(path, cache_pages=2)
+    vol[0] # fill the page cache, which must not be pickled
+    data = pickle.dumps(vol)
+    assert len(data) < 1000
+    copy = pickle.loads(data)
+    assert copy.path == path and copy.cache_pages == 2 and copy.is_memmapped == memmapped
+    assert np.array_equal(np.asarray(copy), read_stack(path))
+
+
+def test_decoded_pages_are_cached_up_to_the_limit(tmp_path):
+    path = str(tmp_path / 'stack.tiff')
+    write_stack(path, np.uint8, 'packbits')
+    vol = TiffVolume(path, cache_pages=2)
+    for cs in range(SHAPE[0]):
+        vol[cs]
+    assert list(vol._cache) == [SHAPE[0] - 2, SHAPE[0] - 1]
@@ -0,0 +1,33 @@
+import numpy as np
+import pytest
+
+from wire import decode_array, encode_array, is_compressed, output_to_probabilities
+
+
+@pytest.mark.parametrize('compress', [False, True])
+@pytest.mark.parametrize('arr', [
+    np.arange(2 * 3 * 5, dtype=np.uint16).reshape(2, 3, 5),
+    np.linspace(0, 1, 12, dtype=np.float32).reshape(3, 4),
+    np.zeros((0, 7), np.uint8),
+    np.arange(6, dtype='>i4').reshape(2, 3), # big endian goes over the wire as little endian
+    np.arange(24, dtype=np.float64).reshape(2, 3, 4)[:, ::2, 1:], # non contiguous
+])
+def test_round_trip(arr, compress):
+    payload = encode_array(arr, compress=compress)
+    assert is_compressed(payload) == compress
+    out = decode_array(payload)
+    assert out.shape == arr.shape
+    assert np.array_equal(out, arr)
+
+
+def test_rejects_foreign_payloads():
+    payload = bytearray(encode_array(np.zeros(3)))
+    payload[:4] = b'NOPE'
+    with pytest.raises(ValueError):
+        decode_array(bytes(payload))
+
+
+def test_output_to_probabilities():
+    probs = np.array([0.2, 0.9], np.float32)
+    assert output_to_probabilities(probs) is probs
+    assert np.array_equal(output_to_probabilities(np.array([1, 0], np.uint8)), [0.0, 1.0]) # annotations are low
@@ -0,0 +1,244 @@
+import struct
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from PIL import Image
+
+# tiff tags used to decide whether a page can be memory-mapped
+TAG_WIDTH = 256
+TAG_LENGTH = 257
+TAG_BITS_PER_SAMPLE = 258
+TAG_COMPRESSION = 259
+TAG_PHOTOMETRIC = 262
+TAG_STRIP_OFFSETS = 273
+TAG_SAMPLES_PER_PIXEL = 277
+TAG_STRIP_BYTE_COUNTS = 279
+TAG_PREDICTOR = 317
+TAG_TILE_WIDTH = 322
+TAG_SAMPLE_FORMAT = 339
+
+# tiff field type -> (struct format, size in bytes)
+FIELD_TYPES = {
+    1: ('B', 1), 2: ('c', 1), 3: ('H', 2), 4: ('I', 4), 5: ('II', 8),
+    6: ('b', 1), 7: ('B', 1), 8: ('h', 2), 9: ('i', 4), 10: ('ii', 8),
+    11: ('f', 4), 12: ('d', 8), 16: ('Q', 8), 17: ('q', 8), 18: ('Q', 8),
+}
+
+SAMPLE_KINDS = {1: 'u', 2: 'i', 3: 'f'} # SampleFormat -> numpy kind
+
+
+class TiffPage():
+    ''' geometry and raw data layout of a single tiff page (IFD) '''
+
+    def __init__(self, tags, byteorder):
+        self.tags = tags
+        self.shape = (tags[TAG_LENGTH][0], tags[TAG_WIDTH][0])
+        bits = tags.get(TAG_BITS_PER_SAMPLE, (1,))[0]
+        kind = SAMPLE_KINDS.get(tags.get(TAG_SAMPLE_FORMAT, (1,))[0], 'u')
+        self.dtype = None
+        if bits in (8, 16, 32, 64):
+            self.dtype = np.dtype(byteorder + kind + str(bits // 8))
+        self.offset = None # byte offset of the page data if it is one contiguous uncompressed block
+
+        if (self.dtype is None or tags.get(TAG_COMPRESSION, (1,))[0] != 1
+                or tags.get(TAG_SAMPLES_PER_PIXEL, (1,))[0] != 1
+                or tags.get(TAG_PHOTOMETRIC, (1,))[0] not in (1, 2) # MinIsWhite etc. are left to PIL
+                or tags.get(TAG_PREDICTOR, (1,))[0] != 1
+                or TAG_TILE_WIDTH in tags or TAG_STRIP_OFFSETS not in tags):
+            return
+
+        offsets = tags[TAG_STRIP_OFFSETS]
+        counts = tags.get(TAG_STRIP_BYTE_COUNTS, ())
+        if len(offsets) != len(counts):
+            return
+        for i in range(len(offsets)-1): # strips have to follow each other without gaps
+            if offsets[i] + counts[i] != offsets[i+1]:
+                return
+        if sum(counts) < self.shape[0] * self.shape[1] * self.dtype.itemsize:
+            return
+        self.offset = offsets[0]
+
+
+def read_tiff_pages(path):
+    ''' parse all IFDs of a classic or big tiff file without decoding any pixel data '''
+    pages = []
+    with open(path, 'rb') as f:
+        header = f.read(16)
+        byteorder = {b'II': '<', b'MM': '>'}.get(header[:2])
+        if byteorder is None:
+            raise ValueError('Not a TIFF file: ' + str(path))
+
+        version = struct.unpack(byteorder + 'H', header[2:4])[0]
+        if version == 42:
+            count_fmt, entry_size, value_fmt, value_size = 'H', 12, 'I', 4
+            ifd_offset = struct.unpack(byteorder + 'I', header[4:8])[0]
+        elif version == 43: # bigtiff
+            count_fmt, entry_size, value_fmt, value_size = 'Q', 20, 'Q', 8
+            ifd_offset = struct.unpack(byteorder + 'Q', header[8:16])[0]
+        else:
+            raise ValueError('Unsupported TIFF version %d: %s' % (version, path))
+
+        count_size = struct.calcsize(count_fmt)
+        visited = set()
+
+        while ifd_offset and ifd_offset not in visited:
+            visited.add(ifd_offset)
+            f.seek(ifd_offset)
+            n_entries = struct.unpack(byteorder + count_fmt, f.read(count_size))[0]
+            raw = f.read(n_entries * entry_size + value_size)
+            tags = {}
+
+            for i in range(n_entries):
+                entry = raw[i*entry_size:(i+1)*entry_size]
+                tag, ftype = struct.unpack(byteorder + 'HH', entry[:4])
+                count = struct.unpack(byteorder + value_fmt, entry[4:4+value_size])[0]
+                if ftype not in FIELD_TYPES:
+                    continue
+                fmt, size = FIELD_TYPES[ftype]
+                nbytes = size * count
+                if nbytes <= value_size: # value stored inline
+                    data = entry[4+value_size:4+value_size+nbytes]
+                else:
+                    pos = f.tell()
+                    f.seek(struct.unpack(byteorder + value_fmt, entry[4+value_size:])[0])
+                    data = f.read(nbytes)
+                    f.seek(pos)
+                if ftype == 2:
+                    tags[tag] = (data,)
+                else:
+                    tags[tag] = struct.unpack(byteorder + fmt[0] * (count * len(fmt)), data)
+
+            ifd_offset = struct.unpack(byteorder + value_fmt, raw[n_entries*entry_size:])[0]
+            pages.append(TiffPage(tags, byteorder))
+
+    return pages
+
+
+class TiffVolume():
+    ''' Read-only (z, y, x) view of a multi-page tiff stack.
+
+    Uncompressed pages are memory-mapped, anything else is decoded lazily page by page
+    with PIL and kept in a small LRU cache. Supports numpy style indexing, e.g.
+    volume[cs], volume[:, cs, :] and volume[:, :, cs], so it can be used in place of
+    the stacked array returned by read_tiff.
+    '''
+
+    def __init__(self, path, cache_pages=64):
+        self.path = path
+        self.cache_pages = cache_pages
+        self._pages = read_tiff_pages(path)
+        self._lock = threading.Lock()
+        self._cache = OrderedDict() # page index -> decoded np array
+        self._pil = None
+        self._mmap = None
+        self._array = None # single strided view when all pages are evenly laid out
+
+        if len(self._pages) == 0:
+            raise ValueError('TIFF file has no pages: ' + str(path))
+
+        first = self._pages[0]
+        if any(page.shape != first.shape for page in self._pages):
+            raise ValueError('TIFF pages differ in size: ' + str(path))
+
+        if all(page.offset is not None and page.dtype == first.dtype for page in self._pages):
+            self._mmap = np.memmap(path, dtype=np.uint8, mode='r')
+            self.dtype = first.dtype
+            steps = set(np.diff([page.offset for page in self._pages]).tolist())
+            if len(steps) <= 1 and all(step > 0 for step in steps):
+                step = steps.pop() if steps else first.shape[0] * first.shape[1] * first.dtype.itemsize
+                self._array = np.ndarray(
+                    (len(self._pages),) + first.shape, dtype=first.dtype, buffer=self._mmap,
+                    offset=first.offset, strides=(step, first.shape[1] * first.dtype.itemsize, first.dtype.itemsize)
+                )
+        else:
+            self.dtype = self._decode(0).dtype
+
+        self.shape = (len(self._pages),) + first.shape
+
+    @property
+    def ndim(self):
+        return 3
+
+    @property
+    def size(self):
+        return self.shape[0] * self.shape[1] * self.shape[2]
+
+    @property
+    def nbytes(self):
+        return self.size * self.dtype.itemsize
+
+    @property
+    def is_memmapped(self):
+        return self._mmap is not None
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None, copy=None):
+        arr = self[:]
+        return arr if dtype is None else arr.astype(dtype, copy=False)
+
+    def __getitem__(self, key):
+        if self._array is not None:
+            return self._array[key]
+
+        if not isinstance(key, tuple):
+            key = (key,)
+        if any(k is Ellipsis for k in key):
+            i = key.index(Ellipsis)
+            key = key[:i] + (slice(None),) * (4 - len(key)) + key[i+1:]
+
+        zkey, rest = key[0], key[1:]
+        if isinstance(zkey, (int, np.integer)):
+            return self.page(zkey)[rest]
+
+        indices = np.arange(self.shape[0])[zkey]
+        sub_shape = np.empty(self.shape[1:], dtype=np.bool_)[rest].shape
+        out = np.empty((len(indices),) + sub_shape, dtype=self.dtype)
+        for j, i in enumerate(indices):
+            out[j] = self.page(i)[rest]
+        return out
+
+    def __getstate__(self): # reopen from path in other processes instead of pickling the data
+        return {'path': self.path, 'cache_pages': self.cache_pages}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'], state['cache_pages'])
+
+    def page(self, i):
+        ''' full xy page i as a numpy array (memmap view or decoded copy) '''
+        if i < 0:
+            i += self.shape[0]
+        if self._array is not None:
+            return self._array[i]
+        if self._mmap is not None:
+            page = self._pages[i]
+            return np.ndarray(page.shape, dtype=page.dtype, buffer=self._mmap, offset=page.offset)
+
+        with self._lock:
+            if i in self._cache:
+                self._cache.move_to_end(i)
+                return self._cache[i]
+        arr = self._decode(i)
+        with self._lock:
+            self._cache[i] = arr
+            while len(self._cache) > self.cache_pages:
+                self._cache.popitem(last=False)
+        return arr
+
+    def _decode(self, i):
+        with self._lock:
+            if self._pil is None:
+                self._pil = Image.open(self.path)
+            self._pil.seek(i)
+            return np.array(self._pil)
+
+    def close(self):
+        with self._lock:
+            if self._pil is not None:
+                self._pil.close()
+                self._pil = None
+            self._cache.clear()
+        self._array = None
+        self._mmap = None
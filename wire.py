@@ -0,0 +1,128 @@
+import json
+import struct
+import zlib
+
+import numpy as np
+
+MAGIC = b'A3DW'
+WIRE_VERSION = 1
+CONTENT_TYPE = 'application/x-annot3d-array'
+FLAG_ZLIB = 1
+BATCH_API = '/predict_batch'
+JSON_API = '/predict_model'
+MAX_SLICES_PER_REQUEST = 16
+
+# magic, version, flags, ndim, dtype string length, then the dtype string and one uint32 per axis
+HEADER = struct.Struct('<4sBBBB')
+
+
+def encode_array(arr, compress=False, level=1):
+    ''' array -> bytes: small header with dtype and shape followed by the raw little-endian data, optionally zlib compressed '''
+    arr = np.asarray(arr)
+    dtype = arr.dtype.newbyteorder('<') if arr.dtype.byteorder == '>' else arr.dtype
+    data = np.ascontiguousarray(arr, dtype=dtype).tobytes()
+    flags = 0
+    if compress:
+        data = zlib.compress(data, level)
+        flags |= FLAG_ZLIB
+    descr = dtype.str.encode('ascii')
+    header = HEADER.pack(MAGIC, WIRE_VERSION, flags, arr.ndim, len(descr)) + descr
+    return header + struct.pack('<%dI' % arr.ndim, *arr.shape) + data
+
+
+def decode_array(payload):
+    ''' bytes from encode_array -> array (read-only when the payload was not compressed) '''
+    payload = memoryview(payload)
+    magic, version, flags, ndim, descr_len = HEADER.unpack_from(payload)
+    if magic != MAGIC or version != WIRE_VERSION:
+        raise ValueError('Not an annot3d array payload')
+    offset = HEADER.size
+    dtype = np.dtype(bytes(payload[offset:offset+descr_len]).decode('ascii'))
+    offset += descr_len
+    shape = struct.unpack_from('<%dI' % ndim, payload, offset)
+    offset += 4 * ndim
+    data = payload[offset:]
+    if flags & FLAG_ZLIB:
+        data = zlib.decompress(data)
+    return np.frombuffer(data, dtype=dtype).reshape(shape)
+
+
+def is_compressed(payload):
+    return HEADER.unpack_from(payload)[2] & FLAG_ZLIB != 0
+
+
+def output_to_probabilities(out):
+    ''' server output -> model-like probabilities: float outputs pass through, binary annotations (1) become 0 '''
+    if np.issubdtype(out.dtype, np.floating):
+        return out.astype(np.float32, copy=False)
+    return (out == 0).astype(np.float32)
+
+
+class PredictionClient():
+    ''' Talks to a prediction server over one pooled HTTP session.
+
+    Slides are sent in batches of up to max_slices per request as binary arrays to
+    /predict_batch. Servers that only know the old /predict_model JSON API are detected on
+    the first request and served one slide at a time from then on.
+    '''
+
+    def __init__(self, url, compress=True, max_slices=MAX_SLICES_PER_REQUEST, timeout=60, pool_size=4):
+        self.url = url.rstrip('/')
+        self.compress = compress
+        self.max_slices = max_slices
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.binary = True # switched off once the server turns out to lack the batch API
+        self._session = None
+
+    @property
+    def session(self): # created on first use, requests is only needed in server mode
+        if self._session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+            self._session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+            self._session.mount('http://', adapter)
+            self._session.mount('https://', adapter)
+        return self._session
+
+    def predict(self, imgs):
+        ''' (n, rows, cols) raw slides -> (n, rows, cols) float32 probabilities, None if the server failed '''
+        imgs = np.asarray(imgs)
+        probs = np.empty(imgs.shape, np.float32)
+        for b in range(0, len(imgs), self.max_slices):
+            out = self.predict_batch(imgs[b:b+self.max_slices]) if self.binary else None
+            if out is None and not self.binary:
+                out = self.predict_json(imgs[b:b+self.max_slices])
+            if out is None:
+                return None
+            probs[b:b+len(out)] = out
+        return probs
+
+    def predict_batch(self, imgs):
+        response = self.session.post(self.url + BATCH_API, data=encode_array(imgs, self.compress),
+                                     headers={'Content-Type': CONTENT_TYPE}, timeout=self.timeout)
+        if response.status_code in (404, 405, 501): # older server, keep using the JSON API
+            print('Server has no', BATCH_API, 'endpoint, falling back to', JSON_API)
+            self.binary = False
+            return None
+        if response.status_code != 200:
+            print('Predict API call failed.', response)
+            return None
+        return output_to_probabilities(decode_array(response.content))
+
+    def predict_json(self, imgs):
+        probs = np.ones(imgs.shape, np.float32)
+        for i, img in enumerate(imgs):
+            response = self.session.post(self.url + JSON_API, json={'slide': img.tolist()}, timeout=self.timeout)
+            if response.status_code != 200:
+                print('Predict API call failed.', response)
+                return None
+            bin_pred = np.array(json.loads(response.content)['prediction'])
+            probs[i][bin_pred == 1] = 0 # server answers binary annotations
+        return probs
+
+    def close(self):
+        if self._session is not None:
+            self._session.close()
+            self._session = None